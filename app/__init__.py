@@ -10,6 +10,7 @@ from app.core.init_app import (
     register_exceptions,
     register_routers,
 )
+from app.rag.utils.resources import preload_from_env
 
 try:
     from app.settings.config import settings
@@ -35,6 +36,8 @@ def create_app() -> FastAPI:
     )
     register_exceptions(app)
     register_routers(app, prefix="/api")
+    # RAG_PRELOAD_RESOURCES loads the models here, before a pre-forking server starts its workers
+    preload_from_env()
     return app
 
 
@@ -1,12 +1,15 @@
 import hashlib
+import io
 import json
 import logging
+import struct
 import uuid
+import weakref
 from contextlib import contextmanager
-from typing import Any
+from typing import Any, Optional
 
+import numpy as np
 import psycopg2.errors
-import psycopg2.extras  # type: ignore
 import psycopg2.pool  # type: ignore
 from pydantic import BaseModel, model_validator
 
@@ -29,6 +32,15 @@ class PGVectorConfig(BaseModel):
     min_connection: int
     max_connection: int
     pg_bigm: bool = False
+    # rows per binary COPY batch, bounds the client side buffer during bulk loads
+    insert_batch_size: int = 1000
+    # "hnsw" or "ivfflat"
+    index_type: str = "hnsw"
+    # build the vector index after the initial bulk load instead of maintaining it row by row
+    defer_index: bool = False
+    ivfflat_lists: int = 100
+    hnsw_ef_search: Optional[int] = None
+    ivfflat_probes: Optional[int] = None
 
     @model_validator(mode="before")
     @classmethod
@@ -49,6 +61,8 @@ class PGVectorConfig(BaseModel):
             raise ValueError("config PGVECTOR_MAX_CONNECTION is required")
         if values["min_connection"] > values["max_connection"]:
             raise ValueError("config PGVECTOR_MIN_CONNECTION should less than PGVECTOR_MAX_CONNECTION")
+        if values.get("index_type", "hnsw") not in ("hnsw", "ivfflat"):
+            raise ValueError("config PGVECTOR_INDEX_TYPE should be hnsw or ivfflat")
         return values
 
 
@@ -66,12 +80,34 @@ CREATE INDEX IF NOT EXISTS embedding_cosine_v1_idx_{index_hash} ON {table_name}
 USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
 """
 
+SQL_CREATE_INDEX_IVFFLAT = """
+CREATE INDEX IF NOT EXISTS embedding_cosine_ivfflat_idx_{index_hash} ON {table_name}
+USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists});
+"""
+
 SQL_CREATE_INDEX_PG_BIGM = """
 CREATE INDEX IF NOT EXISTS bigm_idx_{index_hash} ON {table_name}
 USING gin (text gin_bigm_ops);
 """
 
 
+# Binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack("!h", -1)
+# jsonb binary input is a version byte followed by the json text
+JSONB_BINARY_VERSION = b"\x01"
+
+
+def _copy_field(data: bytes) -> bytes:
+    return struct.pack("!i", len(data)) + data
+
+
+def _copy_vector(embedding: list[float]) -> bytes:
+    # pgvector binary input: int16 dimension, int16 unused, big endian float4 values
+    values = np.asarray(embedding, dtype=">f4")
+    return _copy_field(struct.pack("!hh", values.shape[0], 0) + values.tobytes())
+
+
 class PGVector(BaseVector):
     def __init__(self, collection_name: str, config: PGVectorConfig):
         super().__init__(collection_name)
@@ -79,6 +115,14 @@ class PGVector(BaseVector):
         self.table_name = f"embedding_{collection_name}"
         self.index_hash = hashlib.md5(self.table_name.encode()).hexdigest()[:8]
         self.pg_bigm = config.pg_bigm
+        self.insert_batch_size = max(1, config.insert_batch_size)
+        self.index_type = config.index_type
+        self.defer_index = config.defer_index
+        self.ivfflat_lists = config.ivfflat_lists
+        self.hnsw_ef_search = config.hnsw_ef_search
+        self.ivfflat_probes = config.ivfflat_probes
+        # names of the statements already prepared on each pooled connection
+        self._prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
 
     def get_type(self) -> str:
         return VectorType.PGVECTOR
@@ -108,28 +152,94 @@ class PGVector(BaseVector):
     def create(self, texts: list[Document], embeddings: list[list[float]], **kwargs):
         dimension = len(embeddings[0])
         self._create_collection(dimension)
-        return self.add_texts(texts, embeddings)
+        pks = self.add_texts(texts, embeddings)
+        if self.defer_index:
+            self.create_index(dimension)
+        return pks
 
     def add_texts(self, documents: list[Document], embeddings: list[list[float]], **kwargs):
-        values = []
+        """
+        Load documents with binary COPY, ``insert_batch_size`` rows per COPY.
+
+        Each batch is encoded into one buffer and sent in a single round trip, the embeddings
+        go over the wire as packed float4 instead of their decimal text form.
+        """
         pks = []
-        for i, doc in enumerate(documents):
-            if doc.metadata is not None:
+        batch = io.BytesIO()
+        rows = 0
+        with self._get_cursor() as cur:
+            for i, doc in enumerate(documents):
+                if doc.metadata is None:
+                    continue
                 doc_id = doc.metadata.get("doc_id", str(uuid.uuid4()))
                 pks.append(doc_id)
-                values.append(
-                    (
-                        doc_id,
-                        doc.page_content,
-                        json.dumps(doc.metadata),
-                        embeddings[i],
+                if not rows:
+                    batch.write(COPY_BINARY_HEADER)
+                batch.write(struct.pack("!h", 4))
+                batch.write(_copy_field(uuid.UUID(str(doc_id)).bytes))
+                batch.write(_copy_field(doc.page_content.encode("utf-8")))
+                batch.write(_copy_field(JSONB_BINARY_VERSION + json.dumps(doc.metadata).encode("utf-8")))
+                batch.write(_copy_vector(embeddings[i]))
+                rows += 1
+                if rows >= self.insert_batch_size:
+                    self._copy_batch(cur, batch)
+                    batch = io.BytesIO()
+                    rows = 0
+            if rows:
+                self._copy_batch(cur, batch)
+        return pks
+
+    def _copy_batch(self, cur, batch: io.BytesIO):
+        batch.write(COPY_BINARY_TRAILER)
+        batch.seek(0)
+        cur.copy_expert(f"COPY {self.table_name} (id, text, meta, embedding) FROM STDIN WITH (FORMAT binary)", batch)
+
+    def create_index(self, dimension: int):
+        """
+        Build the vector index, call once after a bulk load when ``defer_index`` is set.
+
+        Building it over the loaded rows is much cheaper than maintaining the graph on every insert,
+        and lets ivfflat pick its centroids from real data.
+        """
+        # PG hnsw index only support 2000 dimension or less
+        # ref: https://github.com/pgvector/pgvector?tab=readme-ov-file#indexing
+        if dimension > 2000:
+            return
+        with self._get_cursor() as cur:
+            if self.index_type == "ivfflat":
+                cur.execute(
+                    SQL_CREATE_INDEX_IVFFLAT.format(
+                        table_name=self.table_name, index_hash=self.index_hash, lists=self.ivfflat_lists
                     )
                 )
-        with self._get_cursor() as cur:
-            psycopg2.extras.execute_values(
-                cur, f"INSERT INTO {self.table_name} (id, text, meta, embedding) VALUES %s", values
-            )
-        return pks
+            else:
+                cur.execute(SQL_CREATE_INDEX.format(table_name=self.table_name, index_hash=self.index_hash))
+            cur.execute(f"ANALYZE {self.table_name}")
+
+    def _execute_prepared(self, cur, name: str, arg_types: str, query: str, params: tuple):
+        """
+        Run ``query`` as a server side prepared statement on the cursor's connection.
+
+        The statement is prepared the first time a connection sees it, later calls only send
+        ``EXECUTE`` with the parameters so the server can reuse the plan.
+        """
+        name = f"{name}_{self.index_hash}"
+        prepared = self._prepared.setdefault(cur.connection, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} ({arg_types}) AS {query}")
+            prepared.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+    def _set_search_params(self, cur, **kwargs):
+        # SET LOCAL only lasts until the cursor's transaction commits, so it never leaks into
+        # other searches sharing the pooled connection
+        ef_search = kwargs.get("ef_search", self.hnsw_ef_search)
+        if ef_search:
+            cur.execute("SET LOCAL hnsw.ef_search = %s", (int(ef_search),))
+        probes = kwargs.get("probes", self.ivfflat_probes)
+        if probes:
+            cur.execute("SET LOCAL ivfflat.probes = %s", (int(probes),))
 
     def text_exists(self, id: str) -> bool:
         with self._get_cursor() as cur:
@@ -169,24 +279,35 @@ class PGVector(BaseVector):
         Search the nearest neighbors to a vector.
 
         :param query_vector: The input vector to search for similar items.
+        :param ef_search: Overrides ``hnsw.ef_search`` for this query.
+        :param probes: Overrides ``ivfflat.probes`` for this query.
         :return: List of Documents that are nearest to the query vector.
         """
         top_k = kwargs.get("top_k", 4)
         if not isinstance(top_k, int) or top_k <= 0:
             raise ValueError("top_k must be a positive integer")
         document_ids_filter = kwargs.get("document_ids_filter")
-        where_clause = ""
-        if document_ids_filter:
-            document_ids = ", ".join(f"'{id}'" for id in document_ids_filter)
-            where_clause = f" WHERE meta->>'document_id' in ({document_ids}) "
 
         with self._get_cursor() as cur:
-            cur.execute(
-                f"SELECT meta, text, embedding <=> %s AS distance FROM {self.table_name}"
-                f" {where_clause}"
-                f" ORDER BY distance LIMIT {top_k}",
-                (json.dumps(query_vector),),
-            )
+            self._set_search_params(cur, **kwargs)
+            if document_ids_filter:
+                self._execute_prepared(
+                    cur,
+                    "search_by_vector_filtered",
+                    "vector, int, text[]",
+                    f"SELECT meta, text, embedding <=> $1 AS distance FROM {self.table_name}"
+                    f" WHERE meta->>'document_id' = ANY($3)"
+                    f" ORDER BY distance LIMIT $2",
+                    (json.dumps(query_vector), top_k, list(document_ids_filter)),
+                )
+            else:
+                self._execute_prepared(
+                    cur,
+                    "search_by_vector",
+                    "vector, int",
+                    f"SELECT meta, text, embedding <=> $1 AS distance FROM {self.table_name} ORDER BY distance LIMIT $2",
+                    (json.dumps(query_vector), top_k),
+                )
             docs = []
             score_threshold = float(kwargs.get("score_threshold") or 0.0)
             for record in cur:
@@ -204,31 +325,41 @@ class PGVector(BaseVector):
         with self._get_cursor() as cur:
             document_ids_filter = kwargs.get("document_ids_filter")
             where_clause = ""
+            # f"'{query}'" is required in order to account for whitespace in query
+            params: tuple = (f"'{query}'", top_k)
+            arg_types = "text, int"
+            name = "search_by_full_text"
             if document_ids_filter:
-                document_ids = ", ".join(f"'{id}'" for id in document_ids_filter)
-                where_clause = f" AND meta->>'document_id' in ({document_ids}) "
+                where_clause = " AND meta->>'document_id' = ANY($3) "
+                params += (list(document_ids_filter),)
+                arg_types += ", text[]"
+                name += "_filtered"
             if self.pg_bigm:
                 cur.execute("SET pg_bigm.similarity_limit TO 0.000001")
-                cur.execute(
-                    f"""SELECT meta, text, bigm_similarity(unistr(%s), coalesce(text, '')) AS score
+                self._execute_prepared(
+                    cur,
+                    name + "_bigm",
+                    arg_types,
+                    f"""SELECT meta, text, bigm_similarity(unistr($1), coalesce(text, '')) AS score
                     FROM {self.table_name}
-                    WHERE text =%% unistr(%s)
+                    WHERE text =% unistr($1)
                     {where_clause}
                     ORDER BY score DESC
-                    LIMIT {top_k}""",
-                    # f"'{query}'" is required in order to account for whitespace in query
-                    (f"'{query}'", f"'{query}'"),
+                    LIMIT $2""",
+                    params,
                 )
             else:
-                cur.execute(
-                    f"""SELECT meta, text, ts_rank(to_tsvector(coalesce(text, '')), plainto_tsquery(%s)) AS score
+                self._execute_prepared(
+                    cur,
+                    name,
+                    arg_types,
+                    f"""SELECT meta, text, ts_rank(to_tsvector(coalesce(text, '')), plainto_tsquery($1)) AS score
                     FROM {self.table_name}
-                    WHERE to_tsvector(text) @@ plainto_tsquery(%s)
+                    WHERE to_tsvector(text) @@ plainto_tsquery($1)
                     {where_clause}
                     ORDER BY score DESC
-                    LIMIT {top_k}""",
-                    # f"'{query}'" is required in order to account for whitespace in query
-                    (f"'{query}'", f"'{query}'"),
+                    LIMIT $2""",
+                    params,
                 )
 
             docs = []
@@ -255,12 +386,10 @@ class PGVector(BaseVector):
             with self._get_cursor() as cur:
                 cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
                 cur.execute(SQL_CREATE_TABLE.format(table_name=self.table_name, dimension=dimension))
-                # PG hnsw index only support 2000 dimension or less
-                # ref: https://github.com/pgvector/pgvector?tab=readme-ov-file#indexing
-                if dimension <= 2000:
-                    cur.execute(SQL_CREATE_INDEX.format(table_name=self.table_name, index_hash=self.index_hash))
                 if self.pg_bigm:
                     cur.execute(SQL_CREATE_INDEX_PG_BIGM.format(table_name=self.table_name, index_hash=self.index_hash))
+            if not self.defer_index:
+                self.create_index(dimension)
             redis_client.set(collection_exist_cache_key, 1, ex=3600)
 
 
@@ -285,5 +414,12 @@ class PGVectorFactory(AbstractVectorFactory):
                 min_connection=dify_config.PGVECTOR_MIN_CONNECTION,
                 max_connection=dify_config.PGVECTOR_MAX_CONNECTION,
                 pg_bigm=dify_config.PGVECTOR_PG_BIGM,
+                # optional settings, deployments whose config predates them get the defaults
+                insert_batch_size=getattr(dify_config, "PGVECTOR_INSERT_BATCH_SIZE", None) or 1000,
+                index_type=getattr(dify_config, "PGVECTOR_INDEX_TYPE", None) or "hnsw",
+                defer_index=getattr(dify_config, "PGVECTOR_DEFER_INDEX", False),
+                ivfflat_lists=getattr(dify_config, "PGVECTOR_IVFFLAT_LISTS", None) or 100,
+                hnsw_ef_search=getattr(dify_config, "PGVECTOR_HNSW_EF_SEARCH", None),
+                ivfflat_probes=getattr(dify_config, "PGVECTOR_IVFFLAT_PROBES", None),
             ),
         )
@@ -1,7 +1,9 @@
 import json
 import os
 import uuid
+from collections import deque
 from collections.abc import Generator, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
 from typing import TYPE_CHECKING, Any, Optional, Union, cast
 
@@ -46,8 +48,19 @@ class QdrantConfig(BaseModel):
     root_path: Optional[str] = None
     grpc_port: int = 6334
     prefer_grpc: bool = False
+    # batches upserted concurrently, 1 keeps the sequential uploads
+    upsert_parallelism: int = 4
+    # target serialized size of one upsert batch, 0 falls back to fixed batches of upsert_batch_size
+    upsert_batch_bytes: int = 4 * 1024 * 1024
+    upsert_batch_size: int = 1024
+
+    def is_local(self) -> bool:
+        return bool(self.endpoint) and (self.endpoint == ":memory:" or self.endpoint.startswith("path:"))
 
     def to_qdrant_params(self):
+        if self.endpoint == ":memory:":
+            # in-process storage, for tests
+            return {"location": ":memory:"}
         if self.endpoint and self.endpoint.startswith("path:"):
             path = self.endpoint.replace("path:", "")
             if not os.path.isabs(path):
@@ -158,14 +171,52 @@ class QdrantVector(BaseVector):
         added_ids = []
         # Filter out None values from metadatas list to match expected type
         filtered_metadatas = [m for m in metadatas if m is not None]
-        for batch_ids, points in self._generate_rest_batches(
-            texts, embeddings, filtered_metadatas, uuids, 64, self._group_id
-        ):
-            self._client.upsert(collection_name=self._collection_name, points=points)
-            added_ids.extend(batch_ids)
+        batches = self._generate_rest_batches(
+            texts,
+            embeddings,
+            filtered_metadatas,
+            uuids,
+            self._client_config.upsert_batch_size,
+            self._group_id,
+            batch_bytes=self._client_config.upsert_batch_bytes,
+        )
+        parallelism = self._client_config.upsert_parallelism
+        # the local client is neither thread safe nor asynchronous
+        if parallelism <= 1 or self._client_config.is_local():
+            for batch_ids, points in batches:
+                self._client.upsert(collection_name=self._collection_name, points=points)
+                added_ids.extend(batch_ids)
+            return added_ids
+
+        # Keep up to `parallelism` batches in flight. Every upsert waits until its points are applied,
+        # so all of them are visible once this returns, whichever shards they landed on; the speedup
+        # comes from the concurrent requests.
+        in_flight: deque = deque()
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            for batch_ids, points in batches:
+                if len(in_flight) >= parallelism:
+                    in_flight.popleft().result()
+                in_flight.append(
+                    executor.submit(
+                        self._client.upsert,
+                        collection_name=self._collection_name,
+                        points=points,
+                        wait=True,
+                    )
+                )
+                added_ids.extend(batch_ids)
+            while in_flight:
+                in_flight.popleft().result()
 
         return added_ids
 
+    def _point_bytes(self, text: str, metadata: Optional[dict], dimension: int) -> int:
+        """Rough serialized size of one point, used to cut batches by bytes instead of by count."""
+        # a float costs 4 bytes in protobuf and around 20 characters in JSON
+        vector_bytes = dimension * (4 if self._client_config.prefer_grpc else 20)
+        metadata_bytes = len(json.dumps(metadata, ensure_ascii=False)) if metadata else 0
+        return vector_bytes + len(text.encode("utf-8")) + metadata_bytes
+
     def _generate_rest_batches(
         self,
         texts: Iterable[str],
@@ -174,20 +225,38 @@ class QdrantVector(BaseVector):
         ids: Optional[Sequence[str]] = None,
         batch_size: int = 64,
         group_id: Optional[str] = None,
+        batch_bytes: int = 0,
     ) -> Generator[tuple[list[str], list[rest.PointStruct]], None, None]:
+        """
+        Yield (ids, points) batches of at most ``batch_size`` points.
+
+        When ``batch_bytes`` is set a batch is also closed as soon as its estimated serialized size
+        reaches it, so batches of short chunks grow and batches of long chunks shrink.
+        """
         from qdrant_client.http import models as rest
 
+        texts = list(texts)
         texts_iterator = iter(texts)
         embeddings_iterator = iter(embeddings)
         metadatas_iterator = iter(metadatas or [])
-        ids_iterator = iter(ids or [uuid.uuid4().hex for _ in iter(texts)])
-        while batch_texts := list(islice(texts_iterator, batch_size)):
+        ids_iterator = iter(ids or [uuid.uuid4().hex for _ in texts])
+        offset = 0
+        while offset < len(texts):
+            size = batch_size
+            if batch_bytes > 0:
+                size, used = 0, 0
+                while offset + size < len(texts) and size < batch_size and (not size or used < batch_bytes):
+                    metadata = metadatas[offset + size] if metadatas and offset + size < len(metadatas) else None
+                    used += self._point_bytes(texts[offset + size] or "", metadata, len(embeddings[offset + size]))
+                    size += 1
+            offset += size
+            batch_texts = list(islice(texts_iterator, size))
             # Take the corresponding metadata and id for each text in a batch
-            batch_metadatas = list(islice(metadatas_iterator, batch_size)) or None
-            batch_ids = list(islice(ids_iterator, batch_size))
+            batch_metadatas = list(islice(metadatas_iterator, size)) or None
+            batch_ids = list(islice(ids_iterator, size))
 
             # Generate the embeddings for all the texts in a batch
-            batch_embeddings = list(islice(embeddings_iterator, batch_size))
+            batch_embeddings = list(islice(embeddings_iterator, size))
 
             points = [
                 rest.PointStruct(
@@ -466,5 +535,8 @@ class QdrantVectorFactory(AbstractVectorFactory):
                 timeout=dify_config.QDRANT_CLIENT_TIMEOUT,
                 grpc_port=dify_config.QDRANT_GRPC_PORT,
                 prefer_grpc=dify_config.QDRANT_GRPC_ENABLED,
+                # optional settings, deployments whose config predates them get the defaults
+                upsert_parallelism=getattr(dify_config, "QDRANT_UPSERT_PARALLELISM", 4),
+                upsert_batch_bytes=getattr(dify_config, "QDRANT_UPSERT_BATCH_BYTES", 4 * 1024 * 1024),
             ),
         )
@@ -44,7 +44,7 @@ def list_docs_from_db(
     for k, v in metadata.items():
         docs = docs.filter(FileDocModel.meta_data[k].as_string() == str(v))
 
-    return [{"id": x.doc_id, "metadata": x.metadata} for x in docs.all()]
+    return [{"id": x.doc_id, "metadata": x.meta_data} for x in docs.all()]
 
 
 @with_session
@@ -66,6 +66,31 @@ def delete_docs_from_db(
     return docs
 
 
+@with_session
+def delete_docs_from_db_by_ids(
+    session,
+    kb_name: str,
+    file_name: str,
+    doc_ids: List[str],
+) -> int:
+    """
+    删除某知识库某文件中指定id的Document记录，返回删除的条数。
+    """
+    if not doc_ids:
+        return 0
+    count = (
+        session.query(FileDocModel)
+        .filter(
+            FileDocModel.kb_name.ilike(kb_name),
+            FileDocModel.file_name.ilike(file_name),
+            FileDocModel.doc_id.in_([str(x) for x in doc_ids]),
+        )
+        .delete(synchronize_session=False)
+    )
+    session.commit()
+    return count
+
+
 @with_session
 def add_docs_to_db(session, kb_name: str, file_name: str, doc_infos: List[Dict]):
     """
@@ -1,6 +1,12 @@
 """Abstract interface for document loader implementations."""
 
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
 from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, cast
 
 from core.rag.extractor.blob.blob import Blob
@@ -8,6 +14,60 @@ from core.rag.extractor.extractor_base import BaseExtractor
 from core.rag.models.document import Document
 from extensions.ext_storage import storage
 
+# extracted page texts, one file per page under <dir>/<sha256 of the pdf>/
+PDF_PAGE_CACHE_DIR = os.environ.get("PDF_PAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdf_page_cache"))
+# least recently used documents are dropped from the page cache once it grows past this size
+PDF_PAGE_CACHE_MAX_BYTES = int(os.environ.get("PDF_PAGE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+# pages handed to a worker at once
+PDF_PAGES_PER_TASK = 16
+# smaller documents are not worth starting worker processes for
+PDF_PARALLEL_MIN_PAGES = 32
+
+
+def _page_cache_path(cache_dir: str, page_number: int) -> str:
+    return os.path.join(cache_dir, f"{page_number}.txt")
+
+
+def _read_cached_page(cache_dir: str, page_number: int) -> Optional[str]:
+    try:
+        with open(_page_cache_path(cache_dir, page_number), encoding="utf-8", newline="") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _extract_pages(file_path: str, start: int, end: int, cache_dir: Optional[str]) -> list[str]:
+    """Extract the text of pages [start, end), caching each page as soon as it is done.
+
+    Module level so it can run in worker processes, every worker opens the document itself since
+    pdfium handles can't be shared between processes.
+    """
+    import pypdfium2  # type: ignore
+
+    contents = []
+    if cache_dir:
+        # the directory may have been evicted by another process in the meantime
+        os.makedirs(cache_dir, exist_ok=True)
+    pdf_reader = pypdfium2.PdfDocument(file_path, autoclose=True)
+    try:
+        for page_number in range(start, end):
+            page = pdf_reader[page_number]
+            text_page = page.get_textpage()
+            content = text_page.get_text_range()
+            text_page.close()
+            page.close()
+            if cache_dir:
+                path = _page_cache_path(cache_dir, page_number)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            contents.append(content)
+    finally:
+        pdf_reader.close()
+    return contents
+
 
 class PdfExtractor(BaseExtractor):
     """Load pdf files.
@@ -51,18 +111,112 @@ class PdfExtractor(BaseExtractor):
         yield from self.parse(blob)
 
     def parse(self, blob: Blob) -> Iterator[Document]:
-        """Lazily parse the blob."""
+        """Lazily parse the blob.
+
+        Pages already in the page cache are read back, the others are extracted in ranges of
+        PDF_PAGES_PER_TASK pages on PDF_EXTRACT_WORKERS processes. Pages are yielded in order as
+        soon as their range is done.
+        """
         import pypdfium2  # type: ignore
 
-        with blob.as_bytes_io() as file_path:
-            pdf_reader = pypdfium2.PdfDocument(file_path, autoclose=True)
-            try:
-                for page_number, page in enumerate(pdf_reader):
-                    text_page = page.get_textpage()
-                    content = text_page.get_text_range()
-                    text_page.close()
-                    page.close()
-                    metadata = {"source": blob.source, "page": page_number}
-                    yield Document(page_content=content, metadata=metadata)
-            finally:
-                pdf_reader.close()
+        if blob.path is None:
+            # workers need a file to open, in-memory blobs are parsed here without the page cache
+            with blob.as_bytes_io() as file_path:
+                pdf_reader = pypdfium2.PdfDocument(file_path, autoclose=True)
+                try:
+                    for page_number, page in enumerate(pdf_reader):
+                        text_page = page.get_textpage()
+                        content = text_page.get_text_range()
+                        text_page.close()
+                        page.close()
+                        metadata = {"source": blob.source, "page": page_number}
+                        yield Document(page_content=content, metadata=metadata)
+                finally:
+                    pdf_reader.close()
+            return
+
+        file_path = str(blob.path)
+        pdf_reader = pypdfium2.PdfDocument(file_path)
+        try:
+            page_count = len(pdf_reader)
+        finally:
+            pdf_reader.close()
+
+        cache_dir = self._page_cache_dir(file_path)
+        cached = {n: _read_cached_page(cache_dir, n) for n in range(page_count)}
+        ranges = []
+        for page_number in range(page_count):
+            if cached[page_number] is not None:
+                continue
+            if ranges and ranges[-1][1] == page_number and ranges[-1][1] - ranges[-1][0] < PDF_PAGES_PER_TASK:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([page_number, page_number + 1])
+
+        missing = sum(end - start for start, end in ranges)
+        executor = None
+        futures = {}
+        if missing >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_WORKERS > 1:
+            # spawned, not forked: extraction runs inside threaded servers and task workers
+            executor = ProcessPoolExecutor(max_workers=min(PDF_EXTRACT_WORKERS, len(ranges)),
+                                           mp_context=multiprocessing.get_context("spawn"))
+            futures = {
+                start: executor.submit(_extract_pages, file_path, start, end, cache_dir) for start, end in ranges
+            }
+        range_of = {page_number: (start, end) for start, end in ranges for page_number in range(start, end)}
+        try:
+            for page_number in range(page_count):
+                if cached[page_number] is None:
+                    start, end = range_of[page_number]
+                    if executor:
+                        contents = futures[start].result()
+                    else:
+                        contents = _extract_pages(file_path, start, end, cache_dir)
+                    for n, content in zip(range(start, end), contents):
+                        cached[n] = content
+                metadata = {"source": blob.source, "page": page_number}
+                yield Document(page_content=cached[page_number], metadata=metadata)
+        finally:
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            self._evict_page_cache(cache_dir)
+
+    @staticmethod
+    def _page_cache_dir(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        cache_dir = os.path.join(PDF_PAGE_CACHE_DIR, digest.hexdigest())
+        os.makedirs(cache_dir, exist_ok=True)
+        # the directory mtime marks the last use, eviction goes by it
+        os.utime(cache_dir)
+        return cache_dir
+
+    @staticmethod
+    def _evict_page_cache(keep: str):
+        """Remove the least recently used documents until the cache fits PDF_PAGE_CACHE_MAX_BYTES."""
+        entries = []
+        total = 0
+        try:
+            with os.scandir(PDF_PAGE_CACHE_DIR) as it:
+                for entry in it:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    try:
+                        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                        entries.append((entry.stat().st_mtime, size, entry.path))
+                    except FileNotFoundError:
+                        continue
+                    total += size
+        except FileNotFoundError:
+            return
+        if total <= PDF_PAGE_CACHE_MAX_BYTES:
+            return
+        for _, size, path in sorted(entries):
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            if total <= PDF_PAGE_CACHE_MAX_BYTES:
+                break
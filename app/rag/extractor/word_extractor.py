@@ -1,12 +1,17 @@
 """Abstract interface for document loader implementations."""
 
 import datetime
+import hashlib
 import logging
 import mimetypes
 import os
 import re
 import tempfile
+import threading
 import uuid
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from xml.etree import ElementTree
 
@@ -24,6 +29,66 @@ from models.model import UploadFile
 
 logger = logging.getLogger(__name__)
 
+# concurrent image downloads/uploads per document
+IMAGE_WORKERS = 8
+# (tenant_id, sha256 of the image) -> markdown link of the stored image
+IMAGE_CACHE_SIZE = 1024
+_image_cache: OrderedDict = OrderedDict()
+_image_cache_lock = threading.Lock()
+
+
+def _get_cached_image(key):
+    with _image_cache_lock:
+        link = _image_cache.get(key)
+        if link is not None:
+            _image_cache.move_to_end(key)
+        return link
+
+
+def _cache_image(key, link):
+    with _image_cache_lock:
+        _image_cache[key] = link
+        _image_cache.move_to_end(key)
+        while len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+
+
+class _ImageMap:
+    """Image part -> markdown link, resolved as the upload workers finish.
+
+    Looking an image up waits for that image only, so a paragraph can be emitted as soon as the
+    images it references are stored while the rest keep uploading in the background.
+    """
+
+    def __init__(self, extractor: "WordExtractor", futures: dict):
+        self._extractor = extractor
+        self._futures = futures
+        self._links: dict = {}
+
+    def _resolve(self, part):
+        future = self._futures.get(part)
+        if future is None or part in self._links:
+            return
+        future.result()
+        self.flush()
+
+    def flush(self, wait: bool = False):
+        """Register every finished image, with a single commit for the new upload files."""
+        done = {}
+        for part, future in list(self._futures.items()):
+            if wait or future.done():
+                done[part] = future.result()
+                del self._futures[part]
+        self._links.update(self._extractor._register_images(done))
+
+    def __contains__(self, part):
+        self._resolve(part)
+        return part in self._links
+
+    def __getitem__(self, part):
+        self._resolve(part)
+        return self._links[part]
+
 
 class WordExtractor(BaseExtractor):
     """Load docx files.
@@ -70,64 +135,96 @@ class WordExtractor(BaseExtractor):
             )
         ]
 
+    def extract_stream(self) -> Iterator[Document]:
+        """Load given path as one document per paragraph or table, in document order."""
+        for block in self.iter_docx(self.file_path, "storage"):
+            yield Document(
+                page_content=block,
+                metadata={"source": self.file_path},
+            )
+
     @staticmethod
     def _is_valid_url(url: str) -> bool:
         """Check if the url is valid."""
         parsed = urlparse(url)
         return bool(parsed.netloc) and bool(parsed.scheme)
 
-    def _extract_images_from_docx(self, doc):
-        image_count = 0
-        image_map = {}
-
+    def _extract_images_from_docx(self, doc, executor: ThreadPoolExecutor) -> _ImageMap:
+        """Start storing every image of the document on the executor."""
+        futures = {}
         for rel in doc.part.rels.values():
             if "image" in rel.target_ref:
-                image_count += 1
-                if rel.is_external:
-                    url = rel.target_ref
-                    response = ssrf_proxy.get(url)
-                    if response.status_code == 200:
-                        image_ext = mimetypes.guess_extension(response.headers["Content-Type"])
-                        if image_ext is None:
-                            continue
-                        file_uuid = str(uuid.uuid4())
-                        file_key = "image_files/" + self.tenant_id + "/" + file_uuid + "." + image_ext
-                        mime_type, _ = mimetypes.guess_type(file_key)
-                        storage.save(file_key, response.content)
-                    else:
-                        continue
-                else:
-                    image_ext = rel.target_ref.split(".")[-1]
-                    if image_ext is None:
-                        continue
-                    # user uuid as file name
-                    file_uuid = str(uuid.uuid4())
-                    file_key = "image_files/" + self.tenant_id + "/" + file_uuid + "." + image_ext
-                    mime_type, _ = mimetypes.guess_type(file_key)
-
-                    storage.save(file_key, rel.target_part.blob)
-                # save file to db
-                upload_file = UploadFile(
-                    tenant_id=self.tenant_id,
-                    storage_type=dify_config.STORAGE_TYPE,
-                    key=file_key,
-                    name=file_key,
-                    size=0,
-                    extension=str(image_ext),
-                    mime_type=mime_type or "",
-                    created_by=self.user_id,
-                    created_by_role=CreatedByRole.ACCOUNT,
-                    created_at=datetime.datetime.now(datetime.UTC).replace(tzinfo=None),
-                    used=True,
-                    used_by=self.user_id,
-                    used_at=datetime.datetime.now(datetime.UTC).replace(tzinfo=None),
-                )
-
-                db.session.add(upload_file)
-                db.session.commit()
-                image_map[rel.target_part] = f"![image]({dify_config.FILES_URL}/files/{upload_file.id}/file-preview)"
-
-        return image_map
+                # external relationships have no target part, key them by their url
+                key = rel.target_ref if rel.is_external else rel.target_part
+                futures[key] = executor.submit(self._save_image, rel)
+        return _ImageMap(self, futures)
+
+    def _save_image(self, rel):
+        """Download (for linked images) and upload one image, runs on the image workers."""
+        try:
+            if rel.is_external:
+                url = rel.target_ref
+                response = ssrf_proxy.get(url)
+                if response.status_code != 200:
+                    return None
+                image_ext = mimetypes.guess_extension(response.headers["Content-Type"])
+                if image_ext is None:
+                    return None
+                content = response.content
+            else:
+                image_ext = rel.target_ref.split(".")[-1]
+                if image_ext is None:
+                    return None
+                content = rel.target_part.blob
+
+            digest = hashlib.sha256(content).hexdigest()
+            link = _get_cached_image((self.tenant_id, digest))
+            if link:
+                return {"link": link}
+            # user uuid as file name
+            file_uuid = str(uuid.uuid4())
+            file_key = "image_files/" + self.tenant_id + "/" + file_uuid + "." + image_ext
+            mime_type, _ = mimetypes.guess_type(file_key)
+            storage.save(file_key, content)
+            return {"digest": digest, "file_key": file_key, "image_ext": image_ext, "mime_type": mime_type}
+        except Exception:
+            logger.exception(f"Failed to save image {rel.target_ref}")
+            return None
+
+    def _register_images(self, saved: dict) -> dict:
+        """Create the upload files of stored images and return their markdown links."""
+        links = {}
+        upload_files = {}
+        for part, image in saved.items():
+            if image is None:
+                continue
+            if "link" in image:
+                links[part] = image["link"]
+                continue
+            # save file to db
+            upload_file = UploadFile(
+                tenant_id=self.tenant_id,
+                storage_type=dify_config.STORAGE_TYPE,
+                key=image["file_key"],
+                name=image["file_key"],
+                size=0,
+                extension=str(image["image_ext"]),
+                mime_type=image["mime_type"] or "",
+                created_by=self.user_id,
+                created_by_role=CreatedByRole.ACCOUNT,
+                created_at=datetime.datetime.now(datetime.UTC).replace(tzinfo=None),
+                used=True,
+                used_by=self.user_id,
+                used_at=datetime.datetime.now(datetime.UTC).replace(tzinfo=None),
+            )
+            db.session.add(upload_file)
+            upload_files[part] = (upload_file, image["digest"])
+        if upload_files:
+            db.session.commit()
+        for part, (upload_file, digest) in upload_files.items():
+            links[part] = f"![image]({dify_config.FILES_URL}/files/{upload_file.id}/file-preview)"
+            _cache_image((self.tenant_id, digest), links[part])
+        return links
 
     def _table_to_markdown(self, table, image_map):
         markdown = []
@@ -204,13 +301,27 @@ class WordExtractor(BaseExtractor):
         return " ".join(paragraph_content) if paragraph_content else ""
 
     def parse_docx(self, docx_path, image_folder):
+        return "\n".join(self.iter_docx(docx_path, image_folder))
+
+    def iter_docx(self, docx_path, image_folder) -> Iterator[str]:
+        """Yield the text of every paragraph and the markdown of every table, in document order.
+
+        Images are stored by a pool of IMAGE_WORKERS threads started before the first block, a block
+        only waits for the images it references.
+        """
         doc = DocxDocument(docx_path)
         os.makedirs(image_folder, exist_ok=True)
 
-        content = []
-
-        image_map = self._extract_images_from_docx(doc)
+        executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="docx-image")
+        try:
+            image_map = self._extract_images_from_docx(doc, executor)
+            yield from self._iter_blocks(doc, image_map)
+            # images that are not referenced from the body still get registered
+            image_map.flush(wait=True)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
+    def _iter_blocks(self, doc, image_map) -> Iterator[str]:
         hyperlinks_url = None
         url_pattern = re.compile(r"http://[^\s+]+//|https://[^\s+]+")
         for para in doc.paragraphs:
@@ -257,18 +368,17 @@ class WordExtractor(BaseExtractor):
                     paragraph_content.append(run.text.strip())
             return "".join(paragraph_content) if paragraph_content else ""
 
-        paragraphs = doc.paragraphs.copy()
-        tables = doc.tables.copy()
+        paragraphs = iter(doc.paragraphs)
+        tables = iter(doc.tables)
         for element in doc.element.body:
             if hasattr(element, "tag"):
                 if isinstance(element.tag, str) and element.tag.endswith("p"):  # paragraph
-                    para = paragraphs.pop(0)
+                    para = next(paragraphs)
                     parsed_paragraph = parse_paragraph(para)
                     if parsed_paragraph.strip():
-                        content.append(parsed_paragraph)
+                        yield parsed_paragraph
                     else:
-                        content.append("\n")
+                        yield "\n"
                 elif isinstance(element.tag, str) and element.tag.endswith("tbl"):  # table
-                    table = tables.pop(0)
-                    content.append(self._table_to_markdown(table, image_map))
-        return "\n".join(content)
+                    table = next(tables)
+                    yield self._table_to_markdown(table, image_map)
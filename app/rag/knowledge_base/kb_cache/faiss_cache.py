@@ -1,5 +1,11 @@
 import os
+import pickle
+import threading
+import uuid
+from typing import Dict, List, Optional
 
+import faiss
+import numpy as np
 from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
 from langchain.vectorstores.faiss import FAISS
@@ -24,7 +30,59 @@ def _new_ds_search(self, search: str) -> Union[str, Document]:
 InMemoryDocstore.search = _new_ds_search
 
 
+# 知识库向量库的存储模式：
+# default: langchain 的 index.faiss + index.pkl，每次修改后整体保存
+# wal: IndexIDMap 快照 + 预写日志，修改只追加日志，快照在后台生成
+FAISS_KB_MODE = os.environ.get("FAISS_KB_MODE", "default")
+FAISS_SNAPSHOT_FILE = "index.snapshot"
+FAISS_WAL_FILE = "index.wal"
+# 日志累计多少次修改后在后台生成新快照
+FAISS_SNAPSHOT_EVERY = int(os.environ.get("FAISS_SNAPSHOT_EVERY", 1000))
+
+
+def _to_id_map(vector_store: FAISS) -> FAISS:
+    """
+    把 flat 索引换成 IndexIDMap，向量的 id 就是 index_to_docstore_id 的 key，删除时不再重排编号
+    """
+    index = vector_store.index
+    if isinstance(index, faiss.IndexIDMap):
+        return vector_store
+    id_map = faiss.index_factory(index.d, "IDMap,Flat", index.metric_type)
+    if index.ntotal:
+        positions = sorted(vector_store.index_to_docstore_id)
+        id_map.add_with_ids(index.reconstruct_n(0, index.ntotal), np.array(positions, dtype="int64"))
+    vector_store.index = id_map
+    return vector_store
+
+
+def _read_wal(path: str):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+            except Exception as e:
+                # 最后一条记录可能在写入时中断
+                logger.warning(f"预写日志 {path} 末尾记录损坏，已忽略: {e}")
+                return
+
+
 class ThreadSafeFaiss(ThreadSafeObject):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # source（小写）-> {id: None}，第一次按文件查找时建立
+        self._source_ids: Optional[Dict[str, Dict[str, None]]] = None
+        # wal 模式下的日志路径，None 表示 default 模式
+        self.wal_path: Optional[str] = None
+        # 文档 id -> IndexIDMap 中的向量 id
+        self._int_ids: Dict[str, int] = {}
+        self._next_id = 0
+        self._wal = None
+        self._wal_records = 0
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_thread: Optional[threading.Thread] = None
+
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"<{cls}: key: {self.key}, obj: {self._obj}, docs_count: {self.docs_count()}>"
@@ -33,6 +91,8 @@ class ThreadSafeFaiss(ThreadSafeObject):
         return len(self._obj.docstore._dict)
 
     def save(self, path: str, create_path: bool = True):
+        if self.wal_path:
+            return self.snapshot()
         with self.acquire():
             if not os.path.isdir(path) and create_path:
                 os.makedirs(path)
@@ -45,11 +105,177 @@ class ThreadSafeFaiss(ThreadSafeObject):
         with self.acquire():
             ids = list(self._obj.docstore._dict.keys())
             if ids:
+                if self.wal_path:
+                    self._append_wal(("delete", ids))
                 ret = self._obj.delete(ids)
                 assert len(self._obj.docstore._dict) == 0
+            self._source_ids = None
+            self._int_ids = {}
             logger.info(f"已将向量库 {self.key} 清空")
         return ret
 
+    def _index_source(self, doc_id: str, doc: Document):
+        source = (doc.metadata.get("source") or "").lower()
+        self._source_ids.setdefault(source, {})[doc_id] = None
+
+    def ids_by_source(self, source: str) -> List[str]:
+        """
+        返回 metadata.source 与 source 相同（不区分大小写）的文档 id
+        """
+        with self.acquire() as vs:
+            if self._source_ids is None:
+                self._source_ids = {}
+                for doc_id, doc in vs.docstore._dict.items():
+                    self._index_source(doc_id, doc)
+            return list(self._source_ids.get(source.lower(), {}))
+
+    def add_embeddings(
+        self, texts: List[str], embeddings: List[List[float]], metadatas: List[dict]
+    ) -> List[str]:
+        """
+        添加已经向量化的文本，调用方应在锁外完成向量化，这里只占用很短的时间
+        """
+        with self.acquire() as vs:
+            if not self.wal_path:
+                ids = vs.add_embeddings(text_embeddings=zip(texts, embeddings), metadatas=metadatas)
+            else:
+                ids = [str(uuid.uuid4()) for _ in texts]
+                start = self._next_id
+                int_ids = list(range(start, start + len(ids)))
+                vectors = np.array(embeddings, dtype=np.float32)
+                if vs._normalize_L2:
+                    faiss.normalize_L2(vectors)
+                record = ("add", ids, int_ids, texts, metadatas, vectors)
+                self._append_wal(record)
+                self._apply(vs, record)
+                self._next_id += len(ids)
+            if self._source_ids is not None:
+                for doc_id in ids:
+                    self._index_source(doc_id, vs.docstore._dict[doc_id])
+        self._maybe_snapshot()
+        return ids
+
+    def delete_ids(self, ids: List[str]):
+        with self.acquire() as vs:
+            if self._source_ids is not None:
+                for doc_id in ids:
+                    doc = vs.docstore._dict.get(doc_id)
+                    if doc is not None:
+                        source = (doc.metadata.get("source") or "").lower()
+                        self._source_ids.get(source, {}).pop(doc_id, None)
+            if not self.wal_path:
+                ret = vs.delete(ids)
+            else:
+                record = ("delete", list(ids))
+                self._append_wal(record)
+                ret = self._apply(vs, record)
+        self._maybe_snapshot()
+        return ret
+
+    def _apply(self, vs: FAISS, record) -> bool:
+        """
+        把一条日志应用到 IndexIDMap 向量库，重复应用同一条记录不会产生副作用
+        """
+        if record[0] == "add":
+            _, ids, int_ids, texts, metadatas, vectors = record
+            keep = [i for i, doc_id in enumerate(ids)
+                    if doc_id not in vs.docstore._dict and int_ids[i] not in vs.index_to_docstore_id]
+            if not keep:
+                return True
+            vs.index.add_with_ids(vectors[keep], np.array([int_ids[i] for i in keep], dtype="int64"))
+            vs.docstore.add({ids[i]: Document(page_content=texts[i], metadata=metadatas[i]) for i in keep})
+            vs.index_to_docstore_id.update({int_ids[i]: ids[i] for i in keep})
+            self._int_ids.update({ids[i]: int_ids[i] for i in keep})
+            return True
+        ids = set(record[1])
+        int_ids = [self._int_ids.pop(doc_id) for doc_id in ids if doc_id in self._int_ids]
+        if int_ids:
+            vs.index.remove_ids(np.array(int_ids, dtype="int64"))
+            for i in int_ids:
+                del vs.index_to_docstore_id[i]
+        existing = [doc_id for doc_id in ids if doc_id in vs.docstore._dict]
+        if existing:
+            vs.docstore.delete(existing)
+        return True
+
+    def open_wal(self, path: str):
+        """
+        重放 path 目录下的日志，之后的修改都先写入日志
+        """
+        self.wal_path = os.path.join(path, FAISS_WAL_FILE)
+        self._int_ids = {doc_id: i for i, doc_id in self._obj.index_to_docstore_id.items()}
+        for wal in [self.wal_path + ".snapshotting", self.wal_path]:
+            if os.path.isfile(wal):
+                for record in _read_wal(wal):
+                    self._apply(self._obj, record)
+                    self._wal_records += 1
+        self._next_id = max(self._obj.index_to_docstore_id, default=-1) + 1
+        self._wal = open(self.wal_path, "ab")
+        if self._wal_records or not os.path.isfile(os.path.join(path, FAISS_SNAPSHOT_FILE)):
+            self.snapshot()
+
+    def _append_wal(self, record):
+        pickle.dump(record, self._wal, protocol=pickle.HIGHEST_PROTOCOL)
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+        self._wal_records += 1
+
+    def _maybe_snapshot(self):
+        if not self.wal_path or self._wal_records < FAISS_SNAPSHOT_EVERY:
+            return
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        self._snapshot_thread = threading.Thread(target=self.snapshot, name=f"faiss-snapshot-{self.key}", daemon=True)
+        self._snapshot_thread.start()
+
+    def snapshot(self):
+        """
+        生成快照：持锁时只复制索引和文档表并切换日志文件，序列化和写盘在锁外进行，
+        写入临时文件后原子地重命名为 index.snapshot，完成后删除被快照覆盖的日志
+        """
+        if not self.wal_path:
+            return
+        with self._snapshot_lock:
+            wal_dir = os.path.dirname(self.wal_path)
+            rotated = self.wal_path + ".snapshotting"
+            with self.acquire() as vs:
+                if self._wal is None:
+                    return
+                index_bytes = faiss.serialize_index(vs.index)
+                docstore = dict(vs.docstore._dict)
+                index_to_docstore_id = dict(vs.index_to_docstore_id)
+                self._wal.close()
+                if os.path.isfile(rotated):
+                    # 上一次快照没有完成，把日志接在后面，两份都由这次快照覆盖
+                    with open(rotated, "ab") as dst, open(self.wal_path, "rb") as src:
+                        dst.write(src.read())
+                    os.remove(self.wal_path)
+                elif os.path.isfile(self.wal_path):
+                    os.replace(self.wal_path, rotated)
+                self._wal = open(self.wal_path, "ab")
+                self._wal_records = 0
+
+            tmp_path = os.path.join(wal_dir, FAISS_SNAPSHOT_FILE + ".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump((index_bytes, docstore, index_to_docstore_id), f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(wal_dir, FAISS_SNAPSHOT_FILE))
+            if os.path.isfile(rotated):
+                os.remove(rotated)
+            logger.info(f"已将向量库 {self.key} 的快照保存到磁盘")
+
+    def close(self):
+        """
+        等待后台快照结束并关闭日志，向量库目录被删除前调用
+        """
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        with self.acquire():
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
 
 class _FaissPool(CachePool):
     def new_vector_store(
@@ -94,6 +320,7 @@ class KBFaissPool(_FaissPool):
         vector_name: str = None,
         create: bool = True,
         embed_model: str = get_default_embedding(),
+        wal: bool = False,
     ) -> ThreadSafeFaiss:
         self.atomic.acquire()
         locked = True
@@ -111,7 +338,18 @@ class KBFaissPool(_FaissPool):
                     )
                     vs_path = get_vs_path(kb_name, vector_name)
 
-                    if os.path.isfile(os.path.join(vs_path, "index.faiss")):
+                    if wal and os.path.isfile(os.path.join(vs_path, FAISS_SNAPSHOT_FILE)):
+                        embeddings = get_Embeddings(embed_model=embed_model)
+                        with open(os.path.join(vs_path, FAISS_SNAPSHOT_FILE), "rb") as f:
+                            index_bytes, docstore, index_to_docstore_id = pickle.load(f)
+                        vector_store = FAISS(
+                            embeddings,
+                            faiss.deserialize_index(index_bytes),
+                            InMemoryDocstore(docstore),
+                            index_to_docstore_id,
+                            normalize_L2=True,
+                        )
+                    elif os.path.isfile(os.path.join(vs_path, "index.faiss")):
                         embeddings = get_Embeddings(embed_model=embed_model)
                         vector_store = FAISS.load_local(
                             vs_path,
@@ -130,6 +368,9 @@ class KBFaissPool(_FaissPool):
                     else:
                         raise RuntimeError(f"knowledge base {kb_name} not exist.")
                     item.obj = vector_store
+                    if wal:
+                        item.obj = _to_id_map(vector_store)
+                        item.open_wal(vs_path)
                     item.finish_loading()
             else:
                 self.atomic.release()
@@ -2,6 +2,7 @@ import asyncio
 import json
 import os
 import urllib
+import uuid
 from typing import Dict, List
 
 from fastapi import Body, File, Form, Query, UploadFile
@@ -32,6 +33,7 @@ from chatchat.server.utils import (
     get_default_embedding,
 )
 from chatchat.utils import build_logger
+from rag.utils.file_utils import FileTooLargeError, HashingReader, copy_stream, file_digest
 
 logger = build_logger()
 
@@ -115,21 +117,32 @@ def _save_files_in_thread(
             )
             data = {"knowledge_base_name": knowledge_base_name, "file_name": filename}
 
-            file_content = file.file.read()  # 读取上传文件的内容
-            if (
-                    os.path.isfile(file_path)
-                    and not override
-                    and os.path.getsize(file_path) == len(file_content)
-            ):
-                file_status = f"文件 {filename} 已存在。"
-                logger.warn(file_status)
-                return dict(code=404, msg=file_status, data=data)
-
             if not os.path.isdir(os.path.dirname(file_path)):
                 os.makedirs(os.path.dirname(file_path))
-            with open(file_path, "wb") as f:
-                f.write(file_content)
+            # 分块写入临时文件，边写边计算摘要并检查大小，内存占用与文件大小无关
+            reader = HashingReader(file.file)
+            tmp_path = f"{file_path}.{uuid.uuid4().hex}.uploading"
+            try:
+                with open(tmp_path, "wb") as f:
+                    copy_stream(reader, f)
+                if (
+                        os.path.isfile(file_path)
+                        and not override
+                        and os.path.getsize(file_path) == reader.size
+                        and file_digest(file_path) == reader.hexdigest()
+                ):
+                    file_status = f"文件 {filename} 已存在。"
+                    logger.warn(file_status)
+                    return dict(code=404, msg=file_status, data=data)
+                os.replace(tmp_path, file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
             return dict(code=200, msg=f"成功上传文件 {filename}", data=data)
+        except FileTooLargeError as e:
+            msg = f"{filename} 文件上传失败，报错信息为: {e}"
+            logger.error(msg)
+            return dict(code=413, msg=msg, data=data)
         except Exception as e:
             msg = f"{filename} 文件上传失败，报错信息为: {e}"
             logger.error(f"{e.__class__.__name__}: {msg}")
@@ -1,5 +1,8 @@
+import hashlib
+import json
 import operator
 import os
+from collections import defaultdict
 from abc import ABC, abstractmethod
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
@@ -20,6 +23,7 @@ from chatchat.server.db.repository.knowledge_base_repository import (
 from chatchat.server.db.repository.knowledge_file_repository import (
     add_file_to_db,
     count_files_from_db,
+    delete_docs_from_db_by_ids,
     delete_file_from_db,
     delete_files_from_db,
     file_exists_in_db,
@@ -129,19 +133,10 @@ class KBService(ABC):
             custom_docs = False
 
         if docs:
-            # 将 metadata["source"] 改为相对路径
-            for doc in docs:
-                try:
-                    doc.metadata.setdefault("source", kb_file.filename)
-                    source = doc.metadata.get("source", "")
-                    if os.path.isabs(source):
-                        rel_path = Path(source).relative_to(self.doc_path)
-                        doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
-                except Exception as e:
-                    print(
-                        f"cannot convert absolute path ({source}) to relative path. error is : {e}"
-                    )
-            self.delete_doc(kb_file)
+            self._prepare_docs(kb_file, docs)
+            self.delete_doc(
+                kb_file, not_refresh_vs_cache=kwargs.get("not_refresh_vs_cache", False)
+            )
             doc_infos = self.do_add_doc(docs, **kwargs)
             status = add_file_to_db(
                 kb_file,
@@ -153,6 +148,24 @@ class KBService(ABC):
             status = False
         return status
 
+    def _prepare_docs(self, kb_file: KnowledgeFile, docs: List[Document]):
+        """
+        将 metadata["source"] 改为相对路径，并记录每个文档的内容摘要 metadata["chunk_hash"]
+        """
+        for doc in docs:
+            try:
+                doc.metadata.setdefault("source", kb_file.filename)
+                source = doc.metadata.get("source", "")
+                if os.path.isabs(source):
+                    rel_path = Path(source).relative_to(self.doc_path)
+                    doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
+            except Exception as e:
+                print(
+                    f"cannot convert absolute path ({source}) to relative path. error is : {e}"
+                )
+            doc.metadata["chunk_hash"] = chunk_hash(doc)
+        return docs
+
     def delete_doc(
         self, kb_file: KnowledgeFile, delete_content: bool = False, **kwargs
     ):
@@ -184,9 +197,70 @@ class KBService(ABC):
             return False
 
         if os.path.exists(kb_file.filepath):
+            status = self.update_doc_incrementally(kb_file, docs=docs, **kwargs)
+            if status is not None:
+                return status
             self.delete_doc(kb_file, **kwargs)
             return self.add_doc(kb_file, docs=docs, **kwargs)
 
+    def update_doc_incrementally(
+        self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs
+    ) -> Optional[bool]:
+        """
+        按内容摘要增量更新文件：只向量化新增或修改过的文档，并只删除已不存在的文档。
+        旧数据没有摘要或向量库不支持按id删除时返回None，由调用方回退到全量重建。
+        """
+        prev_docs = list_docs_from_db(kb_name=self.kb_name, file_name=kb_file.filename)
+        if not prev_docs:
+            return None
+        prev_ids = defaultdict(list)
+        for x in prev_docs:
+            h = (x.get("metadata") or {}).get("chunk_hash")
+            if not h:
+                return None
+            prev_ids[h].append(x["id"])
+
+        if docs:
+            custom_docs = True
+        else:
+            docs = kb_file.file2text()
+            custom_docs = False
+        if not docs:
+            return None
+        self._prepare_docs(kb_file, docs)
+
+        # 相同内容的文档可能出现多次，按摘要逐个配对
+        pending_docs = []
+        for doc in docs:
+            ids = prev_ids.get(doc.metadata["chunk_hash"])
+            if ids:
+                ids.pop()
+            else:
+                pending_docs.append(doc)
+        stale_ids = [_id for ids in prev_ids.values() for _id in ids]
+
+        try:
+            if stale_ids:
+                self.del_doc_by_ids(stale_ids)
+        except NotImplementedError:
+            return None
+        delete_docs_from_db_by_ids(
+            kb_name=self.kb_name, file_name=kb_file.filename, doc_ids=stale_ids
+        )
+        doc_infos = self.do_add_doc(pending_docs, **kwargs) if pending_docs else []
+        if stale_ids and not pending_docs and not kwargs.get("not_refresh_vs_cache"):
+            self.save_vector_store()
+        logger.info(
+            f"{kb_file.filename}: {len(docs) - len(pending_docs)} docs reused, "
+            f"{len(pending_docs)} added, {len(stale_ids)} deleted"
+        )
+        return add_file_to_db(
+            kb_file,
+            custom_docs=custom_docs,
+            docs_count=len(docs),
+            doc_infos=doc_infos,
+        )
+
     def exist_doc(self, file_name: str):
         return file_exists_in_db(
             KnowledgeFile(knowledge_base_name=self.kb_name, filename=file_name)
@@ -507,6 +581,16 @@ def get_kb_file_details(kb_name: str) -> List[Dict]:
     return data
 
 
+def chunk_hash(doc: Document) -> str:
+    """
+    文档内容及元数据的摘要，用于增量更新时比对文档是否变化
+    """
+    metadata = {k: v for k, v in doc.metadata.items() if k != "chunk_hash"}
+    h = hashlib.sha1(doc.page_content.encode("utf-8"))
+    h.update(json.dumps(metadata, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
 def score_threshold_process(score_threshold, k, docs):
     if score_threshold is not None:
         cmp = operator.le
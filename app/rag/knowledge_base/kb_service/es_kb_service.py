@@ -1,9 +1,11 @@
 import logging
 import os
 import shutil
+import uuid
 from typing import List
 
 from elasticsearch import BadRequestError, Elasticsearch
+from elasticsearch.helpers import bulk
 from langchain.schema import Document
 from langchain_community.vectorstores.elasticsearch import (
     ApproxRetrievalStrategy,
@@ -36,6 +38,11 @@ class ESKBService(KBService):
         self.client_key = kb_config.get("client_key", None)
         self.client_cert = kb_config.get("client_cert", None)
         self.dims_length = kb_config.get("dims_length", None)
+        # 每个 bulk 请求包含的文档数，整批写完后只刷新一次索引
+        self.bulk_chunk_size = kb_config.get("bulk_chunk_size", 500)
+        # delete_by_query 的切片数和等待超时
+        self.delete_slices = kb_config.get("delete_slices", "auto")
+        self.delete_timeout = kb_config.get("delete_timeout", "10m")
         self.embeddings_model = get_Embeddings(self.embed_model)
         try:
             connection_info = dict(
@@ -158,44 +165,60 @@ class ESKBService(KBService):
         return results
 
     def del_doc_by_ids(self, ids: List[str]) -> bool:
-        for doc_id in ids:
-            try:
-                self.es_client_python.delete(
-                    index=self.index_name, id=doc_id, refresh=True
-                )
-            except Exception as e:
-                logger.error(f"ES Docs Delete Error! {e}")
+        actions = (
+            {"_op_type": "delete", "_index": self.index_name, "_id": doc_id}
+            for doc_id in ids
+        )
+        try:
+            _, errors = bulk(
+                self.es_client_python,
+                actions,
+                chunk_size=self.bulk_chunk_size,
+                raise_on_error=False,
+                refresh=False,
+            )
+            self.es_client_python.indices.refresh(index=self.index_name)
+        except Exception as e:
+            logger.error(f"ES Docs Delete Error! {e}")
+            return False
+        for error in errors:
+            logger.error(f"ES Docs Delete Error! {error}")
+        return not errors
 
     def do_delete_doc(self, kb_file, **kwargs):
         if self.es_client_python.indices.exists(index=self.index_name):
             # 从向量数据库中删除索引(文档名称是Keyword)
             query = {
-                "query": {
-                    "term": {
-                        "metadata.source.keyword": self.get_relative_source_path(
-                            kb_file.filepath
-                        )
-                    }
-                },
-                "track_total_hits": True,
+                "term": {
+                    "metadata.source.keyword": self.get_relative_source_path(
+                        kb_file.filepath
+                    )
+                }
             }
-            # 注意设置size，默认返回10个，es检索设置track_total_hits为True返回数据库中真实的size。
-            size = self.es_client_python.search(body=query)["hits"]["total"]["value"]
-            search_results = self.es_client_python.search(body=query, size=size)
-            delete_list = [hit["_id"] for hit in search_results["hits"]["hits"]]
-            if len(delete_list) == 0:
-                return None
-            else:
-                for doc_id in delete_list:
-                    try:
-                        self.es_client_python.delete(
-                            index=self.index_name, id=doc_id, refresh=True
-                        )
-                    except Exception as e:
-                        logger.error(f"ES Docs Delete Error! {e}")
-
-            # self.db.delete(ids=delete_list)
-            # self.es_client_python.indices.refresh(index=self.index_name)
+            # 以后台任务的方式切片执行 delete_by_query，结束时只刷新一次索引，
+            # 等待任务完成后再返回，避免随后写入的同名文件被删除
+            try:
+                task = self.es_client_python.delete_by_query(
+                    index=self.index_name,
+                    query=query,
+                    slices=self.delete_slices,
+                    conflicts="proceed",
+                    refresh=True,
+                    wait_for_completion=False,
+                )
+                result = self.es_client_python.tasks.get(
+                    task_id=task["task"],
+                    wait_for_completion=True,
+                    timeout=self.delete_timeout,
+                )
+                response = result.get("response", {})
+                if response.get("failures"):
+                    logger.error(f"ES Docs Delete Error! {response['failures']}")
+                logger.info(
+                    f"已从索引 {self.index_name} 删除文件 {kb_file.filename} 的 {response.get('deleted', 0)} 条数据"
+                )
+            except Exception as e:
+                logger.error(f"ES Docs Delete Error! {e}")
 
     def do_add_doc(self, docs: List[Document], **kwargs):
         """向知识库添加文件"""
@@ -205,28 +228,21 @@ class ESKBService(KBService):
         )
         print("*" * 100)
 
-        self.db.add_documents(documents=docs)
-        # 获取 id 和 source , 格式：[{"id": str, "metadata": dict}, ...]
+        # 由客户端生成 id，通过 bulk 写入后直接返回，整批写完只刷新一次索引
+        ids = [str(uuid.uuid4()) for _ in docs]
+        ids = self.db.add_texts(
+            texts=[doc.page_content for doc in docs],
+            metadatas=[doc.metadata for doc in docs],
+            ids=ids,
+            refresh_indices=False,
+            bulk_kwargs={"chunk_size": self.bulk_chunk_size},
+        )
+        self.es_client_python.indices.refresh(index=self.index_name)
         print("写入数据成功.")
         print("*" * 100)
 
-        if self.es_client_python.indices.exists(index=self.index_name):
-            file_path = docs[0].metadata.get("source")
-            query = {
-                "query": {
-                    "term": {"metadata.source.keyword": file_path},
-                    "term": {"_index": self.index_name},
-                }
-            }
-            # 注意设置size，默认返回10个。
-            search_results = self.es_client_python.search(body=query, size=50)
-            if len(search_results["hits"]["hits"]) == 0:
-                raise ValueError("召回元素个数为0")
-            info_docs = [
-                {"id": hit["_id"], "metadata": hit["_source"]["metadata"]}
-                for hit in search_results["hits"]["hits"]
-            ]
-            return info_docs
+        # 获取 id 和 source , 格式：[{"id": str, "metadata": dict}, ...]
+        return [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
 
     def do_clear_vs(self):
         """从知识库删除全部向量"""
@@ -7,6 +7,7 @@ from langchain.docstore.document import Document
 from chatchat.settings import Settings
 from chatchat.server.file_rag.utils import get_Retriever
 from chatchat.server.knowledge_base.kb_cache.faiss_cache import (
+    FAISS_KB_MODE,
     ThreadSafeFaiss,
     kb_faiss_pool,
 )
@@ -33,6 +34,7 @@ class FaissKBService(KBService):
             kb_name=self.kb_name,
             vector_name=self.vector_name,
             embed_model=self.embed_model,
+            wal=FAISS_KB_MODE == "wal",
         )
 
     def save_vector_store(self):
@@ -43,8 +45,7 @@ class FaissKBService(KBService):
             return [vs.docstore._dict.get(id) for id in ids]
 
     def del_doc_by_ids(self, ids: List[str]) -> bool:
-        with self.load_vector_store().acquire() as vs:
-            vs.delete(ids)
+        self.load_vector_store().delete_ids(ids)
 
     def do_init(self):
         self.vector_name = self.vector_name or self.embed_model.replace(":", "_")
@@ -85,32 +86,32 @@ class FaissKBService(KBService):
     ) -> List[Dict]:
         texts = [x.page_content for x in docs]
         metadatas = [x.metadata for x in docs]
-        with self.load_vector_store().acquire() as vs:
-            embeddings = vs.embeddings.embed_documents(texts)
-            ids = vs.add_embeddings(
-                text_embeddings=zip(texts, embeddings), metadatas=metadatas
-            )
-            if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+        vs_item = self.load_vector_store()
+        # 向量化在锁外进行，避免阻塞同一知识库的检索；调用方也可以传入预先计算好的向量
+        embeddings = kwargs.get("embeddings")
+        if embeddings is None:
+            embeddings = vs_item.obj.embeddings.embed_documents(texts)
+        ids = vs_item.add_embeddings(texts, embeddings, metadatas)
+        # wal 模式下修改已写入日志，由快照负责落盘
+        if not kwargs.get("not_refresh_vs_cache") and not vs_item.wal_path:
+            vs_item.save(self.vs_path)
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
         return doc_infos
 
     def do_delete_doc(self, kb_file: KnowledgeFile, **kwargs):
-        with self.load_vector_store().acquire() as vs:
-            ids = [
-                k
-                for k, v in vs.docstore._dict.items()
-                if v.metadata.get("source").lower() == kb_file.filename.lower()
-            ]
-            if len(ids) > 0:
-                vs.delete(ids)
-            if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+        vs_item = self.load_vector_store()
+        ids = vs_item.ids_by_source(kb_file.filename)
+        if len(ids) > 0:
+            vs_item.delete_ids(ids)
+        if not kwargs.get("not_refresh_vs_cache") and not vs_item.wal_path:
+            vs_item.save(self.vs_path)
         return ids
 
     def do_clear_vs(self):
         with kb_faiss_pool.atomic:
-            kb_faiss_pool.pop((self.kb_name, self.vector_name))
+            vs_item = kb_faiss_pool.pop((self.kb_name, self.vector_name))
+        if vs_item is not None:
+            vs_item.close()
         try:
             shutil.rmtree(self.vs_path)
         except Exception:
@@ -111,7 +111,10 @@ class SummaryAdapter:
         )
 
     async def asummarize(
-        self, file_description: str, docs: List[DocumentWithVSId] = []
+        self,
+        file_description: str,
+        docs: List[DocumentWithVSId] = [],
+        semaphore: Optional[asyncio.Semaphore] = None,
     ) -> List[Document]:
         logger.info("start summary")
         """
@@ -127,13 +130,12 @@ class SummaryAdapter:
             result_docs, token_max=token_max, callbacks=callbacks, **kwargs
         )
         """
-        summary_combine, summary_intermediate_steps = self.chain.combine_docs(
+        summary_combine, summary_intermediate_steps = await self._amap_reduce(
             docs=docs,
+            semaphore=semaphore,
             task_briefing="描述不同方法之间的接近度和相似性，"
             "以帮助读者理解它们之间的关系。",
         )
-        print(summary_combine)
-        print(summary_intermediate_steps)
 
         # if len(summary_combine) == 0:
         #     # 为空重新生成，数量减半
@@ -159,6 +161,42 @@ class SummaryAdapter:
 
         return [summary_combine_doc]
 
+    async def _amap_reduce(
+        self,
+        docs: List[DocumentWithVSId],
+        semaphore: Optional[asyncio.Semaphore] = None,
+        **kwargs,
+    ):
+        """
+        与 MapReduceDocumentsChain.combine_docs 的结果相同，但 map 阶段每个文档单独调用 llm，
+        所有调用共享 semaphore，多个文件同时摘要时 llm 的并发数不会超过 semaphore 的上限
+        :param docs:
+        :param semaphore: 限制 llm 并发数，None 表示不限制
+        :return: (summary_combine, {"intermediate_steps": [...]})
+        """
+        semaphore = semaphore or asyncio.Semaphore(max(len(docs), 1))
+        llm_chain = self.chain.llm_chain
+        document_variable_name = self.chain.document_variable_name
+
+        async def map_doc(doc: DocumentWithVSId) -> str:
+            async with semaphore:
+                return await llm_chain.apredict(
+                    **{document_variable_name: doc.page_content, **kwargs}
+                )
+
+        intermediate_steps = await asyncio.gather(*[map_doc(doc) for doc in docs])
+        result_docs = [
+            Document(page_content=text, metadata=doc.metadata)
+            for text, doc in zip(intermediate_steps, docs)
+        ]
+        # reduce 阶段逐层合并，同一文件内是串行调用，占用一个并发名额
+        async with semaphore:
+            summary_combine, extra_return_dict = await self.chain.reduce_documents_chain.acombine_docs(
+                result_docs, token_max=self.token_max, **kwargs
+            )
+        extra_return_dict["intermediate_steps"] = list(intermediate_steps)
+        return summary_combine, extra_return_dict
+
     def _drop_overlap(self, docs: List[DocumentWithVSId]) -> List[str]:
         """
          # 将文档中page_content句子叠加的部分去掉
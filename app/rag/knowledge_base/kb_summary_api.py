@@ -1,6 +1,7 @@
 import asyncio
 import json
-from typing import List, Optional
+import os
+from typing import AsyncIterator, List, Optional, Set, Tuple
 
 from fastapi import Body
 from sse_starlette import EventSourceResponse
@@ -17,6 +18,84 @@ from chatchat.utils import build_logger
 
 logger = build_logger()
 
+# 摘要写入向量库时每批最多包含的文件数
+SUMMARY_WRITE_BATCH_SIZE = 16
+# 重建摘要的断点文件，记录已写入向量库的文件
+SUMMARY_CHECKPOINT_FILE = "summary_checkpoint.json"
+
+
+def _load_checkpoint(path: str) -> Set[str]:
+    if not os.path.isfile(path):
+        return set()
+    try:
+        with open(path, encoding="utf-8") as f:
+            return set(json.load(f).get("done", []))
+    except Exception as e:
+        logger.warning(f"断点文件 {path} 读取失败，将重新生成全部摘要: {e}")
+        return set()
+
+
+def _save_checkpoint(path: str, done: Set[str]):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"done": sorted(done)}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+async def _summarize_files(
+    kb,
+    kb_summary: KBSummaryService,
+    summary: SummaryAdapter,
+    files: List[str],
+    file_description: str,
+    max_concurrency: int,
+) -> AsyncIterator[List[Tuple[str, bool]]]:
+    """
+    并发生成文件摘要并分批写入摘要向量库
+    最多 max_concurrency 个文件同时摘要，所有文件的 llm 调用共享同一个并发上限。
+    已完成的摘要在没有其他结果就绪或攒满 SUMMARY_WRITE_BATCH_SIZE 个文件时一起写入，
+    每写入一批产出一次 [(file_name, 是否成功), ...]
+    """
+    max_concurrency = max(1, max_concurrency)
+    llm_semaphore = asyncio.Semaphore(max_concurrency)
+    # 限制同时加载到内存的文件数
+    file_semaphore = asyncio.Semaphore(max_concurrency)
+    results = asyncio.Queue()
+
+    async def summarize_file(file_name: str):
+        async with file_semaphore:
+            try:
+                doc_infos = await asyncio.to_thread(kb.list_docs, file_name=file_name)
+                docs = await summary.asummarize(
+                    file_description=file_description, docs=doc_infos, semaphore=llm_semaphore
+                )
+                await results.put((file_name, docs))
+            except Exception as e:
+                logger.error(f"知识库'{kb_summary.kb_name}'总结文件‘{file_name}’时出错: {e}")
+                await results.put((file_name, None))
+
+    tasks = [asyncio.create_task(summarize_file(file_name)) for file_name in files]
+    try:
+        batch_files, batch_docs = [], []
+        for i in range(len(files)):
+            file_name, docs = await results.get()
+            if docs is None:
+                yield [(file_name, False)]
+            else:
+                batch_files.append(file_name)
+                batch_docs.extend(docs)
+            last = i == len(files) - 1
+            if batch_files and (last or results.empty() or len(batch_files) >= SUMMARY_WRITE_BATCH_SIZE):
+                status = await asyncio.to_thread(
+                    kb_summary.add_kb_summary, summary_combine_docs=batch_docs
+                )
+                yield [(name, bool(status)) for name in batch_files]
+                batch_files, batch_docs = [], []
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 def recreate_summary_vector_store(
     knowledge_base_name: str = Body(..., examples=["samples"]),
     allow_empty_kb: bool = Body(True),
@@ -28,9 +107,13 @@ def recreate_summary_vector_store(
     max_tokens: Optional[int] = Body(
         None, description="限制LLM生成Token数量，默认None代表模型最大值"
     ),
+    max_concurrency: int = Body(4, description="同时进行的 LLM 调用数量上限", ge=1),
+    resume: bool = Body(False, description="从上次中断处继续，跳过已写入摘要的文件"),
 ):
     """
     重建单个知识库文件摘要
+    :param resume:
+    :param max_concurrency:
     :param max_tokens:
     :param model_name:
     :param temperature:
@@ -44,7 +127,7 @@ def recreate_summary_vector_store(
     if max_tokens in [None, 0]:
         max_tokens = Settings.model_settings.MAX_TOKENS
 
-    def output():
+    async def output():
         try:
             kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
             if not kb.exists() and not allow_empty_kb:
@@ -54,10 +137,13 @@ def recreate_summary_vector_store(
                 if not ok:
                     yield {"code": 404, "msg": msg}
                 else:
-                    # 重新创建知识库
                     kb_summary = KBSummaryService(knowledge_base_name, embed_model)
-                    kb_summary.drop_kb_summary()
-                    kb_summary.create_kb_summary()
+                    checkpoint_path = os.path.join(kb_summary.kb_path, SUMMARY_CHECKPOINT_FILE)
+                    done = _load_checkpoint(checkpoint_path) if resume else set()
+                    if not done:
+                        # 重新创建知识库
+                        kb_summary.drop_kb_summary()
+                        kb_summary.create_kb_summary()
 
                     llm = get_ChatOpenAI(
                         model_name=model_name,
@@ -76,39 +162,45 @@ def recreate_summary_vector_store(
                         llm=llm, reduce_llm=reduce_llm, overlap_size=Settings.kb_settings.OVERLAP_SIZE
                     )
                     files = list_files_from_folder(knowledge_base_name)
+                    todo = [file_name for file_name in files if file_name not in done]
+                    finished = len(files) - len(todo)
+                    if finished:
+                        logger.info(f"跳过已完成摘要的 {finished} 个文件")
 
-                    i = 0
-                    for i, file_name in enumerate(files):
-                        doc_infos = kb.list_docs(file_name=file_name)
-                        docs = summary.summarize(
-                            file_description=file_description, docs=doc_infos
-                        )
+                    failed = False
+                    async for batch in _summarize_files(
+                        kb, kb_summary, summary, todo, file_description, max_concurrency
+                    ):
+                        for file_name, status_kb_summary in batch:
+                            if status_kb_summary:
+                                done.add(file_name)
+                                finished += 1
+                                logger.info(f"({finished} / {len(files)}): {file_name} 总结完成")
+                                yield json.dumps(
+                                    {
+                                        "code": 200,
+                                        "msg": f"({finished} / {len(files)}): {file_name}",
+                                        "total": len(files),
+                                        "finished": finished,
+                                        "doc": file_name,
+                                    },
+                                    ensure_ascii=False,
+                                )
+                            else:
+                                failed = True
+                                msg = f"知识库'{knowledge_base_name}'总结文件‘{file_name}’时出错。已跳过。"
+                                logger.error(msg)
+                                yield json.dumps(
+                                    {
+                                        "code": 500,
+                                        "msg": msg,
+                                    }
+                                )
+                        _save_checkpoint(checkpoint_path, done)
 
-                        status_kb_summary = kb_summary.add_kb_summary(
-                            summary_combine_docs=docs
-                        )
-                        if status_kb_summary:
-                            logger.info(f"({i + 1} / {len(files)}): {file_name} 总结完成")
-                            yield json.dumps(
-                                {
-                                    "code": 200,
-                                    "msg": f"({i + 1} / {len(files)}): {file_name}",
-                                    "total": len(files),
-                                    "finished": i + 1,
-                                    "doc": file_name,
-                                },
-                                ensure_ascii=False,
-                            )
-                        else:
-                            msg = f"知识库'{knowledge_base_name}'总结文件‘{file_name}’时出错。已跳过。"
-                            logger.error(msg)
-                            yield json.dumps(
-                                {
-                                    "code": 500,
-                                    "msg": msg,
-                                }
-                            )
-                        i += 1
+                    # 全部完成后删除断点，有失败的文件时保留，resume 时只重试失败的文件
+                    if not failed and os.path.exists(checkpoint_path):
+                        os.remove(checkpoint_path)
         except asyncio.exceptions.CancelledError:
             logger.warning("streaming progress has been interrupted by user.")
             return
@@ -128,9 +220,11 @@ def summary_file_to_vector_store(
     max_tokens: Optional[int] = Body(
         None, description="限制LLM生成Token数量，默认None代表模型最大值"
     ),
+    max_concurrency: int = Body(4, description="同时进行的 LLM 调用数量上限", ge=1),
 ):
     """
     单个知识库根据文件名称摘要
+    :param max_concurrency:
     :param model_name:
     :param max_tokens:
     :param temperature:
@@ -143,7 +237,7 @@ def summary_file_to_vector_store(
     :return:
     """
 
-    def output():
+    async def output():
         try:
             kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
             if not kb.exists() and not allow_empty_kb:
@@ -170,29 +264,30 @@ def summary_file_to_vector_store(
                     llm=llm, reduce_llm=reduce_llm, overlap_size=Settings.kb_settings.OVERLAP_SIZE
                 )
 
-                doc_infos = kb.list_docs(file_name=file_name)
-                docs = summary.summarize(file_description=file_description, docs=doc_infos)
-
-                status_kb_summary = kb_summary.add_kb_summary(summary_combine_docs=docs)
-                if status_kb_summary:
-                    logger.info(f" {file_name} 总结完成")
-                    yield json.dumps(
-                        {
-                            "code": 200,
-                            "msg": f"{file_name} 总结完成",
-                            "doc": file_name,
-                        },
-                        ensure_ascii=False,
-                    )
-                else:
-                    msg = f"知识库'{knowledge_base_name}'总结文件‘{file_name}’时出错。已跳过。"
-                    logger.error(msg)
-                    yield json.dumps(
-                        {
-                            "code": 500,
-                            "msg": msg,
-                        }
-                    )
+                # 长文件的各个 chunk 并发摘要后再合并
+                async for batch in _summarize_files(
+                    kb, kb_summary, summary, [file_name], file_description, max_concurrency
+                ):
+                    for _, status_kb_summary in batch:
+                        if status_kb_summary:
+                            logger.info(f" {file_name} 总结完成")
+                            yield json.dumps(
+                                {
+                                    "code": 200,
+                                    "msg": f"{file_name} 总结完成",
+                                    "doc": file_name,
+                                },
+                                ensure_ascii=False,
+                            )
+                        else:
+                            msg = f"知识库'{knowledge_base_name}'总结文件‘{file_name}’时出错。已跳过。"
+                            logger.error(msg)
+                            yield json.dumps(
+                                {
+                                    "code": 500,
+                                    "msg": msg,
+                                }
+                            )
         except asyncio.exceptions.CancelledError:
             logger.warning("streaming progress has been interrupted by user.")
             return
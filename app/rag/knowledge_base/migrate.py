@@ -1,6 +1,10 @@
+import json
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import List, Literal
+from typing import Dict, List, Literal, Tuple
 
 from dateutil.parser import parse
 
@@ -23,17 +27,27 @@ from chatchat.server.knowledge_base.kb_service.base import (
 )
 from chatchat.server.knowledge_base.utils import (
     KnowledgeFile,
-    files2docs_in_thread,
+    files2docs_in_thread_file2docs,
     get_file_path,
+    get_kb_path,
     list_files_from_folder,
     list_kbs_from_folder,
 )
 from chatchat.utils import build_logger
-from chatchat.server.utils import get_default_embedding
+from chatchat.server.utils import get_Embeddings, get_default_embedding
 
 
 logger = build_logger()
 
+# 迁移账本，保存在知识库目录下，中断后重新运行时跳过已完成的文件
+MIGRATE_LEDGER_FILE = "migrate_ledger.json"
+# 每写入多少个文件保存一次向量库并更新账本
+MIGRATE_SAVE_EVERY = int(os.environ.get("MIGRATE_SAVE_EVERY", 100))
+# 同时解析、向量化的文件数
+MIGRATE_WORKERS = int(os.environ.get("MIGRATE_WORKERS", os.cpu_count() or 4))
+# 同时进行的向量化请求数
+MIGRATE_EMBED_CONCURRENCY = int(os.environ.get("MIGRATE_EMBED_CONCURRENCY", 2))
+
 
 def create_tables():
     Base.metadata.create_all(bind=engine)
@@ -100,6 +114,89 @@ def file_to_kbfile(kb_name: str, files: List[str]) -> List[KnowledgeFile]:
     return kb_files
 
 
+class MigrateLedger:
+    """
+    记录每个文件的迁移状态。文件在向量库保存之后才标记为 done，
+    中断时已写入但未保存的文件会在下次运行时重做；文件修改时间变化后也会重做。
+    """
+
+    def __init__(self, path: str, mode: str, vs_type: str, embed_model: str):
+        self.path = path
+        self.meta = {"mode": mode, "vs_type": vs_type, "embed_model": embed_model}
+        self.files: Dict[str, Dict] = {}
+        self.resumed = False
+        if os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+                if not data.get("finished") and all(
+                    data.get(k) == v for k, v in self.meta.items()
+                ):
+                    self.files = data.get("files", {})
+                    self.resumed = True
+            except Exception as e:
+                logger.warning(f"无法读取迁移账本 {path}，将重新开始：{e}")
+
+    @staticmethod
+    def _mtime(kb_file: KnowledgeFile):
+        try:
+            return os.path.getmtime(kb_file.filepath)
+        except OSError:
+            return None
+
+    def done_count(self) -> int:
+        return sum(1 for x in self.files.values() if x.get("status") == "done")
+
+    def is_done(self, kb_file: KnowledgeFile) -> bool:
+        entry = self.files.get(kb_file.filename)
+        return (
+            entry is not None
+            and entry.get("status") == "done"
+            and entry.get("mtime") == self._mtime(kb_file)
+        )
+
+    def mark(self, kb_file: KnowledgeFile, status: str, **info):
+        self.files[kb_file.filename] = {
+            "status": status,
+            "mtime": self._mtime(kb_file),
+            **info,
+        }
+
+    def save(self, finished: bool = False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {**self.meta, "finished": finished, "files": self.files},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, self.path)
+
+
+def _parse_and_embed(
+    kb_file: KnowledgeFile,
+    embeddings,
+    embed_semaphore: threading.Semaphore,
+    **kwargs,
+) -> Tuple:
+    """
+    在线程池中解析单个文件，embeddings 不为 None 时同时完成向量化，
+    返回 (是否成功, kb_file, docs | 错误信息, 向量, 解析用时, 向量化用时)
+    """
+    start = time.perf_counter()
+    success, (_, _, docs) = files2docs_in_thread_file2docs(file=kb_file, **kwargs)
+    parse_time = time.perf_counter() - start
+    vectors = None
+    embed_time = 0.0
+    if success and docs and embeddings is not None:
+        with embed_semaphore:
+            start = time.perf_counter()
+            vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+            embed_time = time.perf_counter() - start
+    return success, kb_file, docs, vectors, parse_time, embed_time
+
+
 def folder2db(
     kb_names: List[str],
     mode: Literal["recreate_vs", "update_in_db", "increment"],
@@ -118,26 +215,99 @@ def folder2db(
         increment: create vector store and database info for local files that not existed in database only
     """
 
-    def files2vs(kb_name: str, kb_files: List[KnowledgeFile]) -> List:
+    def files2vs(
+        kb_name: str, kb_files: List[KnowledgeFile], ledger: MigrateLedger
+    ) -> Tuple[List, Dict]:
+        """
+        解析、向量化在线程池中并行进行，当前线程负责写入向量库，三个阶段互相重叠；
+        每写入 MIGRATE_SAVE_EVERY 个文件保存一次向量库并更新账本
+        """
         result = []
-        for success, res in files2docs_in_thread(
-            kb_files,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            zh_title_enhance=zh_title_enhance,
-        ):
-            if success:
-                _, filename, docs = res
-                print(
-                    f"正在将 {kb_name}/{filename} 添加到向量库，共包含{len(docs)}条文档"
-                )
-                kb_file = KnowledgeFile(filename=filename, knowledge_base_name=kb_name)
-                kb_file.splited_docs = docs
-                kb.add_doc(kb_file=kb_file, not_refresh_vs_cache=True)
-                result.append({"kb_name": kb_name, "file": filename, "docs": docs})
+        stats = {"parse": 0.0, "embed": 0.0, "write": 0.0, "skipped": 0, "failed": 0}
+        pending = []
+        for kb_file in kb_files:
+            if ledger.is_done(kb_file):
+                stats["skipped"] += 1
             else:
-                print(res)
-        return result
+                pending.append(kb_file)
+        # faiss 支持传入预先计算的向量，向量化可以和写入重叠；其它向量库在写入时自行向量化
+        embeddings = (
+            get_Embeddings(kb.embed_model)
+            if kb.vs_type() == SupportedVSType.FAISS
+            else None
+        )
+        embed_semaphore = threading.Semaphore(MIGRATE_EMBED_CONCURRENCY)
+        unsaved = []
+
+        def save():
+            start = time.perf_counter()
+            kb.save_vector_store()
+            stats["write"] += time.perf_counter() - start
+            for kb_file, docs_count in unsaved:
+                ledger.mark(kb_file, "done", docs_count=docs_count)
+            unsaved.clear()
+            ledger.save()
+
+        files = iter(pending)
+        running = set()
+        with ThreadPoolExecutor(max_workers=MIGRATE_WORKERS) as pool:
+
+            def fill():
+                # 限制在途文件数，避免解析结果堆积在内存中
+                while len(running) < MIGRATE_WORKERS * 2:
+                    kb_file = next(files, None)
+                    if kb_file is None:
+                        return
+                    running.add(
+                        pool.submit(
+                            _parse_and_embed,
+                            kb_file,
+                            embeddings,
+                            embed_semaphore,
+                            chunk_size=chunk_size,
+                            chunk_overlap=chunk_overlap,
+                            zh_title_enhance=zh_title_enhance,
+                        )
+                    )
+
+            fill()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.remove(future)
+                    success, kb_file, docs, vectors, parse_time, embed_time = future.result()
+                    stats["parse"] += parse_time
+                    stats["embed"] += embed_time
+                    if not success:
+                        print(docs)
+                        ledger.mark(kb_file, "failed", error=docs)
+                        stats["failed"] += 1
+                        continue
+                    print(
+                        f"正在将 {kb_name}/{kb_file.filename} 添加到向量库，共包含{len(docs)}条文档"
+                    )
+                    start = time.perf_counter()
+                    kb_file.splited_docs = docs
+                    kwargs = {"not_refresh_vs_cache": True}
+                    if vectors is not None:
+                        kwargs["embeddings"] = vectors
+                    try:
+                        kb.add_doc(kb_file=kb_file, **kwargs)
+                    except Exception as e:
+                        msg = f"将 {kb_name}/{kb_file.filename} 添加到向量库时出错：{e}"
+                        logger.error(f"{e.__class__.__name__}: {msg}")
+                        ledger.mark(kb_file, "failed", error=msg)
+                        stats["failed"] += 1
+                        continue
+                    finally:
+                        stats["write"] += time.perf_counter() - start
+                    result.append({"kb_name": kb_name, "file": kb_file.filename, "docs": docs})
+                    unsaved.append((kb_file, len(docs)))
+                    if len(unsaved) >= MIGRATE_SAVE_EVERY:
+                        save()
+                fill()
+        save()
+        return result, stats
 
     kb_names = kb_names or list_kbs_from_folder()
     for kb_name in kb_names:
@@ -146,13 +316,22 @@ def folder2db(
         if not kb.exists():
             kb.create_kb()
 
+        ledger = MigrateLedger(
+            os.path.join(get_kb_path(kb_name), MIGRATE_LEDGER_FILE),
+            mode,
+            kb.vs_type(),
+            kb.embed_model,
+        )
+        if ledger.resumed:
+            print(f"继续 {kb_name} 上次未完成的迁移，已完成 {ledger.done_count()} 个文件")
+
         # 清除向量库，从本地文件重建
         if mode == "recreate_vs":
-            kb.clear_vs()
-            kb.create_kb()
+            if not ledger.resumed:
+                kb.clear_vs()
+                kb.create_kb()
             kb_files = file_to_kbfile(kb_name, list_files_from_folder(kb_name))
-            result = files2vs(kb_name, kb_files)
-            kb.save_vector_store()
+            result, stats = files2vs(kb_name, kb_files, ledger)
         # # 不做文件内容的向量化，仅将文件元信息存到数据库
         # # 由于现在数据库存了很多与文本切分相关的信息，单纯存储文件信息意义不大，该功能取消。
         # elif mode == "fill_info_only":
@@ -165,18 +344,18 @@ def folder2db(
         elif mode == "update_in_db":
             files = kb.list_files()
             kb_files = file_to_kbfile(kb_name, files)
-            result = files2vs(kb_name, kb_files)
-            kb.save_vector_store()
+            result, stats = files2vs(kb_name, kb_files, ledger)
         # 对比本地目录与数据库中的文件列表，进行增量向量化
         elif mode == "increment":
             db_files = kb.list_files()
             folder_files = list_files_from_folder(kb_name)
             files = list(set(folder_files) - set(db_files))
             kb_files = file_to_kbfile(kb_name, files)
-            result = files2vs(kb_name, kb_files)
-            kb.save_vector_store()
+            result, stats = files2vs(kb_name, kb_files, ledger)
         else:
             print(f"unsupported migrate mode: {mode}")
+            continue
+        ledger.save(finished=True)
         end = datetime.now()
         kb_path = (
             f"知识库路径\t：{kb.kb_path}\n"
@@ -186,6 +365,7 @@ def folder2db(
         file_count = len(kb_files)
         success_count = len(result)
         docs_count = sum([len(x["docs"]) for x in result])
+        seconds = max((end - start).total_seconds(), 1e-6)
         print("\n" + "-" * 100)
         print(
             (
@@ -198,7 +378,11 @@ def folder2db(
                 f"文件总数量\t：{file_count}\n"
                 f"入库文件数\t：{success_count}\n"
                 f"知识条目数\t：{docs_count}\n"
-                f"用时\t\t：{end-start}"
+                f"跳过文件数\t：{stats['skipped']}\n"
+                f"失败文件数\t：{stats['failed']}\n"
+                f"用时\t\t：{end-start}\n"
+                f"解析/向量化/写入\t：{stats['parse']:.1f}s / {stats['embed']:.1f}s / {stats['write']:.1f}s\n"
+                f"吞吐量\t\t：{success_count / seconds:.2f} 文件/秒，{docs_count / seconds:.1f} 条/秒"
             )
         )
         print("-" * 100 + "\n")
@@ -1,8 +1,11 @@
+import codecs
 import logging
+import os
 # import random
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 #
-from app.rag.utils import num_tokens_from_string
+from app.rag.utils import num_tokens_from_strings
 from . import rag_tokenizer
 import re
 import copy
@@ -34,25 +37,96 @@ all_codecs = [
 ]
 
 
-def find_codec(blob):
-    detected = chardet.detect(blob[:1024])
-    if detected['confidence'] > 0.5:
-        if detected['encoding'] == "ascii":
-            return "utf-8"
-
-    for c in all_codecs:
-        try:
-            blob[:1024].decode(c)
-            return c
-        except Exception:
-            pass
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf_32"),
+    (codecs.BOM_UTF32_BE, "utf_32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf_16"),
+    (codecs.BOM_UTF16_BE, "utf_16"),
+]
+CODEC_SAMPLE_WINDOW = 4096
+CODEC_SAMPLE_WINDOWS = 4
+CODEC_MAX_FULL_DECODES = 3
+CODEC_DECODE_CHUNK = 1024 * 1024
+
+# worker processes used to tokenize the chunks of large documents, 0 tokenizes in process
+TOKENIZE_WORKERS = int(os.environ.get("TOKENIZE_WORKERS", min(4, os.cpu_count() or 1)))
+# documents with fewer chunks are not worth the round trip to the pool
+TOKENIZE_POOL_MIN_CHUNKS = 64
+TOKENIZE_POOL_CHUNKSIZE = 16
+_tokenize_pool = None
+
+
+def _codec_samples(blob):
+    """Evenly spread windows over the blob, the first one at its head."""
+    if len(blob) <= CODEC_SAMPLE_WINDOW * CODEC_SAMPLE_WINDOWS:
+        return [blob]
+    step = (len(blob) - CODEC_SAMPLE_WINDOW) // (CODEC_SAMPLE_WINDOWS - 1)
+    return [blob[i * step: i * step + CODEC_SAMPLE_WINDOW] for i in range(CODEC_SAMPLE_WINDOWS)]
+
+
+def _sample_decodes(window, codec, head):
+    # windows may start or end in the middle of a multibyte character
+    for skip in ([0] if head else range(4)):
         try:
-            blob.decode(c)
-            return c
-        except Exception:
+            codecs.getincrementaldecoder(codec)().decode(window[skip:], final=False)
+            return True
+        except (UnicodeError, LookupError):
             pass
+    return False
 
-    return "utf-8"
+
+def _stream_decodes(blob, codec):
+    """Decode the whole blob chunk by chunk, stopping at the first error."""
+    try:
+        decoder = codecs.getincrementaldecoder(codec)()
+        for i in range(0, len(blob), CODEC_DECODE_CHUNK):
+            decoder.decode(blob[i: i + CODEC_DECODE_CHUNK], final=False)
+        decoder.decode(b"", final=True)
+        return True
+    except (UnicodeError, LookupError):
+        return False
+
+
+def find_codec(blob):
+    """
+    Detect the encoding of `blob` in time proportional to a sample, not to the blob times the codecs.
+
+    BOMs win outright. Otherwise candidates are ranked from a few windows spread over the blob
+    (UTF-8 first, then chardet's guess, then `all_codecs` in order if UTF-8 doesn't fit the
+    sample) and only the best `CODEC_MAX_FULL_DECODES` of them are validated on the whole blob,
+    each stopping at the first undecodable chunk.
+    """
+    if not blob:
+        return "utf-8"
+    for bom, codec in _BOMS:
+        if blob.startswith(bom):
+            return codec
+
+    samples = _codec_samples(blob)
+
+    def sample_decodes(codec):
+        return all(_sample_decodes(w, codec, i == 0) for i, w in enumerate(samples))
+
+    utf8 = sample_decodes("utf-8")
+    candidates = ["utf-8"] if utf8 else []
+    detected = chardet.detect(samples[0][:1024])
+    if detected["encoding"] and detected["confidence"] > 0.5:
+        codec = "utf-8" if detected["encoding"] == "ascii" else detected["encoding"].lower()
+        if codec not in candidates and sample_decodes(codec):
+            candidates.append(codec)
+    if not utf8:
+        # single byte codecs decode anything, so they only get a chance when UTF-8 is out
+        for c in all_codecs:
+            if len(candidates) >= CODEC_MAX_FULL_DECODES:
+                break
+            if c not in candidates and sample_decodes(c):
+                candidates.append(c)
+
+    for c in candidates[:CODEC_MAX_FULL_DECODES]:
+        if _stream_decodes(blob, c):
+            return c
+    return candidates[0] if candidates else "utf-8"
 
 
 #
@@ -234,15 +308,53 @@ def is_chinese(text):
     return False
 
 
+TABLE_TAG_PATTERN = re.compile(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>")
+
+
+def _tokenize_text(t):
+    ltks = rag_tokenizer.tokenize(TABLE_TAG_PATTERN.sub(" ", t))
+    return ltks, rag_tokenizer.fine_grained_tokenize(ltks)
+
+
 def tokenize(d, t, eng):
     d["content_with_weight"] = t
-    t = re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t)
-    d["content_ltks"] = rag_tokenizer.tokenize(t)
-    d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+    d["content_ltks"], d["content_sm_ltks"] = _tokenize_text(t)
+
+
+def _init_tokenize_worker():
+    # touch the module level tokenizer so its dictionary is loaded before the first chunk arrives
+    rag_tokenizer.tokenizer
+
+
+def _get_tokenize_pool():
+    global _tokenize_pool
+    if _tokenize_pool is None:
+        _tokenize_pool = ProcessPoolExecutor(max_workers=TOKENIZE_WORKERS, initializer=_init_tokenize_worker)
+    return _tokenize_pool
+
+
+def tokenize_batch(texts):
+    """Returns (content_ltks, content_sm_ltks) of every text, using the tokenizer pool for large batches."""
+    global _tokenize_pool
+    if TOKENIZE_WORKERS > 1 and len(texts) >= TOKENIZE_POOL_MIN_CHUNKS:
+        try:
+            return list(_get_tokenize_pool().map(_tokenize_text, texts, chunksize=TOKENIZE_POOL_CHUNKSIZE))
+        except Exception:
+            logging.exception("Tokenizer pool failed, tokenizing in process")
+            _tokenize_pool = None
+    return [_tokenize_text(t) for t in texts]
+
+
+def _tokenize_docs(docs, texts):
+    for d, t, (ltks, sm_ltks) in zip(docs, texts, tokenize_batch(texts)):
+        d["content_with_weight"] = t
+        d["content_ltks"] = ltks
+        d["content_sm_ltks"] = sm_ltks
 
 
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
     res = []
+    texts = []
     # wrap up as es documents
     for ii, ck in enumerate(chunks):
         if len(ck.strip()) == 0:
@@ -258,13 +370,15 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 pass
         else:
             add_positions(d, [[ii]*5])
-        tokenize(d, ck, eng)
+        texts.append(ck)
         res.append(d)
+    _tokenize_docs(res, texts)
     return res
 
 
 def tokenize_chunks_docx(chunks, doc, eng, images):
     res = []
+    texts = []
     # wrap up as es documents
     for ck, image in zip(chunks, images):
         if len(ck.strip()) == 0:
@@ -272,35 +386,36 @@ def tokenize_chunks_docx(chunks, doc, eng, images):
         logging.debug("-- {}".format(ck))
         d = copy.deepcopy(doc)
         d["image"] = image
-        tokenize(d, ck, eng)
+        texts.append(ck)
         res.append(d)
+    _tokenize_docs(res, texts)
     return res
 
 
 def tokenize_table(tbls, doc, eng, batch_size=10):
     res = []
-    # add tables
+    texts = []
+    # add tables, the rows of every table are tokenized together at the end
     for (img, rows), poss in tbls:
         if not rows:
             continue
         if isinstance(rows, str):
             d = copy.deepcopy(doc)
-            tokenize(d, rows, eng)
-            d["content_with_weight"] = rows
             if img:
                 d["image"] = img
             if poss:
                 add_positions(d, poss)
+            texts.append(rows)
             res.append(d)
             continue
         de = "; " if eng else "； "
         for i in range(0, len(rows), batch_size):
             d = copy.deepcopy(doc)
-            r = de.join(rows[i:i + batch_size])
-            tokenize(d, r, eng)
             d["image"] = img
             add_positions(d, poss)
+            texts.append(de.join(rows[i:i + batch_size]))
             res.append(d)
+    _tokenize_docs(res, texts)
     return res
 
 
@@ -493,37 +608,50 @@ def not_title(txt):
 #     return res
 #
 #
-def naive_merge(sections, chunk_token_num=128, delimiter="\n。；！？"):
-    if not sections:
-        return []
-    if isinstance(sections[0], type("")):
-        sections = [(s, "") for s in sections]
-    cks = [""]
-    tk_nums = [0]
-
-    def add_chunk(t, pos):
-        nonlocal cks, tk_nums, delimiter
-        tnum = num_tokens_from_string(t)
-        if not pos:
-            pos = ""
-        if tnum < 8:
+def _merge_sections(texts, poss, chunk_token_num):
+    """
+    Greedily packs sections into chunks of more than chunk_token_num tokens.
+
+    Returns the chunk texts and, for every chunk, the indices of the sections it holds. Token
+    counts are taken in one batch and chunks are assembled as lists of parts joined once, the text
+    of the current chunk is only materialized when a position tag has to be looked up in it.
+    """
+    tnums = num_tokens_from_strings(texts)
+    parts = [[]]
+    groups = [[]]
+    tk_num = 0
+    text = ""  # cache of "".join(parts[-1]), None once a part is appended after the join
+    for i, (t, pos, tnum) in enumerate(zip(texts, poss, tnums)):
+        if not pos or tnum < 8:
             pos = ""
         # Ensure that the length of the merged chunk does not exceed chunk_token_num
-        if tk_nums[-1] > chunk_token_num:
-
+        if tk_num > chunk_token_num:
             if t.find(pos) < 0:
                 t += pos
-            cks.append(t)
-            tk_nums.append(tnum)
+            parts.append([t])
+            groups.append([i])
+            tk_num = tnum
+            text = t
         else:
-            if cks[-1].find(pos) < 0:
-                t += pos
-            cks[-1] += t
-            tk_nums[-1] += tnum
+            if pos:
+                if text is None:
+                    text = "".join(parts[-1])
+                    parts[-1] = [text]
+                if text.find(pos) < 0:
+                    t += pos
+            parts[-1].append(t)
+            groups[-1].append(i)
+            tk_num += tnum
+            text = None
+    return ["".join(p) for p in parts], groups
 
-    for sec, pos in sections:
-        add_chunk(sec, pos)
 
+def naive_merge(sections, chunk_token_num=128, delimiter="\n。；！？"):
+    if not sections:
+        return []
+    if isinstance(sections[0], type("")):
+        sections = [(s, "") for s in sections]
+    cks, _ = _merge_sections([t for t, _ in sections], [pos for _, pos in sections], chunk_token_num)
     return cks
 #
 #
@@ -564,30 +692,13 @@ def naive_merge_docx(sections, chunk_token_num=128, delimiter="\n。；！？"):
     if not sections:
         return [], []
 
-    cks = [""]
-    images = [None]
-    tk_nums = [0]
-
-    def add_chunk(t, image, pos=""):
-        nonlocal cks, tk_nums, delimiter
-        tnum = num_tokens_from_string(t)
-        if tnum < 8:
-            pos = ""
-        if tk_nums[-1] > chunk_token_num:
-            if t.find(pos) < 0:
-                t += pos
-            cks.append(t)
-            images.append(image)
-            tk_nums.append(tnum)
-        else:
-            if cks[-1].find(pos) < 0:
-                t += pos
-            cks[-1] += t
-            images[-1] = concat_img(images[-1], image)
-            tk_nums[-1] += tnum
-
-    for sec, image in sections:
-        add_chunk(sec, image, '')
+    cks, groups = _merge_sections([sec for sec, _ in sections], [""] * len(sections), chunk_token_num)
+    images = []
+    for group in groups:
+        image = None
+        for i in group:
+            image = concat_img(image, sections[i][1])
+        images.append(image)
 
     return cks, images
 
@@ -0,0 +1,289 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+from bisect import bisect_left
+
+MAGIC = b"RAGDICT2"
+# magic, entries, tags, hash slots, prefix slots and the offsets of the nine sections
+_HEADER = struct.Struct("<8s4Q9Q")
+_EMPTY = 0xFFFFFFFF
+KIND_INT, KIND_STR, KIND_PAIR = 0, 1, 2
+# lookups remembered per process, the tokenizer asks for the same keys and prefixes over and over
+LOOKUP_CACHE_SIZE = 1 << 16
+
+
+def _pad(buf: bytearray):
+    buf.extend(b"\0" * (-len(buf) % 8))
+
+
+def _indexable_prefix(p: bytes) -> bool:
+    """Whether prefix p goes into the prefix table. Prefixes ending inside a backslash escape (the
+    tokenizer's keys are escaped utf-8) are left out, that keeps the table to about one entry per
+    byte of the original words; queries for them bisect instead."""
+    return b"\\" not in p[-3:]
+
+
+def compile_dict(items: dict, path: str, prefix_index: bool = False):
+    """Write items (str -> int | str | (int, str)) to path in the compiled format.
+
+    Keys are stored sorted so prefix queries can bisect, next to an open addressing table
+    (crc32 of the utf-8 key) for exact lookups. With ``prefix_index`` every distinct key prefix
+    (see _indexable_prefix) also goes into an open addressing table that points at a key starting
+    with it, so has_keys_with_prefix costs one hash lookup. The file is written to a temporary
+    name and renamed, so concurrent readers only ever see a complete dictionary.
+    """
+    keys = sorted(items)
+    tags, tag_ids = [], {}
+    nums, tag_idx, kinds = [], [], []
+    for k in keys:
+        v = items[k]
+        if isinstance(v, tuple):
+            num, tag, kind = v[0], v[1], KIND_PAIR
+        elif isinstance(v, str):
+            num, tag, kind = 0, v, KIND_STR
+        elif isinstance(v, int):
+            num, tag, kind = v, None, KIND_INT
+        else:
+            raise TypeError(f"Unsupported dictionary value for {k!r}: {v!r}")
+        if tag is None:
+            tag_idx.append(_EMPTY)
+        else:
+            if tag not in tag_ids:
+                tag_ids[tag] = len(tags)
+                tags.append(tag)
+            tag_idx.append(tag_ids[tag])
+        nums.append(int(num))
+        kinds.append(kind)
+
+    encoded = [k.encode("utf-8") for k in keys]
+    key_offsets = [0]
+    for k in encoded:
+        key_offsets.append(key_offsets[-1] + len(k))
+    table_size = 1
+    while table_size < max(2 * len(keys), 8):
+        table_size *= 2
+    slots = [_EMPTY] * table_size
+    mask = table_size - 1
+    for i, k in enumerate(encoded):
+        h = zlib.crc32(k) & mask
+        while slots[h] != _EMPTY:
+            h = (h + 1) & mask
+        slots[h] = i
+    prefix_slots = []
+    if prefix_index:
+        # keys are sorted, so a prefix is new only past the common prefix with the previous key
+        prefixes = []
+        prev = b""
+        for i, k in enumerate(encoded):
+            common = 0
+            for a, b in zip(prev, k):
+                if a != b:
+                    break
+                common += 1
+            prefixes.extend((k[:j], i) for j in range(common + 1, len(k) + 1) if _indexable_prefix(k[:j]))
+            prev = k
+        prefix_size = 1
+        while prefix_size < max(2 * len(prefixes), 8):
+            prefix_size *= 2
+        prefix_slots = [_EMPTY] * prefix_size
+        mask = prefix_size - 1
+        for p, i in prefixes:
+            h = zlib.crc32(p) & mask
+            while prefix_slots[h] != _EMPTY:
+                h = (h + 1) & mask
+            prefix_slots[h] = i
+    encoded_tags = [t.encode("utf-8") for t in tags]
+    tag_offsets = [0]
+    for t in encoded_tags:
+        tag_offsets.append(tag_offsets[-1] + len(t))
+
+    buf = bytearray(_HEADER.size)
+    sections = []
+    for data in (
+        struct.pack(f"<{len(key_offsets)}Q", *key_offsets),
+        b"".join(encoded),
+        struct.pack(f"<{len(nums)}q", *nums),
+        struct.pack(f"<{len(tag_idx)}I", *tag_idx),
+        bytes(kinds),
+        struct.pack(f"<{len(slots)}I", *slots),
+        struct.pack(f"<{len(tag_offsets)}Q", *tag_offsets),
+        b"".join(encoded_tags),
+        struct.pack(f"<{len(prefix_slots)}I", *prefix_slots),
+    ):
+        _pad(buf)
+        sections.append(len(buf))
+        buf.extend(data)
+    _HEADER.pack_into(buf, 0, MAGIC, len(keys), len(tags), table_size, len(prefix_slots), *sections)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buf)
+    os.replace(tmp_path, path)
+
+
+class MmapDict:
+    """Read-only dictionary over a file written by compile_dict.
+
+    The file is memory mapped, so processes forked from (or started next to) each other share
+    its pages instead of each holding a private copy of the dictionary on the heap. Supports the
+    parts of the dict / datrie interface the tokenizer and term weighting use.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, n_tags, table_size, prefix_size, *sections = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a compiled dictionary")
+        if sys.byteorder != "little":
+            raise ValueError("Compiled dictionaries are little endian")
+        view = memoryview(self._mm)
+        o_koffs, o_keys, o_nums, o_tags, o_kinds, o_slots, o_toffs, o_tblob, o_pslots = sections
+        self._n = n
+        self._key_offsets = view[o_koffs:o_koffs + 8 * (n + 1)].cast("Q")
+        self._keys = view[o_keys:o_keys + self._key_offsets[n]]
+        self._nums = view[o_nums:o_nums + 8 * n].cast("q")
+        self._tag_idx = view[o_tags:o_tags + 4 * n].cast("I")
+        self._kinds = view[o_kinds:o_kinds + n]
+        self._slots = view[o_slots:o_slots + 4 * table_size].cast("I")
+        self._mask = table_size - 1
+        tag_offsets = view[o_toffs:o_toffs + 8 * (n_tags + 1)].cast("Q")
+        self._tags = [
+            bytes(view[o_tblob + tag_offsets[i]:o_tblob + tag_offsets[i + 1]]).decode("utf-8")
+            for i in range(n_tags)
+        ]
+        self._prefix_slots = view[o_pslots:o_pslots + 4 * prefix_size].cast("I") if prefix_size else None
+        self._prefix_mask = prefix_size - 1
+        # plain dicts emptied when full, cheaper on a hit than functools.lru_cache
+        self._index_cache = {}
+        self._prefix_cache = {}
+
+    def _key(self, i: int) -> bytes:
+        return bytes(self._keys[self._key_offsets[i]:self._key_offsets[i + 1]])
+
+    def _index(self, key: str) -> int:
+        i = self._index_cache.get(key)
+        if i is None:
+            if len(self._index_cache) >= LOOKUP_CACHE_SIZE:
+                self._index_cache.clear()
+            i = self._index_cache[key] = self._find(key)
+        return i
+
+    def _find(self, key: str) -> int:
+        k = key.encode("utf-8")
+        h = zlib.crc32(k) & self._mask
+        while True:
+            i = self._slots[h]
+            if i == _EMPTY:
+                return -1
+            if self._keys[self._key_offsets[i]:self._key_offsets[i + 1]] == k:
+                return i
+            h = (h + 1) & self._mask
+
+    def _value(self, i: int):
+        kind = self._kinds[i]
+        if kind == KIND_INT:
+            return self._nums[i]
+        if kind == KIND_STR:
+            return self._tags[self._tag_idx[i]]
+        return self._nums[i], self._tags[self._tag_idx[i]]
+
+    def has_keys_with_prefix(self, prefix: str) -> bool:
+        found = self._prefix_cache.get(prefix)
+        if found is None:
+            if len(self._prefix_cache) >= LOOKUP_CACHE_SIZE:
+                self._prefix_cache.clear()
+            found = self._prefix_cache[prefix] = self._find_prefix(prefix)
+        return found
+
+    def _find_prefix(self, prefix: str) -> bool:
+        p = prefix.encode("utf-8")
+        if self._prefix_slots is None or not p or not _indexable_prefix(p):
+            i = bisect_left(_SortedKeys(self), p)
+            return i < self._n and self._key(i).startswith(p)
+        n = len(p)
+        slots, offsets, keys, mask = self._prefix_slots, self._key_offsets, self._keys, self._prefix_mask
+        h = zlib.crc32(p) & mask
+        while True:
+            i = slots[h]
+            if i == _EMPTY:
+                return False
+            o = offsets[i]
+            if offsets[i + 1] - o >= n and keys[o:o + n] == p:
+                return True
+            h = (h + 1) & mask
+
+    def __contains__(self, key) -> bool:
+        return self._index(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._value(i)
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        return default if i < 0 else self._value(i)
+
+    def __len__(self) -> int:
+        return self._n
+
+    def keys(self):
+        return (self._key(i).decode("utf-8") for i in range(self._n))
+
+    def items(self):
+        return ((self._key(i).decode("utf-8"), self._value(i)) for i in range(self._n))
+
+
+class _SortedKeys:
+    """Sequence view of the sorted keys, lets bisect run its loop in C."""
+
+    __slots__ = ("_d",)
+
+    def __init__(self, d: MmapDict):
+        self._d = d
+
+    def __len__(self):
+        return self._d._n
+
+    def __getitem__(self, i):
+        return self._d._key(i)
+
+
+def _compiled_magic(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC))
+
+
+def load_compiled(path: str, sources: list, build, prefix_index: bool = False):
+    """Open the compiled dictionary at path, compiling it first with build() when it is missing,
+    in an older format or older than any of the existing source files. Returns None if it can't
+    be built."""
+    sources = [s for s in sources if os.path.exists(s)]
+    try:
+        if (
+            not os.path.exists(path)
+            or _compiled_magic(path) != MAGIC
+            or any(os.path.getmtime(s) > os.path.getmtime(path) for s in sources)
+        ):
+            if not sources:
+                return None
+            logging.info(f"Compiling dictionary {path}")
+            compile_dict(build(), path, prefix_index)
+        return MmapDict(path)
+    except Exception:
+        logging.exception(f"Fail to load compiled dictionary {path}")
+        return None
+
+
+if __name__ == "__main__":
+    # build the compiled dictionaries offline, e.g. while building the image:
+    #   python -m app.rag.nlp.mmap_dict
+    from app.rag.nlp import rag_tokenizer, term_weight
+
+    rag_tokenizer.RagTokenizer()
+    term_weight.Dealer()
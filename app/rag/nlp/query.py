@@ -3,16 +3,75 @@ import logging
 import json
 import math
 import re
-from collections import defaultdict
+import threading
+import time
+from collections import OrderedDict, defaultdict
 
 from app.rag.utils.doc_store_conn import MatchTextExpr
-from app.rag.nlp import rag_tokenizer, term_weight, synonym
+from app.rag.nlp import rag_tokenizer
+from app.rag.utils.resources import RESOURCES
+
+# analyzed questions kept per queryer, keyed by the normalized text
+QUERY_CACHE_SIZE = 1024
+# synonyms are reloaded periodically, cached analyses and lookups expire after this many seconds
+QUERY_CACHE_TTL = 3600
+
+QUESTION_PUNCT_PATTERN = re.compile(r"[ :|\r\n\t,，。？?/`!！&^%%()\[\]{}<>]+")
+SPECIAL_CHAR_PATTERN = re.compile(r"([:\{\}/\[\]\-\*\"\(\)\|\+~\^])")
+BLANK_SPLIT_PATTERN = re.compile(r"[ \t]+")
+LATIN_WORD_PATTERN = re.compile(r"[a-zA-Z]+$")
+WWW_PATTERNS = [
+    (
+        re.compile(
+            r"是*(什么样的|哪家|一下|那家|请问|啥样|咋样了|什么时候|何时|何地|何人|是否|是不是|多少|哪里|怎么|哪儿|怎么样|如何|哪些|是啥|啥是|啊|吗|呢|吧|咋|什么|有没有|呀|谁|哪位|哪个)是*",
+            re.IGNORECASE,
+        ),
+        "",
+    ),
+    (re.compile(r"(^| )(what|who|how|which|where|why)('re|'s)? ", re.IGNORECASE), " "),
+    (
+        re.compile(
+            r"(^| )('s|'re|is|are|were|was|do|does|did|don't|doesn't|didn't|has|have|be|there|you|me|your|my|mine|just|please|may|i|should|would|wouldn't|will|won't|done|go|for|with|so|the|a|an|by|i'm|it's|he's|she's|they|they're|you're|as|by|on|in|at|up|out|down|of|to|or|and|if) ",
+            re.IGNORECASE,
+        ),
+        " ",
+    ),
+]
+TOKEN_QUOTE_PATTERN = re.compile(r"[ \\\"'^]")
+SINGLE_ALNUM_PATTERN = re.compile(r"^[a-z0-9]$")
+LEADING_SIGN_PATTERN = re.compile(r"^[\+-]")
+QUERY_OPERATOR_PATTERN = re.compile(r"[.^+\(\)-]")
+NO_FINE_GRAINED_PATTERN = re.compile(r"[0-9a-z\.\+#_\*-]+$")
+FINE_GRAINED_PUNCT_PATTERN = re.compile(
+    r"[ ,\./;'\[\]\\`~!@#$%\^&\*\(\)=\+_<>\?:\"\{\}\|，。；‘’【】、！￥……（）——《》？：“”-]+"
+)
+KEYWORD_QUOTE_PATTERN = re.compile(r"[ \\\"']+")
+
+
+class _QueryCharTable(dict):
+    """str.translate table applying strQ2B and tradi2simp in a single pass.
+
+    Both conversions map one character to one character, so the composed mapping is filled in
+    per character the first time it shows up.
+    """
+
+    def __missing__(self, code):
+        char = chr(code)
+        mapped = rag_tokenizer.tradi2simp(rag_tokenizer.strQ2B(char))
+        self[code] = mapped
+        return mapped
+
+
+QUERY_CHAR_TABLE = _QueryCharTable()
 
 
 class FulltextQueryer:
     def __init__(self):
-        self.tw = term_weight.Dealer()
-        self.syn = synonym.Dealer()
+        self._cache_lock = threading.Lock()
+        self._query_cache = OrderedDict()
+        self._syn_cache = {}
+        self._weight_cache = {}
+        self._cache_time = time.monotonic()
         self.query_fields = [
             "title_tks^10",
             "title_sm_tks^5",
@@ -23,67 +82,112 @@ class FulltextQueryer:
             "content_sm_ltks",
         ]
 
+    @property
+    def tw(self):
+        # shared with everything else in the process instead of one copy per queryer
+        return RESOURCES.get("term_weight")
+
+    @property
+    def syn(self):
+        return RESOURCES.get("synonym")
+
     @staticmethod
     def subSpecialChar(line):
-        return re.sub(r"([:\{\}/\[\]\-\*\"\(\)\|\+~\^])", r"\\\1", line).strip()
+        return SPECIAL_CHAR_PATTERN.sub(r"\\\1", line).strip()
 
     @staticmethod
     def isChinese(line):
-        arr = re.split(r"[ \t]+", line)
+        arr = BLANK_SPLIT_PATTERN.split(line)
         if len(arr) <= 3:
             return True
         e = 0
         for t in arr:
-            if not re.match(r"[a-zA-Z]+$", t):
+            if not LATIN_WORD_PATTERN.match(t):
                 e += 1
         return e * 1.0 / len(arr) >= 0.7
 
     @staticmethod
     def rmWWW(txt):
-        patts = [
-            (
-                r"是*(什么样的|哪家|一下|那家|请问|啥样|咋样了|什么时候|何时|何地|何人|是否|是不是|多少|哪里|怎么|哪儿|怎么样|如何|哪些|是啥|啥是|啊|吗|呢|吧|咋|什么|有没有|呀|谁|哪位|哪个)是*",
-                "",
-            ),
-            (r"(^| )(what|who|how|which|where|why)('re|'s)? ", " "),
-            (
-                r"(^| )('s|'re|is|are|were|was|do|does|did|don't|doesn't|didn't|has|have|be|there|you|me|your|my|mine|just|please|may|i|should|would|wouldn't|will|won't|done|go|for|with|so|the|a|an|by|i'm|it's|he's|she's|they|they're|you're|as|by|on|in|at|up|out|down|of|to|or|and|if) ",
-                " ")
-        ]
         otxt = txt
-        for r, p in patts:
-            txt = re.sub(r, p, txt, flags=re.IGNORECASE)
+        for r, p in WWW_PATTERNS:
+            txt = r.sub(p, txt)
         if not txt:
             txt = otxt
         return txt
 
+    @staticmethod
+    def normalize(txt):
+        """Lower case, full width to half width, traditional to simplified, punctuation and
+        question words removed. Questions differing only in those respects share one analysis."""
+        txt = QUESTION_PUNCT_PATTERN.sub(" ", txt.lower().translate(QUERY_CHAR_TABLE)).strip()
+        return FulltextQueryer.rmWWW(txt)
+
+    def _expire_caches(self):
+        if time.monotonic() - self._cache_time < QUERY_CACHE_TTL:
+            return
+        with self._cache_lock:
+            self._query_cache.clear()
+            self._syn_cache = {}
+            self._weight_cache = {}
+            self._cache_time = time.monotonic()
+
+    def _lookup_syn(self, tk):
+        res = self._syn_cache.get(tk)
+        if res is None:
+            res = self.syn.lookup(tk)
+            self._syn_cache[tk] = res
+        return list(res)
+
+    def _token_weights(self, tk):
+        res = self._weight_cache.get(tk)
+        if res is None:
+            res = self.tw.weights([tk])
+            self._weight_cache[tk] = res
+        return res
+
+    @staticmethod
+    def _copy_result(result):
+        expr, keywords = result
+        if expr is not None:
+            expr = MatchTextExpr(expr.fields, expr.matching_text, expr.topn, dict(expr.extra_options))
+        return expr, list(keywords)
+
     def question(self, txt, tbl="qa", min_match: float = 0.6):
-        txt = re.sub(
-            r"[ :|\r\n\t,，。？?/`!！&^%%()\[\]{}<>]+",
-            " ",
-            rag_tokenizer.tradi2simp(rag_tokenizer.strQ2B(txt.lower())),
-        ).strip()
-        txt = FulltextQueryer.rmWWW(txt)
+        txt = self.normalize(txt)
+        self._expire_caches()
+        key = (txt, min_match)
+        with self._cache_lock:
+            result = self._query_cache.get(key)
+            if result is not None:
+                self._query_cache.move_to_end(key)
+        if result is None:
+            result = self._analyze(txt, min_match)
+            with self._cache_lock:
+                self._query_cache[key] = result
+                if len(self._query_cache) > QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
+        return self._copy_result(result)
 
+    def _analyze(self, txt, min_match):
         if not self.isChinese(txt):
             txt = FulltextQueryer.rmWWW(txt)
             tks = rag_tokenizer.tokenize(txt).split()
             keywords = [t for t in tks if t]
             tks_w = self.tw.weights(tks, preprocess=False)
-            tks_w = [(re.sub(r"[ \\\"'^]", "", tk), w) for tk, w in tks_w]
-            tks_w = [(re.sub(r"^[a-z0-9]$", "", tk), w) for tk, w in tks_w if tk]
-            tks_w = [(re.sub(r"^[\+-]", "", tk), w) for tk, w in tks_w if tk]
+            tks_w = [(TOKEN_QUOTE_PATTERN.sub("", tk), w) for tk, w in tks_w]
+            tks_w = [(SINGLE_ALNUM_PATTERN.sub("", tk), w) for tk, w in tks_w if tk]
+            tks_w = [(LEADING_SIGN_PATTERN.sub("", tk), w) for tk, w in tks_w if tk]
             tks_w = [(tk.strip(), w) for tk, w in tks_w if tk.strip()]
             syns = []
             for tk, w in tks_w[:256]:
-                syn = self.syn.lookup(tk)
+                syn = self._lookup_syn(tk)
                 syn = rag_tokenizer.tokenize(" ".join(syn)).split()
                 keywords.extend(syn)
                 syn = ["\"{}\"^{:.4f}".format(s, w / 4.) for s in syn if s.strip()]
                 syns.append(" ".join(syn))
 
             q = ["({}^{:.4f}".format(tk, w) + " {})".format(syn) for (tk, w), syn in zip(tks_w, syns) if
-                 tk and not re.match(r"[.^+\(\)-]", tk)]
+                 tk and not QUERY_OPERATOR_PATTERN.match(tk)]
             for i in range(1, len(tks_w)):
                 left, right = tks_w[i - 1][0].strip(), tks_w[i][0].strip()
                 if not left or not right:
@@ -106,7 +210,7 @@ class FulltextQueryer:
         def need_fine_grained_tokenize(tk):
             if len(tk) < 3:
                 return False
-            if re.match(r"[0-9a-z\.\+#_\*-]+$", tk):
+            if NO_FINE_GRAINED_PATTERN.match(tk):
                 return False
             return True
 
@@ -116,11 +220,12 @@ class FulltextQueryer:
             if not tt:
                 continue
             keywords.append(tt)
-            twts = self.tw.weights([tt])
-            syns = self.syn.lookup(tt)
+            twts = self._token_weights(tt)
+            syns = self._lookup_syn(tt)
             if syns and len(keywords) < 32:
                 keywords.extend(syns)
-            logging.debug(json.dumps(twts, ensure_ascii=False))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(json.dumps(twts, ensure_ascii=False))
             tms = []
             for tk, w in sorted(twts, key=lambda x: x[1] * -1):
                 sm = (
@@ -128,22 +233,15 @@ class FulltextQueryer:
                     if need_fine_grained_tokenize(tk)
                     else []
                 )
-                sm = [
-                    re.sub(
-                        r"[ ,\./;'\[\]\\`~!@#$%\^&\*\(\)=\+_<>\?:\"\{\}\|，。；‘’【】、！￥……（）——《》？：“”-]+",
-                        "",
-                        m,
-                    )
-                    for m in sm
-                ]
+                sm = [FINE_GRAINED_PUNCT_PATTERN.sub("", m) for m in sm]
                 sm = [FulltextQueryer.subSpecialChar(m) for m in sm if len(m) > 1]
                 sm = [m for m in sm if len(m) > 1]
 
                 if len(keywords) < 32:
-                    keywords.append(re.sub(r"[ \\\"']+", "", tk))
+                    keywords.append(KEYWORD_QUOTE_PATTERN.sub("", tk))
                     keywords.extend(sm)
 
-                tk_syns = self.syn.lookup(tk)
+                tk_syns = self._lookup_syn(tk)
                 tk_syns = [FulltextQueryer.subSpecialChar(s) for s in tk_syns]
                 if len(keywords) < 32:
                     keywords.extend([s for s in tk_syns if s])
@@ -9,7 +9,9 @@ import sys
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
+from app.rag.nlp.mmap_dict import MmapDict, load_compiled
 from app.rag.utils.file_utils import get_project_base_directory
+from app.rag.utils.resources import RESOURCES
 
 
 class RagTokenizer:
@@ -42,6 +44,23 @@ class RagTokenizer:
         except Exception:
             logging.exception(f"[HUQIE]:Build trie {fnm} failed")
 
+    def _build_dict(self):
+        """Entries of the default dictionary as a plain dict, to be compiled"""
+        fnm = self.DIR_ + ".txt"
+        if not os.path.exists(fnm):
+            return dict(datrie.Trie.load(fnm + ".trie").items())
+        res = {}
+        with open(fnm, "r", encoding='utf-8') as of:
+            for line in of:
+                line = re.sub(r"[\r\n]+", "", line)
+                line = re.split(r"[ \t]", line)
+                k = self.key_(line[0])
+                F = int(math.log(float(line[1]) / self.DENOMINATOR) + .5)
+                if k not in res or res[k][0] < F:
+                    res[k] = (F, line[2])
+                res[self.rkey_(line[0])] = 1
+        return res
+
     def __init__(self, debug=False):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
@@ -52,6 +71,14 @@ class RagTokenizer:
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
+        # the compiled dictionary is memory mapped read-only and shared between worker processes
+        self.trie_ = load_compiled(
+            self.DIR_ + ".txt.dict", [self.DIR_ + ".txt", self.DIR_ + ".txt.trie"], self._build_dict,
+            prefix_index=True,
+        )
+        if self.trie_ is not None:
+            return
+
         trie_file_name = self.DIR_ + ".txt.trie"
         # check if trie file existence
         if os.path.exists(trie_file_name):
@@ -80,6 +107,12 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        if isinstance(self.trie_, MmapDict):
+            # the compiled dictionary is read only, copy it into a trie that takes the user entries
+            trie = datrie.Trie(string.printable)
+            for k, v in self.trie_.items():
+                trie[k] = v
+            self.trie_ = trie
         self.loadDict_(fnm)
 
     def _strQ2B(self, ustring):
@@ -417,15 +450,44 @@ def naiveQie(txt):
     return tks
 
 
-tokenizer = RagTokenizer()
-tokenize = tokenizer.tokenize
-fine_grained_tokenize = tokenizer.fine_grained_tokenize
-tag = tokenizer.tag
-freq = tokenizer.freq
-loadUserDict = tokenizer.loadUserDict
-addUserDict = tokenizer.addUserDict
-tradi2simp = tokenizer._tradi2simp
-strQ2B = tokenizer._strQ2B
+def __getattr__(name):
+    # the shared tokenizer is created on first use, one per process (see app.rag.utils.resources)
+    if name == "tokenizer":
+        return RESOURCES.get("rag_tokenizer")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def tokenize(line):
+    return RESOURCES.get("rag_tokenizer").tokenize(line)
+
+
+def fine_grained_tokenize(tks):
+    return RESOURCES.get("rag_tokenizer").fine_grained_tokenize(tks)
+
+
+def tag(tk):
+    return RESOURCES.get("rag_tokenizer").tag(tk)
+
+
+def freq(tk):
+    return RESOURCES.get("rag_tokenizer").freq(tk)
+
+
+def loadUserDict(fnm):
+    return RESOURCES.get("rag_tokenizer").loadUserDict(fnm)
+
+
+def addUserDict(fnm):
+    return RESOURCES.get("rag_tokenizer").addUserDict(fnm)
+
+
+def tradi2simp(line):
+    return HanziConv.toSimplified(line)
+
+
+def strQ2B(ustring):
+    return RagTokenizer._strQ2B(None, ustring)
+
 
 if __name__ == '__main__':
     # tknzr = RagTokenizer(debug=True)
@@ -5,6 +5,7 @@ import re
 import os
 import numpy as np
 from app.rag.nlp import rag_tokenizer
+from app.rag.nlp.mmap_dict import load_compiled
 from app.rag.utils.file_utils import get_project_base_directory
 
 
@@ -62,16 +63,32 @@ class Dealer:
                 return set(res.keys())
             return res
 
+        def load_json(fnm):
+            with open(fnm, "r") as f:
+                return json.load(f)
+
+        def load_freq(fnm):
+            res = load_dict(fnm)
+            return res if isinstance(res, dict) else dict.fromkeys(res, 0)
+
         fnm = os.path.join(get_project_base_directory(), "rag/res")
-        self.ne, self.df = {}, {}
-        try:
-            self.ne = json.load(open(os.path.join(fnm, "ner.json"), "r"))
-        except Exception:
-            logging.warning("Load ner.json FAIL!")
-        try:
-            self.df = load_dict(os.path.join(fnm, "term.freq"))
-        except Exception:
-            logging.warning("Load term.freq FAIL!")
+        ner_fnm = os.path.join(fnm, "ner.json")
+        freq_fnm = os.path.join(fnm, "term.freq")
+        # compiled, memory mapped copies are shared between worker processes
+        self.ne = load_compiled(ner_fnm + ".dict", [ner_fnm], lambda: load_json(ner_fnm))
+        self.df = load_compiled(freq_fnm + ".dict", [freq_fnm], lambda: load_freq(freq_fnm))
+        if self.ne is None:
+            self.ne = {}
+            try:
+                self.ne = load_json(ner_fnm)
+            except Exception:
+                logging.warning("Load ner.json FAIL!")
+        if self.df is None:
+            self.df = {}
+            try:
+                self.df = load_dict(freq_fnm)
+            except Exception:
+                logging.warning("Load term.freq FAIL!")
 
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
@@ -1,134 +1,170 @@
 
+import codecs
+import csv
+import io
+import itertools
 import logging
 import sys
 from io import BytesIO
 import pandas as pd
-from openpyxl import Workbook, load_workbook
+from openpyxl import load_workbook
 from app.rag.nlp import find_codec
 
+CSV_SAMPLE_SIZE = 64 * 1024
+
 
 class ExcelParser:
+    """
+    Tabular parser for xlsx/xls/csv files.
+
+    Sheets are read lazily (openpyxl read-only mode, csv.reader for CSV) and rows are yielded as
+    lists of cell values, so chunks can be produced without materializing the whole workbook.
+    `from_row`/`to_row` select a range of the global row numbering used by `row_number`, which
+    lets a task only build the chunks of its own rows.
+    """
 
     @staticmethod
-    def _load_excel_to_workbook(file_like_object):
-        if isinstance(file_like_object, bytes):
+    def _iter_sheets(file_like_object):
+        """Yield (sheetname, rows) pairs, rows being an iterator of lists of cell values."""
+        opened = None
+        if isinstance(file_like_object, (bytes, bytearray)):
             file_like_object = BytesIO(file_like_object)
+        elif isinstance(file_like_object, str):
+            file_like_object = opened = open(file_like_object, "rb")
+
+        try:
+            yield from ExcelParser._iter_sheets_of(file_like_object)
+        finally:
+            if opened is not None:
+                opened.close()
 
-        # Read first 4 bytes to determine file type
+    @staticmethod
+    def _iter_sheets_of(file_like_object):
         file_like_object.seek(0)
         file_head = file_like_object.read(4)
         file_like_object.seek(0)
 
         if not (file_head.startswith(b'PK\x03\x04') or file_head.startswith(b'\xD0\xCF\x11\xE0')):
-            logging.info("****wxy: Not an Excel file, converting CSV to Excel Workbook")
-
+            sample = file_like_object.read(CSV_SAMPLE_SIZE)
+            file_like_object.seek(0)
+            txt = io.TextIOWrapper(file_like_object, encoding=find_codec(sample), errors="ignore", newline="")
+            rows = ([c if c != "" else None for c in r] for r in csv.reader(txt))
             try:
-                file_like_object.seek(0)
-                df = pd.read_csv(file_like_object)
-                return ExcelParser._dataframe_to_workbook(df)
-
-            except Exception as e_csv:
-                raise Exception(f"****wxy: Failed to parse CSV and convert to Excel Workbook: {e_csv}")
+                yield "Data", rows
+            finally:
+                # leave the underlying file to its owner
+                txt.detach()
+            return
 
         try:
-            return load_workbook(file_like_object,data_only= True)
+            wb = load_workbook(file_like_object, read_only=True, data_only=True)
         except Exception as e:
-            logging.info(f"****wxy: openpyxl load error: {e}, try pandas instead")
-            try:
-                file_like_object.seek(0)
-                df = pd.read_excel(file_like_object)
-                return ExcelParser._dataframe_to_workbook(df)
-            except Exception as e_pandas:
-                raise Exception(f"****wxy: pandas.read_excel error: {e_pandas}, original openpyxl error: {e}")
+            logging.info(f"openpyxl load error: {e}, try pandas instead")
+            file_like_object.seek(0)
+            for sheetname, df in pd.read_excel(file_like_object, sheet_name=None).items():
+                rows = itertools.chain([list(df.columns)], (list(r) for r in df.itertuples(index=False)))
+                yield sheetname, ([None if pd.isna(c) else c for c in r] for r in rows)
+            return
+        try:
+            for sheetname in wb.sheetnames:
+                ws = wb[sheetname]
+                # read-only sheets trust the stored <dimension>, which some writers get wrong
+                ws.reset_dimensions()
+                yield sheetname, (list(r) for r in ws.iter_rows(values_only=True))
+        finally:
+            wb.close()
 
     @staticmethod
-    def _dataframe_to_workbook(df):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Data"
-
-        for col_num, column_name in enumerate(df.columns, 1):
-            ws.cell(row=1, column=col_num, value=column_name)
-
-        for row_num, row in enumerate(df.values, 2):
-            for col_num, value in enumerate(row, 1):
-                ws.cell(row=row_num, column=col_num, value=value)
+    def _iter_row_ranges(fnm, from_row=0, to_row=None):
+        """
+        Yield (sheetname, header, rows, has_header) for every sheet with rows in [from_row, to_row)
+        of the global row numbering, header rows included in the count like `row_number` does.
+        `has_header` tells whether the header row itself is in the range.
+        Rows before `from_row` are skipped without being kept, reading stops after `to_row`.
+        """
+        n = 0
+        for sheetname, rows in ExcelParser._iter_sheets(fnm):
+            if to_row is not None and n >= to_row:
+                break
+            header = next(rows, None)
+            if header is None:
+                continue
+            has_header = n >= from_row
+            n += 1
+
+            def selected(rows=rows):
+                nonlocal n
+                for r in rows:
+                    i = n
+                    n += 1
+                    if i < from_row:
+                        continue
+                    if to_row is not None and i >= to_row:
+                        return
+                    yield r
 
-        return wb
+            it = selected()
+            yield sheetname, header, it, has_header
+            # consume what the caller left over so the numbering of the next sheet is right
+            for _ in it:
+                pass
 
-    def html(self, fnm, chunk_rows=256):
+    def iter_html(self, fnm, chunk_rows=256, from_row=0, to_row=None):
         file_like_object = BytesIO(fnm) if not isinstance(fnm, str) else fnm
-        wb = ExcelParser._load_excel_to_workbook(file_like_object)
-        tb_chunks = []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:
-                continue
-
-            tb_rows_0 = "<tr>"
-            for t in list(rows[0]):
-                tb_rows_0 += f"<th>{t.value}</th>"
-            tb_rows_0 += "</tr>"
-
-            for chunk_i in range((len(rows) - 1) // chunk_rows + 1):
-                tb = ""
-                tb += f"<table><caption>{sheetname}</caption>"
-                tb += tb_rows_0
-                for r in list(
-                    rows[1 + chunk_i * chunk_rows: 1 + (chunk_i + 1) * chunk_rows]
-                ):
-                    tb += "<tr>"
-                    for i, c in enumerate(r):
-                        if c.value is None:
-                            tb += "<td></td>"
-                        else:
-                            tb += f"<td>{c.value}</td>"
-                    tb += "</tr>"
-                tb += "</table>\n"
-                tb_chunks.append(tb)
-
-        return tb_chunks
-
-    def __call__(self, fnm):
+        for sheetname, header, rows, has_header in ExcelParser._iter_row_ranges(file_like_object, from_row, to_row):
+            tb_rows_0 = "<tr>" + "".join(f"<th>{t}</th>" for t in header) + "</tr>"
+            emitted = False
+            while True:
+                chunk = list(itertools.islice(rows, chunk_rows))
+                # a sheet with only a header still gets its table, from the range holding the header
+                if not chunk and (emitted or not has_header):
+                    break
+                tb = [f"<table><caption>{sheetname}</caption>", tb_rows_0]
+                for r in chunk:
+                    tb.append("<tr>")
+                    tb.extend("<td></td>" if c is None else f"<td>{c}</td>" for c in r)
+                    tb.append("</tr>")
+                tb.append("</table>\n")
+                emitted = True
+                yield "".join(tb)
+                if not chunk:
+                    break
+
+    def html(self, fnm, chunk_rows=256, from_row=0, to_row=None):
+        return list(self.iter_html(fnm, chunk_rows, from_row, to_row))
+
+    def iter_lines(self, fnm, from_row=0, to_row=None):
         file_like_object = BytesIO(fnm) if not isinstance(fnm, str) else fnm
-        wb = ExcelParser._load_excel_to_workbook(file_like_object)
-
-        res = []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:
-                continue
-            ti = list(rows[0])
-            for r in list(rows[1:]):
+        for sheetname, ti, rows, _ in ExcelParser._iter_row_ranges(file_like_object, from_row, to_row):
+            for r in rows:
                 fields = []
                 for i, c in enumerate(r):
-                    if not c.value:
+                    if not c:
                         continue
-                    t = str(ti[i].value) if i < len(ti) else ""
-                    t += ("：" if t else "") + str(c.value)
+                    t = str(ti[i]) if i < len(ti) else ""
+                    t += ("：" if t else "") + str(c)
                     fields.append(t)
                 line = "; ".join(fields)
                 if sheetname.lower().find("sheet") < 0:
                     line += " ——" + sheetname
-                res.append(line)
-        return res
+                yield line
+
+    def __call__(self, fnm, from_row=0, to_row=None):
+        return list(self.iter_lines(fnm, from_row, to_row))
 
     @staticmethod
     def row_number(fnm, binary):
         if fnm.split(".")[-1].lower().find("xls") >= 0:
-            wb = ExcelParser._load_excel_to_workbook(BytesIO(binary))
             total = 0
-            for sheetname in wb.sheetnames:
-                ws = wb[sheetname]
-                total += len(list(ws.rows))
+            for _, rows in ExcelParser._iter_sheets(BytesIO(binary)):
+                total += sum(1 for _ in rows)
             return total
 
         if fnm.split(".")[-1].lower() in ["csv", "txt"]:
-            encoding = find_codec(binary)
-            txt = binary.decode(encoding, errors="ignore")
-            return len(txt.split("\n"))
+            encoding = find_codec(binary[:CSV_SAMPLE_SIZE])
+            if codecs.lookup(encoding).name.startswith(("utf-16", "utf-32")):
+                return len(binary.decode(encoding, errors="ignore").split("\n"))
+            return binary.count(b"\n") + 1
 
 
 if __name__ == "__main__":
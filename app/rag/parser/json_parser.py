@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import codecs
+import io
 import json
+import logging
+from io import BytesIO
 from typing import Any
 
 from app.rag.nlp import find_codec
 
+# bytes looked at to detect the encoding, and the longest first line recognized as JSONL
+SAMPLE_SIZE = 64 * 1024
+
 
 class JsonParser:
     def __init__(
@@ -19,18 +26,130 @@ class JsonParser:
         )
 
     def __call__(self, binary):
-        encoding = find_codec(binary)
-        txt = binary.decode(encoding, errors="ignore")
-        json_data = json.loads(txt)
-        chunks = self.split_json(json_data, True)
-        sections = [json.dumps(line, ensure_ascii=False) for line in chunks if line]
-        return sections
+        """
+        Chunk a JSON or JSONL document, given as bytes or as a binary file object.
+
+        Top level items are parsed one at a time with ijson, so a file object is processed in
+        memory bounded by the largest top level item. ijson is an optional dependency, without
+        it (or for encodings other than UTF-8) the whole document is loaded at once.
+        """
+        return list(self.iter_sections(binary))
+
+    def iter_sections(self, binary):
+        for chunk in self._split_stream(self._iter_items(binary), True):
+            if chunk:
+                yield json.dumps(chunk, ensure_ascii=False)
+
+    @staticmethod
+    def _iter_items(binary):
+        """Yield the top level (key, value) pairs of a JSON object, JSON array or JSONL stream."""
+        stream = BytesIO(binary) if isinstance(binary, (bytes, bytearray)) else binary
+        start = stream.tell()
+        head = stream.read(SAMPLE_SIZE)
+        stream.seek(start)
+        encoding = find_codec(head)
+        first = head.lstrip()[:1]
+
+        if JsonParser._is_jsonl(stream, encoding):
+            stream.seek(start)
+            yield from JsonParser._iter_lines(stream, encoding)
+            return
+        stream.seek(start)
+
+        ijson = None
+        if codecs.lookup(encoding).name == "utf-8" and first in (b"{", b"["):
+            try:
+                import ijson
+            except ImportError:
+                logging.info("Can't import package 'ijson', JSON is loaded at once")
+        if ijson is not None:
+            if first == b"[":
+                for i, item in enumerate(ijson.items(stream, "item", use_float=True)):
+                    yield str(i), item
+            else:
+                yield from ijson.kvitems(stream, "", use_float=True)
+            return
+
+        data = stream.read()
+        try:
+            json_data = json.loads(data.decode(encoding, errors="ignore"))
+        except json.JSONDecodeError as e:
+            if not e.msg.startswith("Extra data"):
+                raise
+            yield from JsonParser._iter_lines(BytesIO(data), encoding)
+            return
+        if isinstance(json_data, list):
+            yield from ((str(i), item) for i, item in enumerate(json_data))
+        elif isinstance(json_data, dict):
+            yield from json_data.items()
+        else:
+            raise ValueError("The top level JSON value must be an object or an array")
+
+    @staticmethod
+    def _is_jsonl(stream, encoding) -> bool:
+        """
+        JSONL if the first non-blank line is a JSON value on its own and another non-blank line follows.
+
+        Lines are read at most SAMPLE_SIZE bytes at a time, so a minified single line document is
+        not loaded just for the detection. A first line longer than that is taken for plain JSON,
+        which still falls back to line parsing on "Extra data". The caller rewinds the stream.
+        """
+        first_line = b""
+        while not first_line.strip():
+            first_line = stream.readline(SAMPLE_SIZE)
+            if not first_line:
+                return False
+        if not first_line.endswith(b"\n"):
+            return False
+        while True:
+            line = stream.readline(SAMPLE_SIZE)
+            if not line:
+                return False
+            if line.strip():
+                break
+        try:
+            json.loads(first_line.decode(encoding, errors="ignore"))
+        except ValueError:
+            return False
+        return True
+
+    @staticmethod
+    def _iter_lines(stream, encoding):
+        text = io.TextIOWrapper(stream, encoding=encoding, errors="ignore")
+        i = 0
+        for line in text:
+            if not line.strip():
+                continue
+            yield str(i), json.loads(line)
+            i += 1
+        text.detach()
 
     @staticmethod
     def _json_size(data: dict) -> int:
         """Calculate the size of the serialized JSON object."""
         return len(json.dumps(data, ensure_ascii=False))
 
+    @staticmethod
+    def _key_size(key) -> int:
+        """Size of a serialized dict key, quotes included."""
+        if isinstance(key, str):
+            return len(json.dumps(key, ensure_ascii=False))
+        return len(json.dumps({key: 0}, ensure_ascii=False)) - len("{: 0}")
+
+    def _value_size(self, value, memo: dict) -> int:
+        """Size of the serialized value, nested containers are measured once and memoized by id."""
+        if isinstance(value, (dict, list)):
+            size = memo.get(id(value))
+            if size is None:
+                if isinstance(value, dict):
+                    size = sum(self._key_size(k) + 2 + self._value_size(v, memo) for k, v in value.items())
+                else:
+                    size = sum(self._value_size(v, memo) for v in value)
+                size += 2 + 2 * max(len(value) - 1, 0)
+                memo[id(value)] = size
+            return size
+        return len(json.dumps(value, ensure_ascii=False))
+
     @staticmethod
     def _set_nested_dict(d: dict, path: list[str], value: Any) -> None:
         """Set a value in a nested dictionary based on the given path."""
@@ -38,6 +157,21 @@ class JsonParser:
             d = d.setdefault(key, {})
         d[path[-1]] = value
 
+    def _nested_size_delta(self, d: dict, path: list[str], item_size: int) -> int:
+        """
+        How much the serialized size of `d` grows when `_set_nested_dict` puts an item of
+        serialized size `item_size` (as `{key: value}`) at `path`.
+        """
+        delta = 0
+        for key in path[:-1]:
+            if isinstance(d, dict) and key in d:
+                d = d[key]
+                continue
+            # ", " if needed, then "key": {}
+            delta += (2 if d else 0) + self._key_size(key) + 4
+            d = None
+        return delta + (2 if d else 0) + item_size - 2
+
     def _list_to_dict_preprocessing(self, data: Any) -> Any:
         if isinstance(data, dict):
             # Process each key-value pair in the dictionary
@@ -57,34 +191,64 @@ class JsonParser:
             data,
             current_path: list[str] | None,
             chunks: list[dict] | None,
+            sizes: list[int] | None = None,
+            memo: dict | None = None,
     ) -> list[dict]:
         """
         Split json into maximum size dictionaries while preserving structure.
+
+        `sizes` holds the running serialized size of each chunk, so chunks are never
+        re-serialized while they grow.
         """
         current_path = current_path or []
         chunks = chunks or [{}]
+        if sizes is None:
+            sizes = [self._json_size(chunk) for chunk in chunks]
+        memo = {} if memo is None else memo
         if isinstance(data, dict):
             for key, value in data.items():
                 new_path = current_path + [key]
-                chunk_size = self._json_size(chunks[-1])
-                size = self._json_size({key: value})
+                chunk_size = sizes[-1]
+                size = self._key_size(key) + self._value_size(value, memo) + 4
                 remaining = self.max_chunk_size - chunk_size
 
                 if size < remaining:
                     # Add item to current chunk
+                    sizes[-1] += self._nested_size_delta(chunks[-1], new_path, size)
                     self._set_nested_dict(chunks[-1], new_path, value)
                 else:
                     if chunk_size >= self.min_chunk_size:
                         # Chunk is big enough, start a new chunk
                         chunks.append({})
+                        sizes.append(2)
 
                     # Iterate
-                    self._json_split(value, new_path, chunks)
+                    self._json_split(value, new_path, chunks, sizes, memo)
         else:
             # handle single item
+            if current_path:
+                size = self._key_size(current_path[-1]) + self._value_size(data, memo) + 4
+                sizes[-1] += self._nested_size_delta(chunks[-1], current_path, size)
             self._set_nested_dict(chunks[-1], current_path, data)
         return chunks
 
+    def _split_stream(self, items, convert_lists: bool = False):
+        """
+        Same chunks as `split_json` over a stream of top level (key, value) pairs.
+        A chunk is yielded as soon as the next one is started, only the open chunk is kept.
+        """
+        chunks, sizes = [{}], [2]
+        for key, value in items:
+            if convert_lists:
+                value = self._list_to_dict_preprocessing(value)
+            self._json_split({key: value}, None, chunks, sizes)
+            if len(chunks) > 1:
+                yield from chunks[:-1]
+                del chunks[:-1]
+                del sizes[:-1]
+        if chunks[-1]:
+            yield chunks[-1]
+
     def split_json(
             self,
             json_data,
@@ -6,6 +6,7 @@ import re
 import sys
 import threading
 from copy import deepcopy
+from functools import lru_cache
 from io import BytesIO
 from timeit import default_timer as timer
 
@@ -18,7 +19,9 @@ from PIL import Image
 from pypdf import PdfReader as pdf2_read
 from app.rag import settings
 from app.rag.utils.file_utils import get_project_base_directory
-from app.rag.vision import OCR, LayoutRecognizer, Recognizer, TableStructureRecognizer
+from app.rag.utils.resources import RESOURCES
+from app.rag.vision import Recognizer, TableStructureRecognizer
+from app.rag.vision.box_ops import BoxIndex
 from app.rag.nlp import rag_tokenizer
 from app.rag.settings import PARALLEL_DEVICES
 # from rag.prompts import vision_llm_describe_prompt
@@ -28,6 +31,43 @@ LOCK_KEY_pdfplumber = "global_shared_lock_pdfplumber"
 if LOCK_KEY_pdfplumber not in sys.modules:
     sys.modules[LOCK_KEY_pdfplumber] = threading.Lock()
 
+# characters of each box end looked at by the up-down concat features
+UPDOWN_CONCAT_LEN = 6
+# upper boxes whose candidate pairs are scored by one prediction
+UPDOWN_CONCAT_WINDOW = 64
+
+
+@lru_cache(maxsize=1 << 16)
+def _tokenize_cached(text):
+    # the up-down features tokenize the same box ends again for every pair they are part of
+    return rag_tokenizer.tokenize(text)
+
+
+def load_updown_concat_model():
+    updown_cnt_mdl = xgb.Booster()
+    if not settings.LIGHTEN:
+        try:
+            import torch.cuda
+            if torch.cuda.is_available():
+                updown_cnt_mdl.set_param({"device": "cuda"})
+        except Exception:
+            logging.exception("PdfParser __init__")
+    try:
+        model_dir = os.path.join(
+            get_project_base_directory(),
+            "rag/res/deepdoc")
+        updown_cnt_mdl.load_model(os.path.join(
+            model_dir, "updown_concat_xgb.model"))
+    except Exception:
+        # model_dir = snapshot_download(
+        #     repo_id="InfiniFlow/text_concat_xgb_v1.0",
+        #     local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
+        #     local_dir_use_symlinks=False)
+        # updown_cnt_mdl.load_model(os.path.join(
+        #     model_dir, "updown_concat_xgb.model"))
+        logging.exception("PdfParser model_dir")
+    return updown_cnt_mdl
+
 
 class PdfParser:
     def __init__(self, **kwargs):
@@ -35,48 +75,21 @@ class PdfParser:
         export HF_ENDPOINT=https://hf-mirror.com
 
         """
-        self.ocr = OCR()
+        # models are shared by every parser in the process, see app.rag.utils.resources
+        self.ocr = RESOURCES.get("ocr")
         self.parallel_limiter = None
         if PARALLEL_DEVICES is not None and PARALLEL_DEVICES > 1:
             self.parallel_limiter = [trio.CapacityLimiter(1) for _ in range(PARALLEL_DEVICES)]
 
         if hasattr(self, "model_speciess"):
-            self.layouter = LayoutRecognizer("layout." + self.model_speciess)
+            self.layouter = RESOURCES.get("layout_recognizer", "layout." + self.model_speciess)
         else:
-            self.layouter = LayoutRecognizer("layout")
-        self.tbl_det = TableStructureRecognizer()
-
-        self.updown_cnt_mdl = xgb.Booster()
-        if not settings.LIGHTEN:
-            try:
-                import torch.cuda
-                if torch.cuda.is_available():
-                    self.updown_cnt_mdl.set_param({"device": "cuda"})
-            except Exception:
-                logging.exception("PdfParser __init__")
-        try:
-            model_dir = os.path.join(
-                get_project_base_directory(),
-                "rag/res/deepdoc")
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
-        except Exception:
-            # model_dir = snapshot_download(
-            #     repo_id="InfiniFlow/text_concat_xgb_v1.0",
-            #     local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
-            #     local_dir_use_symlinks=False)
-            # self.updown_cnt_mdl.load_model(os.path.join(
-            #     model_dir, "updown_concat_xgb.model"))
-            logging.exception("PdfParser model_dir")
+            self.layouter = RESOURCES.get("layout_recognizer", "layout")
+        self.tbl_det = RESOURCES.get("table_structure_recognizer")
+        self.updown_cnt_mdl = RESOURCES.get("updown_concat_model")
 
         self.page_from = 0
 
-    def __char_width(self, c):
-        return (c["x1"] - c["x0"]) // max(len(c["text"]), 1)
-
-    def __height(self, c):
-        return c["bottom"] - c["top"]
-
     def _x_dis(self, a, b):
         return min(abs(a["x1"] - b["x0"]), abs(a["x0"] - b["x1"]),
                    abs(a["x0"] + a["x1"] - b["x0"] - b["x1"]) / 2)
@@ -99,63 +112,129 @@ class PdfParser:
         ]
         return any([re.match(p, b["text"]) for p in proj_patt])
 
-    def _updown_concat_features(self, up, down):
-        w = max(self.__char_width(up), self.__char_width(down))
-        h = max(self.__height(up), self.__height(down))
-        y_dis = self._y_dis(up, down)
-        LEN = 6
-        tks_down = rag_tokenizer.tokenize(down["text"][:LEN]).split()
-        tks_up = rag_tokenizer.tokenize(up["text"][-LEN:]).split()
-        tks_all = up["text"][-LEN:].strip() \
-            + (" " if re.match(r"[a-zA-Z0-9]+",
-                               up["text"][-1] + down["text"][0]) else "") \
-            + down["text"][:LEN].strip()
-        tks_all = rag_tokenizer.tokenize(tks_all).split()
-        fea = [
-            up.get("R", -1) == down.get("R", -1),
-            y_dis / h,
-            down["page_number"] - up["page_number"],
-            up["layout_type"] == down["layout_type"],
-            up["layout_type"] == "text",
-            down["layout_type"] == "text",
-            up["layout_type"] == "table",
-            down["layout_type"] == "table",
-            True if re.search(
-                r"([。？！；!?;+)）]|[a-z]\.)$",
-                up["text"]) else False,
-            True if re.search(r"[，：‘“、0-9（+-]$", up["text"]) else False,
-            True if re.search(
-                r"(^.?[/,?;:\]，。；：’”？！》】）-])",
-                down["text"]) else False,
-            True if re.match(r"[\(（][^\(\)（）]+[）\)]$", up["text"]) else False,
-            True if re.search(r"[，,][^。.]+$", up["text"]) else False,
-            True if re.search(r"[，,][^。.]+$", up["text"]) else False,
-            True if re.search(r"[\(（][^\)）]+$", up["text"])
-            and re.search(r"[\)）]", down["text"]) else False,
-            self._match_proj(down),
-            True if re.match(r"[A-Z]", down["text"]) else False,
-            True if re.match(r"[A-Z]", up["text"][-1]) else False,
-            True if re.match(r"[a-z0-9]", up["text"][-1]) else False,
-            True if re.match(r"[0-9.%,-]+$", down["text"]) else False,
-            up["text"].strip()[-2:] == down["text"].strip()[-2:] if len(up["text"].strip()
-                                                                        ) > 1 and len(
-                down["text"].strip()) > 1 else False,
-            up["x0"] > down["x1"],
-            abs(self.__height(up) - self.__height(down)) / min(self.__height(up),
-                                                               self.__height(down)),
-            self._x_dis(up, down) / max(w, 0.000001),
-            (len(up["text"]) - len(down["text"])) /
-            max(len(up["text"]), len(down["text"])),
-            len(tks_all) - len(tks_up) - len(tks_down),
-            len(tks_down) - len(tks_up),
-            tks_down[-1] == tks_up[-1] if tks_down and tks_up else False,
-            max(down["in_row"], up["in_row"]),
-            abs(down["in_row"] - up["in_row"]),
-            len(tks_down) == 1 and rag_tokenizer.tag(tks_down[0]).find("n") >= 0,
-            len(tks_up) == 1 and rag_tokenizer.tag(tks_up[0]).find("n") >= 0
-        ]
+    def _updown_box_features(self, b):
+        """The text features of the up-down concat model that depend on one box only, as the upper
+        ("u_" keys) and as the lower ("d_" keys) box of a pair."""
+        LEN = UPDOWN_CONCAT_LEN
+        text = b["text"]
+        tks_up = _tokenize_cached(text[-LEN:]).split()
+        tks_down = _tokenize_cached(text[:LEN]).split()
+        tail = text.strip()
+        return {
+            "tks_up": tks_up,
+            "tks_down": tks_down,
+            "tail2": tail[-2:] if len(tail) > 1 else None,
+            "u_flags": [
+                bool(re.search(r"([。？！；!?;+)）]|[a-z]\.)$", text)),
+                bool(re.search(r"[，：‘“、0-9（+-]$", text)),
+                bool(re.match(r"[\(（][^\(\)（）]+[）\)]$", text)),
+                bool(re.search(r"[，,][^。.]+$", text)),
+            ],
+            "u_open": bool(re.search(r"[\(（][^\)）]+$", text)),
+            "u_cap": bool(re.match(r"[A-Z]", text[-1])),
+            "u_alnum": bool(re.match(r"[a-z0-9]", text[-1])),
+            "u_noun": len(tks_up) == 1 and rag_tokenizer.tag(tks_up[0]).find("n") >= 0,
+            "d_punct": bool(re.search(r"(^.?[/,?;:\]，。；：’”？！》】）-])", text)),
+            "d_close": bool(re.search(r"[\)）]", text)),
+            "d_proj": self._match_proj(b),
+            "d_cap": bool(re.match(r"[A-Z]", text)),
+            "d_num": bool(re.match(r"[0-9.%,-]+$", text)),
+            "d_noun": len(tks_down) == 1 and rag_tokenizer.tag(tks_down[0]).find("n") >= 0,
+        }
+
+    def _updown_concat_matrix(self, pairs, box_feas):
+        """Features of the up-down concat model for every (up, down) pair, one row per pair.
+
+        Geometric columns are computed on numpy arrays for all pairs at once, the text features
+        of each box are computed once and kept in ``box_feas`` (keyed by id) for the caller to
+        reuse across batches.
+        """
+        LEN = UPDOWN_CONCAT_LEN
+        ups = [u for u, _ in pairs]
+        downs = [d for _, d in pairs]
+        for b in ups + downs:
+            if id(b) not in box_feas:
+                box_feas[id(b)] = self._updown_box_features(b)
+
+        def col(bxs, k):
+            return np.array([b[k] for b in bxs], dtype=np.float64)
+
+        ux0, ux1, ut, ub = col(ups, "x0"), col(ups, "x1"), col(ups, "top"), col(ups, "bottom")
+        dx0, dx1, dt, db = col(downs, "x0"), col(downs, "x1"), col(downs, "top"), col(downs, "bottom")
+        ulen = np.array([len(u["text"]) for u in ups], dtype=np.int64)
+        dlen = np.array([len(d["text"]) for d in downs], dtype=np.int64)
+        uh, dh = ub - ut, db - dt
+        w = np.maximum((ux1 - ux0) // np.maximum(ulen, 1), (dx1 - dx0) // np.maximum(dlen, 1))
+        x_dis = np.minimum(np.minimum(np.abs(ux1 - dx0), np.abs(ux0 - dx1)), np.abs(ux0 + ux1 - dx0 - dx1) / 2)
+        u_in_row, d_in_row = col(ups, "in_row"), col(downs, "in_row")
+
+        fea = np.zeros((len(pairs), 32), dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fea[:, 1] = ((dt + db - ut - ub) / 2) / np.maximum(uh, dh)
+            fea[:, 21] = ux0 > dx1
+            fea[:, 22] = np.abs(uh - dh) / np.minimum(uh, dh)
+            fea[:, 23] = x_dis / np.maximum(w, 0.000001)
+            fea[:, 24] = (ulen - dlen) / np.maximum(ulen, dlen)
+        fea[:, 2] = col(downs, "page_number") - col(ups, "page_number")
+        fea[:, 28] = np.maximum(d_in_row, u_in_row)
+        fea[:, 29] = np.abs(d_in_row - u_in_row)
+
+        for n, (up, down) in enumerate(pairs):
+            uf, df = box_feas[id(up)], box_feas[id(down)]
+            tks_up, tks_down = uf["tks_up"], df["tks_down"]
+            tks_all = up["text"][-LEN:].strip() \
+                + (" " if re.match(r"[a-zA-Z0-9]+",
+                                   up["text"][-1] + down["text"][0]) else "") \
+                + down["text"][:LEN].strip()
+            tks_all = _tokenize_cached(tks_all).split()
+            lt_up, lt_down = up["layout_type"], down["layout_type"]
+            row = fea[n]
+            row[0] = up.get("R", -1) == down.get("R", -1)
+            row[3:8] = [lt_up == lt_down, lt_up == "text", lt_down == "text", lt_up == "table", lt_down == "table"]
+            row[8:10] = uf["u_flags"][:2]
+            row[10] = df["d_punct"]
+            row[11:14] = [uf["u_flags"][2], uf["u_flags"][3], uf["u_flags"][3]]
+            row[14] = uf["u_open"] and df["d_close"]
+            row[15:20] = [df["d_proj"], df["d_cap"], uf["u_cap"], uf["u_alnum"], df["d_num"]]
+            row[20] = uf["tail2"] is not None and df["tail2"] is not None and uf["tail2"] == df["tail2"]
+            row[25] = len(tks_all) - len(tks_up) - len(tks_down)
+            row[26] = len(tks_down) - len(tks_up)
+            row[27] = tks_down[-1] == tks_up[-1] if tks_down and tks_up else False
+            row[30] = df["d_noun"]
+            row[31] = uf["u_noun"]
         return fea
 
+    def _concat_candidate(self, up, down, concat_between_pages):
+        """Whether ``down`` may be concatenated to ``up``: None stops the scan below ``up``, False
+        skips ``down``, True leaves the decision to the layout or the up-down model."""
+        ydis = self._y_dis(up, down)
+        smpg = up["page_number"] == down["page_number"]
+        mh = self.mean_height[up["page_number"] - 1]
+        mw = self.mean_width[up["page_number"] - 1]
+        if smpg and ydis > mh * 4:
+            return None
+        if not smpg and ydis > mh * 16:
+            return None
+        if not concat_between_pages and down["page_number"] > up["page_number"]:
+            return None
+
+        if up.get("R", "") != down.get(
+                "R", "") and up["text"][-1] != "，":
+            return False
+
+        if re.match(r"[0-9]{2,3}/[0-9]{3}$", up["text"]) \
+                or re.match(r"[0-9]{2,3}/[0-9]{3}$", down["text"]) \
+                or not down["text"].strip():
+            return False
+
+        if not down["text"].strip() or not up["text"].strip():
+            return False
+
+        if up["x1"] < down["x0"] - 10 * \
+                mw or up["x0"] > down["x1"] + 10 * mw:
+            return False
+        return True
+
     @staticmethod
     def sort_X_by_page(arr, threashold):
         # sort using y1 first and then x1
@@ -238,17 +317,18 @@ class PdfParser:
         clmns = sorted([r for r in self.tb_cpns if re.match(
             r"table column$", r["label"])], key=lambda x: (x["pn"], x["layoutno"], x["x0"]))
         clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5)
+        rows_idx, headers_idx, spans_idx = BoxIndex(rows), BoxIndex(headers), BoxIndex(spans)
         for b in self.boxes:
             if b.get("layout_type", "") != "table":
                 continue
-            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3)
+            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3, index=rows_idx)
             if ii is not None:
                 b["R"] = ii
                 b["R_top"] = rows[ii]["top"]
                 b["R_bott"] = rows[ii]["bottom"]
 
             ii = Recognizer.find_overlapped_with_threashold(
-                b, headers, thr=0.3)
+                b, headers, thr=0.3, index=headers_idx)
             if ii is not None:
                 b["H_top"] = headers[ii]["top"]
                 b["H_bott"] = headers[ii]["bottom"]
@@ -262,7 +342,7 @@ class PdfParser:
                 b["C_left"] = clmns[ii]["x0"]
                 b["C_right"] = clmns[ii]["x1"]
 
-            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3)
+            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3, index=spans_idx)
             if ii is not None:
                 b["H_top"] = spans[ii]["top"]
                 b["H_bott"] = spans[ii]["bottom"]
@@ -289,9 +369,10 @@ class PdfParser:
         )
 
         # merge chars in the same rect
+        bxs_idx = BoxIndex(bxs)
         for c in Recognizer.sort_Y_firstly(
                 chars, self.mean_height[pagenum - 1] // 4):
-            ii = Recognizer.find_overlapped(c, bxs)
+            ii = Recognizer.find_overlapped(c, bxs, index=bxs_idx)
             if ii is None:
                 self.lefted_chars.append(c)
                 continue
@@ -466,6 +547,34 @@ class PdfParser:
         # concat between rows
         boxes = deepcopy(self.boxes)
         blocks = []
+        # model outputs by (id(up), id(down)) and text features by id(box), boxes stay alive in
+        # boxes or chunks until the end, so ids are not reused meanwhile
+        probs, box_feas = {}, {}
+
+        def concat_prob(up, down, dp):
+            if (id(up), id(down)) not in probs:
+                # score the candidate pairs of the next UPDOWN_CONCAT_WINDOW upper boxes at once,
+                # pairs the scan never gets to only cost their share of the batch
+                pairs = [(up, down)]
+                for q in range(dp - 1, min(dp - 1 + UPDOWN_CONCAT_WINDOW, len(boxes))):
+                    u = boxes[q]
+                    if not u["text"].strip():
+                        continue
+                    for r in range(q + 1, min(q + 13, len(boxes))):
+                        d = boxes[r]
+                        cand = self._concat_candidate(u, d, concat_between_pages)
+                        if cand is None:
+                            break
+                        if not cand or (id(u), id(d)) in probs or (u is up and d is down):
+                            continue
+                        # the layout decides text boxes close below each other, see dfs
+                        if r - q <= 5 and u.get("layout_type") == "text":
+                            continue
+                        pairs.append((u, d))
+                preds = self.updown_cnt_mdl.predict(xgb.DMatrix(self._updown_concat_matrix(pairs, box_feas)))
+                probs.update(zip([(id(u), id(d)) for u, d in pairs], preds))
+            return probs[(id(up), id(down))]
+
         while boxes:
             chunks = []
 
@@ -473,35 +582,11 @@ class PdfParser:
                 chunks.append(up)
                 i = dp
                 while i < min(dp + 12, len(boxes)):
-                    ydis = self._y_dis(up, boxes[i])
-                    smpg = up["page_number"] == boxes[i]["page_number"]
-                    mh = self.mean_height[up["page_number"] - 1]
-                    mw = self.mean_width[up["page_number"] - 1]
-                    if smpg and ydis > mh * 4:
-                        break
-                    if not smpg and ydis > mh * 16:
-                        break
                     down = boxes[i]
-                    if not concat_between_pages and down["page_number"] > up["page_number"]:
+                    cand = self._concat_candidate(up, down, concat_between_pages)
+                    if cand is None:
                         break
-
-                    if up.get("R", "") != down.get(
-                            "R", "") and up["text"][-1] != "，":
-                        i += 1
-                        continue
-
-                    if re.match(r"[0-9]{2,3}/[0-9]{3}$", up["text"]) \
-                            or re.match(r"[0-9]{2,3}/[0-9]{3}$", down["text"]) \
-                            or not down["text"].strip():
-                        i += 1
-                        continue
-
-                    if not down["text"].strip() or not up["text"].strip():
-                        i += 1
-                        continue
-
-                    if up["x1"] < down["x0"] - 10 * \
-                            mw or up["x0"] > down["x1"] + 10 * mw:
+                    if not cand:
                         i += 1
                         continue
 
@@ -514,9 +599,7 @@ class PdfParser:
                         i += 1
                         continue
 
-                    fea = self._updown_concat_features(up, down)
-                    if self.updown_cnt_mdl.predict(
-                            xgb.DMatrix([fea]))[0] <= 0.5:
+                    if concat_prob(up, down, dp) <= 0.5:
                         i += 1
                         continue
                     dfs(down, i + 1)
@@ -68,6 +68,10 @@ def structure_answer(conv, ans, message_id, session_id):
         conv.message = []
     if not conv.message or conv.message[-1].get("role", "") != "assistant":
         conv.message.append({"role": "assistant", "content": ans["answer"], "created_at": time.time(), "id": message_id})
+    elif ans.get("delta"):
+        # delta events only carry the newly generated text, the final event carries the whole answer
+        conv.message[-1]["content"] = conv.message[-1].get("content", "") + ans["answer"]
+        conv.message[-1]["created_at"] = time.time()
     else:
         conv.message[-1] = {"role": "assistant", "content": ans["answer"], "created_at": time.time(), "id": message_id}
     if conv.reference:
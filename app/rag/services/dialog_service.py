@@ -61,7 +61,7 @@ class DialogService(CommonService):
         return list(chats.dicts())
 
 
-def chat_solo(dialog, messages, stream=True):
+def chat_solo(dialog, messages, stream=True, delta=False):
     if llm_id2llm_type(dialog.llm_id) == "image2text":
         chat_mdl = LLMBundle(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
     else:
@@ -72,7 +72,11 @@ def chat_solo(dialog, messages, stream=True):
     if prompt_config.get("tts"):
         tts_mdl = LLMBundle(dialog.tenant_id, LLMType.TTS)
     msg = [{"role": m["role"], "content": re.sub(r"##\d+\$\$", "", m["content"])} for m in messages if m["role"] != "system"]
-    if stream:
+    if stream and delta:
+        for ans in stream_deltas(chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting), tts_mdl):
+            ans.update({"reference": {}, "prompt": "", "created_at": time.time()})
+            yield ans
+    elif stream:
         last_ans = ""
         for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
             answer = ans
@@ -90,10 +94,10 @@ def chat_solo(dialog, messages, stream=True):
         yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, answer), "prompt": "", "created_at": time.time()}
 
 
-def chat(dialog, messages, stream=True, **kwargs):
+def chat(dialog, messages, stream=True, delta=False, **kwargs):
     assert messages[-1]["role"] == "user", "The last content of this conversation is not from user."
     if not dialog.kb_ids:
-        for ans in chat_solo(dialog, messages, stream):
+        for ans in chat_solo(dialog, messages, stream, delta):
             yield ans
         return
 
@@ -346,7 +350,27 @@ def chat(dialog, messages, stream=True, **kwargs):
     if langfuse_tracer:
         langfuse_generation = langfuse_tracer.trace.generation(name="chat", model=llm_model_config["llm_name"], input={"prompt": prompt, "prompt4citation": prompt4citation, "messages": msg})
 
-    if stream:
+    if stream and delta:
+        answer = []
+
+        def answers():
+            for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
+                if thought:
+                    ans = re.sub(r"<think>.*</think>", "", ans, flags=re.DOTALL)
+                yield ans
+
+        if thought:
+            yield {"answer": thought, "reference": {}, "audio_binary": None, "delta": True, "tokens": num_tokens_from_string(thought)}
+        for ans in stream_deltas(answers(), tts_mdl):
+            if ans["delta"]:
+                answer.append(ans["answer"])
+            else:
+                answer = [ans["answer"]]
+                ans["answer"] = thought + ans["answer"]
+            ans["reference"] = {}
+            yield ans
+        yield decorate_answer(thought + "".join(answer))
+    elif stream:
         last_ans = ""
         answer = ""
         for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
@@ -484,10 +508,65 @@ Please write the SQL, only SQL, without any other explanations or text.
 def tts(tts_mdl, text):
     if not tts_mdl or not text:
         return
-    bin = b""
+    return binascii.hexlify(b"".join(tts_mdl.tts(text))).decode("utf-8")
+
+
+def tts_streamly(tts_mdl, text):
+    if not tts_mdl or not text:
+        return
     for chunk in tts_mdl.tts(text):
-        bin += chunk
-    return binascii.hexlify(bin).decode("utf-8")
+        if chunk:
+            yield binascii.hexlify(chunk).decode("utf-8")
+
+
+def stream_deltas(answers, tts_mdl=None, min_tokens=16):
+    """
+    Turn the cumulative answers of `chat_streamly` into incremental events.
+
+    Each event carries only the text added since the previous one (`answer`), flagged with
+    `delta: True`, plus the running token count of the whole answer (`tokens`). Tokens are
+    counted once per new piece, so the cost is linear in the answer length. Audio of every
+    delta is streamed chunk by chunk as separate events instead of being joined in memory.
+    Being a plain generator, the LLM and TTS streams are only pulled as fast as the client
+    consumes the events. If the upstream rewrites text that was already sent, the whole answer
+    goes out again with `delta: False` and replaces what the client has so far.
+    """
+    sent = ""
+    seen = 0
+    pending = 0
+    tokens = 0
+    ans = ""
+    for ans in answers:
+        if not ans.startswith(sent):
+            # the upstream rewrote already streamed text, e.g. dropped a <think> block; the client
+            # can't take back what it got, so it gets the whole answer in a non-delta event instead
+            sent, seen, pending = ans, len(ans), 0
+            tokens = num_tokens_from_string(ans)
+            yield {"answer": ans, "audio_binary": None, "delta": False, "tokens": tokens}
+            continue
+        if len(ans) < seen:
+            # only text that was not sent yet is gone, count what is left of it again
+            seen = len(sent)
+            pending = num_tokens_from_string(ans[seen:])
+        else:
+            pending += num_tokens_from_string(ans[seen:])
+        seen = len(ans)
+        if pending < min_tokens:
+            continue
+        tokens += pending
+        pending = 0
+        delta_ans = ans[len(sent):]
+        sent = ans
+        yield {"answer": delta_ans, "audio_binary": None, "delta": True, "tokens": tokens}
+        for audio in tts_streamly(tts_mdl, delta_ans):
+            yield {"answer": "", "audio_binary": audio, "delta": True, "tokens": tokens}
+
+    delta_ans = ans[len(sent):]
+    if delta_ans:
+        tokens += pending
+        yield {"answer": delta_ans, "audio_binary": None, "delta": True, "tokens": tokens}
+        for audio in tts_streamly(tts_mdl, delta_ans):
+            yield {"answer": "", "audio_binary": audio, "delta": True, "tokens": tokens}
 
 
 def ask(question, kb_ids, tenant_id):
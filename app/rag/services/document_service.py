@@ -15,12 +15,16 @@
 #
 import json
 import logging
+import multiprocessing
+import os
+import queue
 import random
 import re
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from io import BytesIO
+from timeit import default_timer as timer
 
 import trio
 import xxhash
@@ -484,14 +488,62 @@ def queue_raptor_o_graphrag_tasks(doc, ty, priority):
     assert REDIS_CONN.queue_product(get_svr_queue_name(priority), message=task), "Can't access Redis. Please check the Redis' status."
 
 
-def doc_upload_and_parse(conversation_id, file_objs, user_id):
+def _dummy_callback(prog=None, msg=""):
+    pass
+
+
+def _chunk_document(parser_id, name, blob, kwargs):
+    from rag.app import audio, email, naive, picture, presentation
+
+    FACTORY = {
+        ParserType.PRESENTATION.value: presentation,
+        ParserType.PICTURE.value: picture,
+        ParserType.AUDIO.value: audio,
+        ParserType.EMAIL.value: email
+    }
+    return FACTORY.get(parser_id, naive).chunk(name, blob, callback=_dummy_callback, **kwargs)
+
+
+def _mind_map(llm_bdl, doc_id, kb_id, doc_name, contents):
+    from graphrag.general.mind_map_extractor import MindMapExtractor
+    mindmap = MindMapExtractor(llm_bdl)
+    mind_map = trio.run(mindmap, contents)
+    mind_map = json.dumps(mind_map.output, ensure_ascii=False, indent=2)
+    if len(mind_map) < 32:
+        raise Exception("Few content: " + mind_map)
+    return {
+        "id": get_uuid(),
+        "doc_id": doc_id,
+        "kb_id": [kb_id],
+        "docnm_kwd": doc_name,
+        "title_tks": rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", doc_name)),
+        "content_ltks": rag_tokenizer.tokenize("summary summarize 总结 概况 file 文件 概括"),
+        "content_with_weight": mind_map,
+        "knowledge_graph_kwd": "mind_map"
+    }
+
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 4))
+DOC_BULK_BYTES = int(os.environ.get("DOC_BULK_BYTES", 8 * 1024 * 1024))
+
+
+def doc_upload_and_parse(conversation_id, file_objs, user_id, timings=None):
+    """
+    Upload files to the knowledge base of a conversation and index them right away.
+
+    The work runs as a pipeline of stages connected by bounded queues: files are parsed in worker
+    processes, chunks of each finished file are embedded by several threads while the other files
+    are still parsing, a single writer bulk indexes them in batches sized by payload bytes, and mind
+    maps are generated concurrently next to the embedding. Time spent in each stage, summed over the
+    threads running it, is added to ``timings`` (seconds) when a dict is given, and logged.
+    """
     from api.db.services.api_service import API4ConversationService
     from api.db.services.conversation_service import ConversationService
     from api.db.services.dialog_service import DialogService
     from api.db.services.file_service import FileService
     from api.db.services.llm_service import LLMBundle
     from api.db.services.user_service import TenantService
-    from rag.app import audio, email, naive, picture, presentation
 
     e, conv = ConversationService.get_by_id(conversation_id)
     if not e:
@@ -512,40 +564,85 @@ def doc_upload_and_parse(conversation_id, file_objs, user_id):
     err, files = FileService.upload_document(kb, file_objs, user_id)
     assert not err, "\n".join(err)
 
-    def dummy(prog=None, msg=""):
-        pass
+    timings = timings if timings is not None else {}
+    for stage in ["parse", "embed", "index", "mind_map"]:
+        timings.setdefault(stage, 0.0)
+    lock = threading.Lock()
+
+    def record(stage, start):
+        with lock:
+            timings[stage] += timer() - start
 
-    FACTORY = {
-        ParserType.PRESENTATION.value: presentation,
-        ParserType.PICTURE.value: picture,
-        ParserType.AUDIO.value: audio,
-        ParserType.EMAIL.value: email
-    }
     parser_config = {"chunk_token_num": 4096, "delimiter": "\n!?;。；！？", "layout_recognize": "Plain Text"}
-    exe = ThreadPoolExecutor(max_workers=12)
-    threads = []
-    doc_nm = {}
-    for d, blob in files:
-        doc_nm[d["id"]] = d["name"]
-    for d, blob in files:
-        kwargs = {
-            "callback": dummy,
-            "parser_config": parser_config,
-            "from_page": 0,
-            "to_page": 100000,
-            "tenant_id": kb.tenant_id,
-            "lang": kb.language
-        }
-        threads.append(exe.submit(FACTORY.get(d["parser_id"], naive).chunk, d["name"], blob, **kwargs))
+    doc_nm = {d["id"]: d["name"] for d, _ in files}
+    parser_ids = {d["id"]: d["parser_id"] for d, _ in files}
+    docids = [d["id"] for d, _ in files]
+    chunk_counts = {id: 0 for id in docids}
+    token_counts = {id: 0 for id in docids}
+    idxnm = search.index_name(kb.tenant_id)
+    errors = []
 
-    for (docinfo, _), th in zip(files, threads):
+    embed_queue = queue.Queue(maxsize=EMBEDDING_WORKERS * 4)
+    index_queue = queue.Queue(maxsize=EMBEDDING_WORKERS * 4)
+
+    def embedder():
+        while True:
+            cks = embed_queue.get()
+            if cks is None:
+                return
+            if errors:
+                continue
+            try:
+                st = timer()
+                vts, c = embd_mdl.encode([ck["content_with_weight"] for ck in cks])
+                for ck, v in zip(cks, vts.tolist()):
+                    ck["q_%d_vec" % len(v)] = v
+                with lock:
+                    chunk_counts[cks[0]["doc_id"]] += len(cks)
+                    token_counts[cks[0]["doc_id"]] += c
+                record("embed", st)
+                index_queue.put(cks)
+            except Exception as e:
+                errors.append(e)
+
+    def indexer():
+        batch, size = [], 0
+        try_create_idx = True
+
+        def flush():
+            nonlocal batch, size, try_create_idx
+            if not batch or errors:
+                batch, size = [], 0
+                return
+            st = timer()
+            if try_create_idx:
+                dim = len(next(v for k, v in batch[0].items() if k.startswith("q_") and k.endswith("_vec")))
+                if not settings.docStoreConn.indexExist(idxnm, kb_id):
+                    settings.docStoreConn.createIdx(idxnm, kb_id, dim)
+                try_create_idx = False
+            settings.docStoreConn.insert(batch, idxnm, kb_id)
+            batch, size = [], 0
+            record("index", st)
+
+        while True:
+            cks = index_queue.get()
+            try:
+                if cks is None:
+                    flush()
+                    return
+                for ck in cks:
+                    batch.append(ck)
+                    size += len(json.dumps(ck, ensure_ascii=False))
+                    if size >= DOC_BULK_BYTES:
+                        flush()
+            except Exception as e:
+                errors.append(e)
+                batch, size = [], 0
+
+    def build_chunks(docinfo, chunks):
         docs = []
-        doc = {
-            "doc_id": docinfo["id"],
-            "kb_id": [kb.id]
-        }
-        for ck in th.result():
-            d = deepcopy(doc)
+        for ck in chunks:
+            d = {"doc_id": docinfo["id"], "kb_id": [kb.id]}
             d.update(ck)
             d["id"] = xxhash.xxh64((ck["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
             d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
@@ -564,64 +661,73 @@ def doc_upload_and_parse(conversation_id, file_objs, user_id):
             d["img_id"] = "{}-{}".format(kb.id, d["id"])
             d.pop("image", None)
             docs.append(d)
-
-    parser_ids = {d["id"]: d["parser_id"] for d, _ in files}
-    docids = [d["id"] for d, _ in files]
-    chunk_counts = {id: 0 for id in docids}
-    token_counts = {id: 0 for id in docids}
-    es_bulk_size = 64
-
-    def embedding(doc_id, cnts, batch_size=16):
-        nonlocal embd_mdl, chunk_counts, token_counts
-        vects = []
-        for i in range(0, len(cnts), batch_size):
-            vts, c = embd_mdl.encode(cnts[i: i + batch_size])
-            vects.extend(vts.tolist())
-            chunk_counts[doc_id] += len(cnts[i:i + batch_size])
-            token_counts[doc_id] += c
-        return vects
-
-    idxnm = search.index_name(kb.tenant_id)
-    try_create_idx = True
+        return docs
 
     _, tenant = TenantService.get_by_id(kb.tenant_id)
     llm_bdl = LLMBundle(kb.tenant_id, LLMType.CHAT, tenant.llm_id)
-    for doc_id in docids:
-        cks = [c for c in docs if c["doc_id"] == doc_id]
 
-        if parser_ids[doc_id] != ParserType.PICTURE.value:
-            from graphrag.general.mind_map_extractor import MindMapExtractor
-            mindmap = MindMapExtractor(llm_bdl)
+    def mind_map(docinfo, contents):
+        st = timer()
+        try:
+            return _mind_map(llm_bdl, docinfo["id"], kb.id, doc_nm[docinfo["id"]], contents)
+        finally:
+            record("mind_map", st)
+
+    kwargs = {
+        "parser_config": parser_config,
+        "from_page": 0,
+        "to_page": 100000,
+        "tenant_id": kb.tenant_id,
+        "lang": kb.language
+    }
+    # spawned, not forked: this runs inside a threaded server, where forking can deadlock
+    parse_exe = ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1) or 1,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    st = timer()
+    parsing = {parse_exe.submit(_chunk_document, d["parser_id"], d["name"], blob, kwargs): d for d, blob in files}
+
+    embedders = [threading.Thread(target=embedder, daemon=True) for _ in range(EMBEDDING_WORKERS)]
+    writer = threading.Thread(target=indexer, daemon=True)
+    for th in embedders + [writer]:
+        th.start()
+
+    mind_map_exe = ThreadPoolExecutor(max_workers=4)
+    try:
+        mind_maps = []
+        for th in as_completed(parsing):
+            docinfo = parsing[th]
+            cks = build_chunks(docinfo, th.result())
+            record("parse", st)
+            for b in range(0, len(cks), EMBEDDING_BATCH_SIZE):
+                embed_queue.put(cks[b:b + EMBEDDING_BATCH_SIZE])
+            if parser_ids[docinfo["id"]] != ParserType.PICTURE.value:
+                mind_maps.append(mind_map_exe.submit(mind_map, docinfo, [c["content_with_weight"] for c in cks]))
+            # time blocked on a full embedding queue is not parsing
+            st = timer()
+
+        for th in as_completed(mind_maps):
             try:
-                mind_map = trio.run(mindmap, [c["content_with_weight"] for c in docs if c["doc_id"] == doc_id])
-                mind_map = json.dumps(mind_map.output, ensure_ascii=False, indent=2)
-                if len(mind_map) < 32:
-                    raise Exception("Few content: " + mind_map)
-                cks.append({
-                    "id": get_uuid(),
-                    "doc_id": doc_id,
-                    "kb_id": [kb.id],
-                    "docnm_kwd": doc_nm[doc_id],
-                    "title_tks": rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", doc_nm[doc_id])),
-                    "content_ltks": rag_tokenizer.tokenize("summary summarize 总结 概况 file 文件 概括"),
-                    "content_with_weight": mind_map,
-                    "knowledge_graph_kwd": "mind_map"
-                })
-            except Exception as e:
+                ck = th.result()
+            except Exception:
                 logging.exception("Mind map generation error")
+                continue
+            embed_queue.put([ck])
+    finally:
+        parse_exe.shutdown(wait=False, cancel_futures=True)
+        mind_map_exe.shutdown(wait=False, cancel_futures=True)
+        for _ in embedders:
+            embed_queue.put(None)
+        for th in embedders:
+            th.join()
+        index_queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+    logging.info("doc_upload_and_parse {} files, stage timings: {}".format(
+        len(files), ", ".join("{}: {:.2f}s".format(k, v) for k, v in timings.items())))
 
-        vects = embedding(doc_id, [c["content_with_weight"] for c in cks])
-        assert len(cks) == len(vects)
-        for i, d in enumerate(cks):
-            v = vects[i]
-            d["q_%d_vec" % len(v)] = v
-        for b in range(0, len(cks), es_bulk_size):
-            if try_create_idx:
-                if not settings.docStoreConn.indexExist(idxnm, kb_id):
-                    settings.docStoreConn.createIdx(idxnm, kb_id, len(vects[0]))
-                try_create_idx = False
-            settings.docStoreConn.insert(cks[b:b + es_bulk_size], idxnm, kb_id)
-
+    for doc_id in docids:
         DocumentService.increment_chunk_num(
             doc_id, kb.id, token_counts[doc_id], chunk_counts[doc_id], 0)
 
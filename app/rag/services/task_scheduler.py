@@ -0,0 +1,342 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntEnum
+
+
+class TaskPriority(IntEnum):
+    """Priority classes of parsing tasks, higher values are always served first."""
+
+    BULK = 0
+    INTERACTIVE = 1
+
+
+class InMemoryTaskQueue:
+    """Process local task queue, one FIFO per (priority, tenant).
+
+    Meant for tests and single process deployments that run without Redis.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = defaultdict(lambda: defaultdict(deque))
+
+    def push(self, priority: int, tenant_id: str, message: dict):
+        with self._lock:
+            self._queues[priority][tenant_id].append(message)
+
+    def tenants(self, priority: int) -> list[str]:
+        with self._lock:
+            return [t for t, q in self._queues[priority].items() if q]
+
+    def pop(self, priority: int, tenant_id: str):
+        with self._lock:
+            q = self._queues[priority].get(tenant_id)
+            if not q:
+                return None
+            message = q.popleft()
+            if not q:
+                del self._queues[priority][tenant_id]
+            return message
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(q) for tenants in self._queues.values() for q in tenants.values())
+
+
+class SQLiteTaskQueue:
+    """Persistent task queue stored in a single SQLite file.
+
+    Survives restarts of the worker process, which the in-memory queue does not.
+    Use ``":memory:"`` as path to get a throwaway database.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS task_queue ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, priority INTEGER NOT NULL, "
+            "tenant_id TEXT NOT NULL, message TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS task_queue_head ON task_queue (priority, tenant_id, seq)")
+
+    def push(self, priority: int, tenant_id: str, message: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO task_queue (priority, tenant_id, message) VALUES (?, ?, ?)",
+                (priority, tenant_id, json.dumps(message, ensure_ascii=False)),
+            )
+
+    def tenants(self, priority: int) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT tenant_id FROM task_queue WHERE priority = ?", (priority,))
+            return [r[0] for r in rows]
+
+    def pop(self, priority: int, tenant_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT seq, message FROM task_queue WHERE priority = ? AND tenant_id = ? ORDER BY seq LIMIT 1",
+                (priority, tenant_id),
+            ).fetchone()
+            if not row:
+                return None
+            self._conn.execute("DELETE FROM task_queue WHERE seq = ?", (row[0],))
+            return json.loads(row[1])
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM task_queue").fetchone()[0]
+
+
+class AdaptiveTaskSizer:
+    """Chooses how many pages (or rows) go into one task from the measured cost per page.
+
+    Costs are tracked per parser as an exponential moving average of seconds per page. Task
+    sizes aim at ``target_seconds`` per task and stay within ``[default / 4, default * 4]`` so a
+    single outlier can't produce degenerate splits.
+    """
+
+    def __init__(self, target_seconds: float = 60.0, alpha: float = 0.2):
+        self.target_seconds = target_seconds
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._cost = {}
+
+    def record(self, key: str, pages: int, seconds: float):
+        if pages <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            cost = seconds / pages
+            prev = self._cost.get(key)
+            self._cost[key] = cost if prev is None else self.alpha * cost + (1 - self.alpha) * prev
+
+    def cost(self, key: str, default: float = 1.0) -> float:
+        with self._lock:
+            return self._cost.get(key, default)
+
+    def page_size(self, key: str, default: int) -> int:
+        with self._lock:
+            cost = self._cost.get(key)
+        if not cost:
+            return default
+        size = int(self.target_seconds / cost)
+        return max(max(1, default // 4), min(size, default * 4))
+
+
+class WeightedFairScheduler:
+    """Strict priority between classes, start-time fair queueing between tenants within a class.
+
+    Every tenant keeps a virtual finish tag that grows by ``cost / weight`` for each task it gets
+    dispatched, and the tenant with the smallest start tag goes next. A tenant with a 10k-page
+    backlog therefore only gets its weighted share of the workers, while a tenant that shows up
+    with a small upload is served right away.
+    """
+
+    def __init__(self, queue=None, sizer: AdaptiveTaskSizer = None, weights: dict = None):
+        self.queue = queue if queue is not None else InMemoryTaskQueue()
+        self.sizer = sizer if sizer is not None else AdaptiveTaskSizer()
+        self.weights = weights or {}
+        self._lock = threading.Lock()
+        self._vtime = defaultdict(float)
+        self._finish = defaultdict(dict)
+        self._ready = threading.Condition(self._lock)
+
+    def put(self, task: dict, priority: int, tenant_id: str, cost_key: str = ""):
+        self.queue.push(int(priority), tenant_id, {"task": task, "tenant_id": tenant_id, "cost_key": cost_key})
+        with self._ready:
+            self._ready.notify()
+
+    def _cost(self, message: dict) -> float:
+        task = message["task"]
+        pages = int(task.get("to_page", 1)) - int(task.get("from_page", 0))
+        if pages <= 0 or pages >= 10 ** 6:
+            pages = 1
+        return pages * self.sizer.cost(message["cost_key"])
+
+    def get(self, timeout: float = None):
+        """Dequeue the next message, or return None if nothing arrived within ``timeout`` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            while True:
+                for priority in sorted([int(p) for p in TaskPriority], reverse=True):
+                    tenants = self.queue.tenants(priority)
+                    if not tenants:
+                        continue
+                    vtime = self._vtime[priority]
+                    finish = self._finish[priority]
+                    tenant_id = min(tenants, key=lambda t: (max(vtime, finish.get(t, 0.0)), t))
+                    message = self.queue.pop(priority, tenant_id)
+                    if message is None:
+                        continue
+                    start = max(vtime, finish.get(tenant_id, 0.0))
+                    finish[tenant_id] = start + self._cost(message) / self.weights.get(tenant_id, 1.0)
+                    self._vtime[priority] = start
+                    return message
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._ready.wait(remaining)
+
+    def __len__(self):
+        return len(self.queue)
+
+
+class TaskWorkerPool:
+    """Runs scheduled tasks on a pool of worker processes.
+
+    ``handler`` is called with the task dict inside a worker process, so it has to be a picklable
+    module level function. A dispatcher thread keeps at most ``max_workers`` tasks in flight and
+    asks the scheduler for the next one whenever a worker frees up, which keeps the priority and
+    fairness decisions as late as possible. Measured durations are fed back to the sizer.
+    ``preload`` names resources (see app.rag.utils.resources) the workers need. With the fork start
+    method they are created before the workers are forked, so all workers share one copy; with
+    spawn every worker loads them once when it starts instead of on its first task.
+    ``mp_context`` is passed on to the executor; use a ``spawn`` context when starting the pool
+    from a threaded server.
+    """
+
+    def __init__(self, handler, scheduler: WeightedFairScheduler = None, max_workers: int = None,
+                 preload: list = None, mp_context=None):
+        self.handler = handler
+        self.preload = preload
+        self.mp_context = mp_context
+        self.scheduler = scheduler if scheduler is not None else WeightedFairScheduler()
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._slots = threading.Semaphore(self.max_workers)
+        self._stop = threading.Event()
+        self._executor = None
+        self._dispatcher = None
+
+    def start(self):
+        if self._dispatcher:
+            return self
+        self._stop.clear()
+        initializer, initargs = None, ()
+        if self.preload:
+            if (self.mp_context or multiprocessing.get_context()).get_start_method() == "fork":
+                from app.rag.utils.resources import RESOURCES
+                RESOURCES.preload(self.preload)
+            else:
+                initializer, initargs = _preload_worker, (list(self.preload),)
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context,
+                                             initializer=initializer, initargs=initargs)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="task-dispatcher", daemon=True)
+        self._dispatcher.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        if self._dispatcher:
+            self._dispatcher.join()
+            self._dispatcher = None
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            if not self._slots.acquire(timeout=0.5):
+                continue
+            message = self.scheduler.get(timeout=0.5)
+            if message is None:
+                self._slots.release()
+                continue
+            start = time.perf_counter()
+            try:
+                future = self._executor.submit(self.handler, message["task"])
+            except Exception:
+                logging.exception("Failed to submit task {}".format(message["task"].get("id")))
+                self._slots.release()
+                continue
+            future.add_done_callback(lambda f, m=message, s=start: self._done(f, m, s))
+
+    def _done(self, future, message, start):
+        self._slots.release()
+        task = message["task"]
+        if future.exception():
+            logging.error("Task {} failed: {}".format(task.get("id"), future.exception()))
+            return
+        pages = int(task.get("to_page", 0)) - int(task.get("from_page", 0))
+        if message["cost_key"] and 0 < pages < 10 ** 6:
+            self.scheduler.sizer.record(message["cost_key"], pages, time.perf_counter() - start)
+
+
+def _preload_worker(names: list):
+    from app.rag.utils.resources import RESOURCES
+    RESOURCES.preload(names)
+
+
+def run_task(task: dict):
+    """Worker process entry of the local backends, hands the task to the ``TASK_HANDLER`` function.
+
+    ``TASK_HANDLER`` is a ``"module:function"`` path resolved inside the worker, the function gets
+    the same task message the task executors read from Redis.
+    """
+    module_name, _, func_name = os.environ["TASK_HANDLER"].partition(":")
+    return getattr(importlib.import_module(module_name), func_name)(task)
+
+
+TASK_SIZER = AdaptiveTaskSizer()
+_TASK_SCHEDULER = None
+_TASK_WORKER_POOL = None
+
+
+def get_task_scheduler():
+    """Return the local scheduler selected by ``TASK_QUEUE_BACKEND``.
+
+    ``redis`` (the default) returns None and tasks keep going to the Redis queues consumed by the
+    task executors. ``memory`` and ``sqlite`` (file from ``TASK_QUEUE_PATH``) keep them local, and
+    the first call also starts the ``TaskWorkerPool`` that consumes them: ``TASK_WORKERS``
+    processes running ``TASK_HANDLER`` (see ``run_task``). Their measured durations feed
+    ``TASK_SIZER``, which ``queue_tasks`` asks for the task size. The workers are spawned, since
+    this runs inside the server, and each loads the resources in ``TASK_PRELOAD_RESOURCES`` (same
+    format as ``RAG_PRELOAD_RESOURCES``) when it starts.
+    """
+    global _TASK_SCHEDULER, _TASK_WORKER_POOL
+    backend = os.environ.get("TASK_QUEUE_BACKEND", "redis").lower()
+    if backend == "redis":
+        return None
+    if _TASK_SCHEDULER is None:
+        if backend == "sqlite":
+            queue = SQLiteTaskQueue(os.environ.get("TASK_QUEUE_PATH", "task_queue.sqlite3"))
+        elif backend == "memory":
+            queue = InMemoryTaskQueue()
+        else:
+            raise ValueError(f"Unsupported task queue backend: {backend}")
+        if not os.environ.get("TASK_HANDLER"):
+            raise ValueError(f"TASK_HANDLER must be set to consume tasks with the {backend} task queue backend")
+        preload = None
+        if os.environ.get("TASK_PRELOAD_RESOURCES"):
+            from app.rag.utils.resources import resources_from_env
+            preload = resources_from_env("TASK_PRELOAD_RESOURCES")
+        scheduler = WeightedFairScheduler(queue, TASK_SIZER)
+        _TASK_WORKER_POOL = TaskWorkerPool(
+            run_task, scheduler, max_workers=int(os.environ.get("TASK_WORKERS", 0)) or None,
+            preload=preload, mp_context=multiprocessing.get_context("spawn"),
+        ).start()
+        _TASK_SCHEDULER = scheduler
+    return _TASK_SCHEDULER
@@ -26,6 +26,7 @@ from api.db import StatusEnum, FileType, TaskStatus
 from api.db.db_models import Task, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
+from api.db.services.task_scheduler import TASK_SIZER, get_task_scheduler
 from api.utils import current_timestamp, get_uuid
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
 from rag.settings import get_svr_queue_name
@@ -152,6 +153,7 @@ class TaskService(CommonService):
         fields = [
             cls.model.id,
             cls.model.from_page,
+            cls.model.to_page,
             cls.model.progress,
             cls.model.digest,
             cls.model.chunk_ids,
@@ -308,19 +310,28 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
         - For Excel documents, tasks are created per row range
         - Task digests are calculated for optimization and reuse
         - Previous task chunks may be reused if available
+        - Unless ``task_page_size`` is configured, task sizes adapt to the measured cost per page;
+          documents that were split before keep their previous split so chunks stay reusable
+        - With a local task queue backend, tasks are scheduled per tenant instead of going to Redis
     """
     def new_task():
         return {"id": get_uuid(), "doc_id": doc["id"], "progress": 0.0, "from_page": 0, "to_page": 100000000}
 
+    def task_size(default):
+        if doc["parser_config"].get("task_page_size"):
+            return doc["parser_config"]["task_page_size"]
+        if prev_tasks and len(prev_tasks) > 1:
+            return max(int(t["to_page"]) - int(t["from_page"]) for t in prev_tasks)
+        return TASK_SIZER.page_size(doc["parser_id"], default)
+
     parse_task_array = []
+    prev_tasks = TaskService.get_tasks(doc["id"])
 
     if doc["type"] == FileType.PDF.value:
         file_bin = STORAGE_IMPL.get(bucket, name)
         do_layout = doc["parser_config"].get("layout_recognize", "DeepDOC")
         pages = PdfParser.total_page_number(doc["name"], file_bin)
-        page_size = doc["parser_config"].get("task_page_size", 12)
-        if doc["parser_id"] == "paper":
-            page_size = doc["parser_config"].get("task_page_size", 22)
+        page_size = task_size(22 if doc["parser_id"] == "paper" else 12)
         if doc["parser_id"] in ["one", "knowledge_graph"] or do_layout != "DeepDOC":
             page_size = 10 ** 9
         page_ranges = doc["parser_config"].get("pages") or [(1, 10 ** 5)]
@@ -337,10 +348,11 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
     elif doc["parser_id"] == "table":
         file_bin = STORAGE_IMPL.get(bucket, name)
         rn = RAGFlowExcelParser.row_number(doc["name"], file_bin)
-        for i in range(0, rn, 3000):
+        row_size = task_size(3000)
+        for i in range(0, rn, row_size):
             task = new_task()
             task["from_page"] = i
-            task["to_page"] = min(i + 3000, rn)
+            task["to_page"] = min(i + row_size, rn)
             parse_task_array.append(task)
     else:
         parse_task_array.append(new_task())
@@ -361,7 +373,6 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
         task["progress"] = 0.0
         task["priority"] = priority
 
-    prev_tasks = TaskService.get_tasks(doc["id"])
     ck_num = 0
     if prev_tasks:
         for task in parse_task_array:
@@ -380,7 +391,11 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
     DocumentService.begin2parse(doc["id"])
 
     unfinished_task_array = [task for task in parse_task_array if task["progress"] < 1.0]
+    scheduler = get_task_scheduler()
     for unfinished_task in unfinished_task_array:
+        if scheduler:
+            scheduler.put(unfinished_task, priority, chunking_config["tenant_id"], doc["parser_id"])
+            continue
         assert REDIS_CONN.queue_product(
             get_svr_queue_name(priority), message=unfinished_task
         ), "Can't access Redis. Please check the Redis' status."
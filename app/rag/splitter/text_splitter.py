@@ -15,6 +15,10 @@ from app.rag.nlp import concat_img, find_codec, naive_merge, naive_merge_docx, r
     tokenize_chunks_docx, tokenize_table
 from app.rag.utils import num_tokens_from_string
 
+HEADING_STYLE_PATTERN = re.compile(r"Heading\s*(\d+)", re.I)
+HEADING_LEVEL_PATTERN = re.compile(r"(\d+)")
+DOC_EXTENSION_PATTERN = re.compile(r"\.[a-zA-Z]+$")
+
 
 class Docx(DocxParser):
     def __init__(self):
@@ -48,110 +52,50 @@ class Docx(DocxParser):
         line = re.sub(r"\u3000", " ", line).strip()
         return line
 
-    def __get_nearest_title(self, table_index, filename):
-        """Get the hierarchical title structure before the table"""
-        import re
-        from docx.text.paragraph import Paragraph
-
-        titles = []
-        blocks = []
+    def __build_title_index(self, filename):
+        """Walk the body once and record the heading hierarchy in front of every table.
 
-        # Get document name from filename parameter
-        doc_name = re.sub(r"\.[a-zA-Z]+$", "", filename)
-        if not doc_name:
-            doc_name = "Untitled Document"
+        A stack of (level, text) holds the nearest heading and, below it, the nearest heading of
+        every lower level, so each table just takes a copy of the stack as it passes.
+        """
+        from docx.text.paragraph import Paragraph
 
-        # Collect all document blocks while maintaining document order
+        doc_name = DOC_EXTENSION_PATTERN.sub("", filename) or "Untitled Document"
+        self.__doc_name = doc_name
+        self.__table_titles = []
+        stack = []
         try:
-            # Iterate through all paragraphs and tables in document order
-            for i, block in enumerate(self.doc._element.body):
-                if block.tag.endswith('p'):  # Paragraph
-                    p = Paragraph(block, self.doc)
-                    blocks.append(('p', i, p))
-                elif block.tag.endswith('tbl'):  # Table
-                    blocks.append(('t', i, None))  # Table object will be retrieved later
+            for block in self.doc._element.body:
+                if block.tag.endswith('tbl'):
+                    self.__table_titles.append(tuple(stack))
+                    continue
+                if not block.tag.endswith('p'):
+                    continue
+                p = Paragraph(block, self.doc)
+                if not p.style or not HEADING_STYLE_PATTERN.search(p.style.name):
+                    continue
+                level_match = HEADING_LEVEL_PATTERN.search(p.style.name)
+                if not level_match:
+                    continue
+                level = int(level_match.group(1))
+                if level > 7:  # Support up to 7 heading levels
+                    continue
+                title_text = p.text.strip()
+                if not title_text:  # Avoid empty titles
+                    continue
+                while stack and stack[-1][0] >= level:
+                    stack.pop()
+                stack.append((level, title_text))
         except Exception as e:
             logging.error(f"Error collecting blocks: {e}")
-            return ""
+            self.__table_titles = []
 
-        # Find the target table position
-        target_table_pos = -1
-        table_count = 0
-        for i, (block_type, pos, _) in enumerate(blocks):
-            if block_type == 't':
-                if table_count == table_index:
-                    target_table_pos = pos
-                    break
-                table_count += 1
-
-        if target_table_pos == -1:
-            return ""  # Target table not found
-
-        # Find the nearest heading paragraph in reverse order
-        nearest_title = None
-        for i in range(len(blocks) - 1, -1, -1):
-            block_type, pos, block = blocks[i]
-            if pos >= target_table_pos:  # Skip blocks after the table
-                continue
-
-            if block_type != 'p':
-                continue
-
-            if block.style and re.search(r"Heading\s*(\d+)", block.style.name, re.I):
-                try:
-                    level_match = re.search(r"(\d+)", block.style.name)
-                    if level_match:
-                        level = int(level_match.group(1))
-                        if level <= 7:  # Support up to 7 heading levels
-                            title_text = block.text.strip()
-                            if title_text:  # Avoid empty titles
-                                nearest_title = (level, title_text)
-                                break
-                except Exception as e:
-                    logging.error(f"Error parsing heading level: {e}")
-
-        if nearest_title:
-            # Add current title
-            titles.append(nearest_title)
-            current_level = nearest_title[0]
-
-            # Find all parent headings, allowing cross-level search
-            while current_level > 1:
-                found = False
-                for i in range(len(blocks) - 1, -1, -1):
-                    block_type, pos, block = blocks[i]
-                    if pos >= target_table_pos:  # Skip blocks after the table
-                        continue
-
-                    if block_type != 'p':
-                        continue
-
-                    if block.style and re.search(r"Heading\s*(\d+)", block.style.name, re.I):
-                        try:
-                            level_match = re.search(r"(\d+)", block.style.name)
-                            if level_match:
-                                level = int(level_match.group(1))
-                                # Find any heading with a higher level
-                                if level < current_level:
-                                    title_text = block.text.strip()
-                                    if title_text:  # Avoid empty titles
-                                        titles.append((level, title_text))
-                                        current_level = level
-                                        found = True
-                                        break
-                        except Exception as e:
-                            logging.error(f"Error parsing parent heading: {e}")
-
-                if not found:  # Break if no parent heading is found
-                    break
-
-            # Sort by level (ascending, from highest to lowest)
-            titles.sort(key=lambda x: x[0])
-            # Organize titles (from highest to lowest)
-            hierarchy = [doc_name] + [t[1] for t in titles]
-            return " > ".join(hierarchy)
-
-        return ""
+    def __get_nearest_title(self, table_index):
+        """Get the hierarchical title structure before the table"""
+        if table_index >= len(self.__table_titles) or not self.__table_titles[table_index]:
+            return ""
+        hierarchy = [self.__doc_name] + [t[1] for t in self.__table_titles[table_index]]
+        return " > ".join(hierarchy)
 
     def __call__(self, filename, binary=None, from_page=0, to_page=100000):
         self.doc = Document(
@@ -194,8 +138,9 @@ class Docx(DocxParser):
         new_line = [(line[0], reduce(concat_img, line[1]) if line[1] else None) for line in lines]
 
         tbls = []
+        self.__build_title_index(filename)
         for i, tb in enumerate(self.doc.tables):
-            title = self.__get_nearest_title(i, filename)
+            title = self.__get_nearest_title(i)
             html = "<table>"
             if title:
                 html += f"<caption>Table Location: {title}</caption>"
@@ -300,6 +245,8 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         This method apply the naive ways to chunk files.
         Successive text will be sliced into pieces using 'delimiter'.
         Next, these successive pieces are merge into chunks whose token number is no more than 'Max token number'.
+        Spreadsheets are read whole unless `from_row`/`to_row` are given, in the row numbering of
+        ExcelParser.row_number.
     """
 
     is_english = lang.lower() == "english"  # is_english(cks)
@@ -400,10 +347,12 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
     elif re.search(r"\.(csv|xlsx?)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
         excel_parser = ExcelParser()
+        # from_page/to_page default to a page cap, so only row-range tasks restrict the rows
+        from_row, to_row = kwargs.get("from_row", 0), kwargs.get("to_row")
         if parser_config.get("html4excel"):
-            sections = [(_, "") for _ in excel_parser.html(binary, 12) if _]
+            sections = [(_, "") for _ in excel_parser.html(binary, 12, from_row, to_row) if _]
         else:
-            sections = [(_, "") for _ in excel_parser(binary) if _]
+            sections = [(_, "") for _ in excel_parser(binary, from_row, to_row) if _]
 
     elif re.search(r"\.(txt|py|js|java|c|cpp|h|php|go|ts|sh|cs|kt|sql)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
@@ -1,9 +1,15 @@
 from __future__ import annotations
 
 import copy
+import functools
+import importlib.util
 import logging
+import multiprocessing
+import pickle
 import re
 from abc import ABC, abstractmethod
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
 from collections.abc import Callable, Collection, Iterable, Sequence, Set
 from dataclasses import dataclass
 from typing import (
@@ -22,22 +28,62 @@ logger = logging.getLogger(__name__)
 TS = TypeVar("TS", bound="TextSplitter")
 
 
+@functools.lru_cache(maxsize=256)
+def _separator_pattern(separator: str, keep_separator: bool) -> re.Pattern:
+    if keep_separator:
+        # The parentheses in the pattern keep the delimiters in the result.
+        return re.compile(f"({re.escape(separator)})")
+    return re.compile(separator)
+
+
 def _split_text_with_regex(text: str, separator: str, keep_separator: bool) -> list[str]:
     # Now that we have the separator, split the text
     if separator:
         if keep_separator:
-            # The parentheses in the pattern keep the delimiters in the result.
-            _splits = re.split(f"({re.escape(separator)})", text)
+            _splits = _separator_pattern(separator, True).split(text)
             splits = [_splits[i - 1] + _splits[i] for i in range(1, len(_splits), 2)]
             if len(_splits) % 2 != 0:
                 splits += _splits[-1:]
         else:
-            splits = re.split(separator, text)
+            splits = _separator_pattern(separator, False).split(text)
     else:
         splits = list(text)
     return [s for s in splits if (s not in {"", "\n"})]
 
 
+def _char_lengths(texts: list[str]) -> list[int]:
+    return [len(text) for text in texts]
+
+
+def _token_lengths(offsets_function: Callable[[str], list[int]], texts: list[str]) -> list[int]:
+    return [len(offsets_function(text)) for text in texts]
+
+
+def _locate_splits(text: str, splits: list[str]) -> list[int]:
+    """Start offset of every split in text, splits are in order and don't overlap."""
+    positions = []
+    cursor = 0
+    for split in splits:
+        position = text.find(split, cursor)
+        if position < 0:
+            position = cursor
+        positions.append(position)
+        cursor = position + len(split)
+    return positions
+
+
+_worker_splitter: Optional[TextSplitter] = None
+
+
+def _init_split_worker(splitter: TextSplitter) -> None:
+    global _worker_splitter
+    _worker_splitter = splitter
+
+
+def _split_in_worker(text: str) -> list[str]:
+    return _worker_splitter.split_text(text)
+
+
 class TextSplitter(BaseDocumentTransformer, ABC):
     """Interface for splitting text into chunks."""
 
@@ -45,7 +91,7 @@ class TextSplitter(BaseDocumentTransformer, ABC):
         self,
         chunk_size: int = 4000,
         chunk_overlap: int = 200,
-        length_function: Callable[[list[str]], list[int]] = lambda x: [len(x) for x in x],
+        length_function: Callable[[list[str]], list[int]] = _char_lengths,
         keep_separator: bool = False,
         add_start_index: bool = False,
     ) -> None:
@@ -67,6 +113,7 @@ class TextSplitter(BaseDocumentTransformer, ABC):
         self._length_function = length_function
         self._keep_separator = keep_separator
         self._add_start_index = add_start_index
+        self._separator_lengths: dict[str, int] = {}
 
     @abstractmethod
     def split_text(self, text: str) -> list[str]:
@@ -95,6 +142,29 @@ class TextSplitter(BaseDocumentTransformer, ABC):
             metadatas.append(doc.metadata or {})
         return self.create_documents(texts, metadatas=metadatas)
 
+    def split_texts(self, texts: list[str], max_workers: Optional[int] = None, chunksize: int = 16) -> list[list[str]]:
+        """Split many texts on a process pool, results are in the order of texts.
+
+        Falls back to splitting in this process for a single worker, a single text or a splitter
+        that can't be pickled (e.g. one built with a lambda length function).
+        """
+        if max_workers == 1 or len(texts) < 2:
+            return [self.split_text(text) for text in texts]
+        try:
+            pickle.dumps(self)
+        except Exception:
+            logger.warning("%s can't be pickled, splitting in process", type(self).__name__)
+            return [self.split_text(text) for text in texts]
+        # spawned, not forked, so callers with running threads can't deadlock the workers
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_split_worker, initargs=(self,),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            return list(pool.map(_split_in_worker, texts, chunksize=chunksize))
+
+    def _separator_length(self, separator: str) -> int:
+        if separator not in self._separator_lengths:
+            self._separator_lengths[separator] = self._length_function([separator])[0]
+        return self._separator_lengths[separator]
+
     def _join_docs(self, docs: list[str], separator: str) -> Optional[str]:
         text = separator.join(docs)
         text = text.strip()
@@ -106,37 +176,40 @@ class TextSplitter(BaseDocumentTransformer, ABC):
     def _merge_splits(self, splits: Iterable[str], separator: str, lengths: list[int]) -> list[str]:
         # We now want to combine these smaller pieces into medium size
         # chunks to send to the LLM.
-        separator_len = self._length_function([separator])[0]
+        # The current chunk is splits[start:end], its size comes from prefix sums of the
+        # precomputed lengths so nothing is measured again while the overlap window slides.
+        splits = list(splits)
+        separator_len = self._separator_length(separator)
+        prefix = [0]
+        for _len in lengths[: len(splits)]:
+            prefix.append(prefix[-1] + _len)
+
+        def window(start: int, end: int) -> int:
+            return prefix[end] - prefix[start] + (separator_len * (end - start - 1) if end > start else 0)
 
         docs = []
-        current_doc: list[str] = []
-        total = 0
-        index = 0
-        for d in splits:
-            _len = lengths[index]
-            if total + _len + (separator_len if len(current_doc) > 0 else 0) > self._chunk_size:
+        start = 0
+        for end in range(len(splits)):
+            _len = lengths[end]
+            total = window(start, end)
+            if total + _len + (separator_len if end > start else 0) > self._chunk_size:
                 if total > self._chunk_size:
                     logger.warning(
                         f"Created a chunk of size {total}, which is longer than the specified {self._chunk_size}"
                     )
-                if len(current_doc) > 0:
-                    doc = self._join_docs(current_doc, separator)
+                if end > start:
+                    doc = self._join_docs(splits[start:end], separator)
                     if doc is not None:
                         docs.append(doc)
                     # Keep on popping if:
                     # - we have a larger chunk than in the chunk overlap
                     # - or if we still have any chunks and the length is long
                     while total > self._chunk_overlap or (
-                        total + _len + (separator_len if len(current_doc) > 0 else 0) > self._chunk_size and total > 0
+                        total + _len + (separator_len if end > start else 0) > self._chunk_size and total > 0
                     ):
-                        total -= self._length_function([current_doc[0]])[0] + (
-                            separator_len if len(current_doc) > 1 else 0
-                        )
-                        current_doc = current_doc[1:]
-            current_doc.append(d)
-            total += _len + (separator_len if len(current_doc) > 1 else 0)
-            index += 1
-        doc = self._join_docs(current_doc, separator)
+                        start += 1
+                        total = window(start, end)
+        doc = self._join_docs(splits[start:], separator)
         if doc is not None:
             docs.append(doc)
         return docs
@@ -412,13 +485,54 @@ class RecursiveCharacterTextSplitter(TextSplitter):
         self,
         separators: Optional[list[str]] = None,
         keep_separator: bool = True,
+        token_offsets_function: Optional[Callable[[str], list[int]]] = None,
         **kwargs: Any,
     ) -> None:
-        """Create a new TextSplitter."""
+        """Create a new TextSplitter.
+
+        Args:
+            token_offsets_function: Returns the start offset of every token of a text. When set,
+                lengths are token counts, the text is tokenized once and the length of a split is
+                the number of tokens starting inside it.
+        """
+        if token_offsets_function is not None:
+            kwargs["length_function"] = functools.partial(_token_lengths, token_offsets_function)
         super().__init__(keep_separator=keep_separator, **kwargs)
         self._separators = separators or ["\n\n", "\n", " ", ""]
+        self._token_offsets_function = token_offsets_function
 
-    def _split_text(self, text: str, separators: list[str]) -> list[str]:
+    @classmethod
+    def from_tiktoken_offsets(
+        cls, encoding_name: str = "gpt2", model_name: Optional[str] = None, **kwargs: Any
+    ) -> RecursiveCharacterTextSplitter:
+        """Splitter measuring chunks in tiktoken tokens, tokenizing every text only once."""
+        # tiktoken is imported lazily by _tiktoken_encoding, only check here that it is installed
+        if importlib.util.find_spec("tiktoken") is None:
+            raise ImportError(
+                "Could not import tiktoken python package. "
+                "This is needed in order to calculate token offsets. "
+                "Please install it with `pip install tiktoken`."
+            )
+
+        return cls(
+            token_offsets_function=functools.partial(
+                _tiktoken_offsets, encoding_name if model_name is None else None, model_name
+            ),
+            **kwargs,
+        )
+
+    def _measure(self, text: str, splits: list[str], offset: int, token_starts: Optional[list[int]]):
+        if token_starts is None:
+            return self._length_function(splits), [0] * len(splits)
+        positions = [offset + p for p in _locate_splits(text, splits)]
+        lengths = [
+            bisect_left(token_starts, p + len(s)) - bisect_left(token_starts, p) for p, s in zip(positions, splits)
+        ]
+        return lengths, positions
+
+    def _split_text(
+        self, text: str, separators: list[str], offset: int = 0, token_starts: Optional[list[int]] = None
+    ) -> list[str]:
         final_chunks = []
         separator = separators[-1]
         new_separators = []
@@ -427,7 +541,7 @@ class RecursiveCharacterTextSplitter(TextSplitter):
             if _s == "":
                 separator = _s
                 break
-            if re.search(_s, text):
+            if _separator_pattern(_s, False).search(text):
                 separator = _s
                 new_separators = separators[i + 1 :]
                 break
@@ -436,8 +550,8 @@ class RecursiveCharacterTextSplitter(TextSplitter):
         _good_splits = []
         _good_splits_lengths = []  # cache the lengths of the splits
         _separator = "" if self._keep_separator else separator
-        s_lens = self._length_function(splits)
-        for s, s_len in zip(splits, s_lens):
+        s_lens, positions = self._measure(text, splits, offset, token_starts)
+        for s, s_len, position in zip(splits, s_lens, positions):
             if s_len < self._chunk_size:
                 _good_splits.append(s)
                 _good_splits_lengths.append(s_len)
@@ -450,7 +564,7 @@ class RecursiveCharacterTextSplitter(TextSplitter):
                 if not new_separators:
                     final_chunks.append(s)
                 else:
-                    other_info = self._split_text(s, new_separators)
+                    other_info = self._split_text(s, new_separators, position, token_starts)
                     final_chunks.extend(other_info)
 
         if _good_splits:
@@ -460,4 +574,20 @@ class RecursiveCharacterTextSplitter(TextSplitter):
         return final_chunks
 
     def split_text(self, text: str) -> list[str]:
-        return self._split_text(text, self._separators)
+        if self._token_offsets_function is None:
+            return self._split_text(text, self._separators)
+        return self._split_text(text, self._separators, 0, self._token_offsets_function(text))
+
+
+@functools.lru_cache(maxsize=8)
+def _tiktoken_encoding(encoding_name: Optional[str], model_name: Optional[str]):
+    import tiktoken
+
+    if model_name is not None:
+        return tiktoken.encoding_for_model(model_name)
+    return tiktoken.get_encoding(encoding_name)
+
+
+def _tiktoken_offsets(encoding_name: Optional[str], model_name: Optional[str], text: str) -> list[int]:
+    enc = _tiktoken_encoding(encoding_name, model_name)
+    return enc.decode_with_offsets(enc.encode(text, disallowed_special=()))[1]
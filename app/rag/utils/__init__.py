@@ -71,6 +71,15 @@ def num_tokens_from_string(string: str) -> int:
         return 0
 
 
+def num_tokens_from_strings(strings: list) -> list:
+    """Returns the number of tokens of every string, counted in one batch."""
+    try:
+        return [len(tks) for tks in encoder.encode_batch(strings)]
+    except Exception:
+        # one of the strings can't be encoded, count them one by one so only that one gets 0
+        return [num_tokens_from_string(s) for s in strings]
+
+
 def truncate(string: str, max_len: int) -> str:
     """Returns truncated text if the length of text exceed max_len."""
     return encoder.decode(encoder.encode(string)[:max_len])
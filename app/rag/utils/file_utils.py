@@ -1,4 +1,5 @@
 import base64
+import hashlib
 import json
 import os
 import re
@@ -17,6 +18,9 @@ from cachetools import LRUCache, cached
 PROJECT_BASE = os.getenv("RAG_PROJECT_BASE") or os.getenv("RAG_DEPLOY_BASE")
 RAG_BASE = os.getenv("RAG_BASE")
 
+DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 1024 * 1024
+
 LOCK_KEY_pdfplumber = "global_shared_lock_pdfplumber"
 if LOCK_KEY_pdfplumber not in sys.modules:
     sys.modules[LOCK_KEY_pdfplumber] = threading.Lock()
@@ -226,3 +230,52 @@ def traversal_files(base):
         for f in fs:
             fullname = os.path.join(root, f)
             yield fullname
+
+
+class FileTooLargeError(ValueError):
+    pass
+
+
+class HashingReader:
+    """
+    Wraps a binary stream, hashing what is read and failing as soon as more than `max_size`
+    bytes came through, so uploads can be checked without ever holding them in memory.
+    """
+
+    def __init__(self, stream, max_size=DOC_MAXIMUM_SIZE, algorithm="sha256"):
+        self.stream = stream
+        self.max_size = max_size
+        self.hasher = hashlib.new(algorithm)
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = STREAM_CHUNK_SIZE
+        data = self.stream.read(size)
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise FileTooLargeError(f"File exceeds the maximum size of {self.max_size} bytes")
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def copy_stream(reader, dst, chunk_size=STREAM_CHUNK_SIZE):
+    """Copy `reader` into the file object `dst` with a bounded buffer, returns the number of bytes."""
+    total = 0
+    while True:
+        data = reader.read(chunk_size)
+        if not data:
+            return total
+        dst.write(data)
+        total += len(data)
+
+
+def file_digest(path, algorithm="sha256", chunk_size=STREAM_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        reader = HashingReader(f, max_size=0, algorithm=algorithm)
+        while reader.read(chunk_size):
+            pass
+    return reader.hexdigest()
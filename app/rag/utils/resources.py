@@ -0,0 +1,137 @@
+import importlib
+import logging
+import os
+import threading
+import time
+
+# Heavy objects (dictionaries, ONNX / xgboost models) shared by everything in a process.
+# Factories are "module:attribute" strings so nothing is imported until a resource is used.
+DEFAULT_RESOURCES = {
+    "rag_tokenizer": "app.rag.nlp.rag_tokenizer:RagTokenizer",
+    "term_weight": "app.rag.nlp.term_weight:Dealer",
+    "synonym": "app.rag.nlp.synonym:Dealer",
+    "ocr": "app.rag.vision:OCR",
+    "layout_recognizer": "app.rag.vision:LayoutRecognizer",
+    "table_structure_recognizer": "app.rag.vision:TableStructureRecognizer",
+    "updown_concat_model": "app.rag.parser.pdf_parser:load_updown_concat_model",
+}
+# what preload() loads by default, "name:arg" passes arg to the factory
+PRELOAD_ALL = [
+    "rag_tokenizer",
+    "term_weight",
+    "synonym",
+    "ocr",
+    "layout_recognizer:layout",
+    "table_structure_recognizer",
+    "updown_concat_model",
+]
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except Exception:
+        return 0.0
+
+
+def _resolve(factory):
+    if not isinstance(factory, str):
+        return factory
+    module, attr = factory.split(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+class ResourceRegistry:
+    """Process wide, lazily created singletons.
+
+    ``get(name, *args)`` creates the resource on first use and returns the same instance to every
+    caller in the process afterwards, ``args`` are passed to the factory and are part of the key.
+    Resources created before a fork (see ``preload``) are inherited by the children, which share
+    their memory copy-on-write. Resources registered with ``fork_safe=False`` are dropped in the
+    child and created again there.
+    """
+
+    def __init__(self, factories: dict = None):
+        self._factories = {name: (factory, True) for name, factory in (factories or {}).items()}
+        self._instances = {}
+        self._stats = {}
+        self._lock = threading.RLock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        for key in list(self._instances):
+            if not self._factories.get(key[0], (None, True))[1]:
+                del self._instances[key]
+                self._stats.pop(key, None)
+
+    def register(self, name: str, factory, fork_safe: bool = True):
+        with self._lock:
+            self._factories[name] = (factory, fork_safe)
+
+    def get(self, name: str, *args):
+        key = (name, args)
+        instance = self._instances.get(key)
+        if instance is not None:
+            return instance
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance is not None:
+                return instance
+            if name not in self._factories:
+                raise KeyError(f"Unknown resource: {name}")
+            rss = _rss_mb()
+            start = time.perf_counter()
+            instance = _resolve(self._factories[name][0])(*args)
+            self._stats[key] = (time.perf_counter() - start, _rss_mb() - rss)
+            self._instances[key] = instance
+            logging.info("Loaded resource {} in {:.2f}s, RSS {:+.1f}MB".format(self._label(key), *self._stats[key]))
+            return instance
+
+    def loaded(self, name: str, *args) -> bool:
+        return (name, args) in self._instances
+
+    @staticmethod
+    def _label(key):
+        name, args = key
+        return f"{name}({', '.join(map(str, args))})" if args else name
+
+    def preload(self, names=None):
+        """Create the given resources (PRELOAD_ALL by default) now, typically in the parent process
+        before workers are forked. Failures are logged and skipped."""
+        for item in names if names is not None else PRELOAD_ALL:
+            name, *args = item.split(":") if isinstance(item, str) else item
+            try:
+                self.get(name, *args)
+            except Exception:
+                logging.exception(f"Fail to preload resource {item}")
+        logging.info(self.report())
+
+    def report(self) -> str:
+        lines = ["{:<40} {:>8} {:>10}".format("resource", "load(s)", "RSS(MB)")]
+        for key, (seconds, rss) in self._stats.items():
+            lines.append("{:<40} {:>8.2f} {:>+10.1f}".format(self._label(key), seconds, rss))
+        lines.append("{:<40} {:>8.2f} {:>10.1f}".format(
+            "total (process RSS)", sum(s for s, _ in self._stats.values()), _rss_mb()))
+        return "\n".join(lines)
+
+
+RESOURCES = ResourceRegistry(DEFAULT_RESOURCES)
+
+
+def resources_from_env(var: str) -> list:
+    """The comma separated resources in environment variable ``var`` ("all" for every one),
+    e.g. ``rag_tokenizer,term_weight,layout_recognizer:layout``."""
+    value = os.environ.get(var, "").strip()
+    if value == "all":
+        return list(PRELOAD_ALL)
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def preload_from_env():
+    """Preload the resources named in RAG_PRELOAD_RESOURCES, see resources_from_env."""
+    names = resources_from_env("RAG_PRELOAD_RESOURCES")
+    if names:
+        RESOURCES.preload(names)
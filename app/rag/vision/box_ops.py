@@ -0,0 +1,144 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+import numpy as np
+
+# rows of the suppression matrix computed at once, bounds memory to NMS_BLOCK x boxes
+NMS_BLOCK = 256
+# scalar types whose subtraction is one correctly rounded operation, see sort_clustered
+_SAME_ARITHMETIC = {float: 0, int: 0, np.float64: 0, np.float32: 1}
+
+
+def _suppression(x1, y1, x2, y2, areas, start, stop, iou_threshold, offset, inclusive):
+    """Rows [start, stop) of the suppression matrix over the boxes in score order, restricted to
+    columns >= start: entry (p, q) is True when box p suppresses box q."""
+    xx1 = np.maximum(x1[start:stop, None], x1[None, start:])
+    yy1 = np.maximum(y1[start:stop, None], y1[None, start:])
+    xx2 = np.minimum(x2[start:stop, None], x2[None, start:])
+    yy2 = np.minimum(y2[start:stop, None], y2[None, start:])
+    w = xx2 - xx1
+    h = yy2 - yy1
+    if offset:
+        w += offset
+        h += offset
+    overlaps = np.maximum(0, w) * np.maximum(0, h)
+    ious = overlaps / (areas[start:stop, None] + areas[None, start:] - overlaps)
+    # written as "not kept" so that NaN IoUs suppress, like the per box loops did
+    return ~(ious <= iou_threshold) if inclusive else ~(ious < iou_threshold)
+
+
+def greedy_nms(boxes, scores, iou_threshold, offset=0, inclusive=False):
+    """Greedy non maximum suppression over [x1, y1, x2, y2] boxes.
+
+    Keeps the indices (highest score first) the per box loop would keep: a box is dropped when
+    its IoU with a kept box is at or above ``iou_threshold`` (above it with ``inclusive``).
+    ``offset`` is added to the intersection width and height, 1 for pixel inclusive boxes.
+    IoUs are computed in blocks of rows with the same arithmetic as the loop, so the result
+    doesn't change, only the number of numpy calls does.
+    """
+    order = np.argsort(scores)[::-1]
+    ordered = boxes[order]
+    x1, y1, x2, y2 = ordered[:, 0], ordered[:, 1], ordered[:, 2], ordered[:, 3]
+    areas = (y2 - y1) * (x2 - x1)
+    n = len(order)
+    suppressed = np.zeros(n, dtype=bool)
+    keep = []
+    for start in range(0, n, NMS_BLOCK):
+        stop = min(start + NMS_BLOCK, n)
+        if suppressed[start:stop].all():
+            continue
+        rows = _suppression(x1, y1, x2, y2, areas, start, stop, iou_threshold, offset, inclusive)
+        for p in range(start, stop):
+            if suppressed[p]:
+                continue
+            keep.append(order[p])
+            suppressed[start:] |= rows[p - start]
+    return keep
+
+
+def batched_nms(boxes, scores, class_ids, iou_threshold, offset=0, inclusive=False):
+    """greedy_nms within every class, indices are returned class by class in ascending class id."""
+    indices = []
+    for class_id in np.unique(class_ids):
+        class_indices = np.where(class_ids == class_id)[0]
+        keep = greedy_nms(boxes[class_indices, :], scores[class_indices], iou_threshold, offset, inclusive)
+        indices.extend(class_indices[keep])
+    return indices
+
+
+def _same_arithmetic(values):
+    kind = _SAME_ARITHMETIC.get(type(values[0]))
+    return kind is not None and all(_SAME_ARITHMETIC.get(type(v)) == kind and v == v for v in values)
+
+
+def sort_clustered(arr, major, minor, thr):
+    """sorted() with a key equivalent to the threshold comparator of Recognizer.sort_*_firstly,
+    or None when there is none.
+
+    The comparator orders by ``major`` unless two values are closer than ``thr``, then by
+    ``minor``. When the sorted ``major`` values fall into groups narrower than ``thr`` that are at
+    least ``thr`` apart, it agrees on every pair with the key (group, minor) and both sorts return
+    the same list. Otherwise the comparator isn't a total order and only the original sort
+    reproduces its result.
+    """
+    if len(arr) < 2:
+        return list(arr)
+    majors = [a[major] for a in arr]
+    minors = [a[minor] for a in arr]
+    if not _same_arithmetic(majors) or not _same_arithmetic(minors):
+        return None
+    if not thr > 0:
+        return sorted(arr, key=lambda a: a[major])
+    values = sorted(majors)
+    group, first, prev = {values[0]: 0}, values[0], values[0]
+    for v in values[1:]:
+        if abs(v - prev) < thr:
+            group[v] = group[prev]
+        else:
+            if abs(prev - first) >= thr:
+                return None
+            group[v] = group[prev] + 1
+            first = v
+        prev = v
+    if abs(prev - first) >= thr:
+        return None
+    return sorted(arr, key=lambda a: (group[a[major]], a[minor]))
+
+
+class BoxIndex:
+    """Overlap lookups over a fixed list of boxes (dicts with x0, x1, top and bottom).
+
+    Works like an augmented interval tree flattened into arrays: boxes are ordered by top and
+    carry the running maximum of their bottoms, so two binary searches find the slice of boxes
+    that can overlap a query vertically and only that slice is tested. Only comparisons are done
+    here, the overlap areas are still computed by the callers, so their results don't change.
+    Build one per list and reuse it for every box looked up in that list, the list must not be
+    reordered or resized meanwhile.
+    """
+
+    def __init__(self, boxes):
+        top = [float(b["top"]) for b in boxes]
+        self._bottom = [float(b["bottom"]) for b in boxes]
+        self._x0 = [float(b["x0"]) for b in boxes]
+        self._x1 = [float(b["x1"]) for b in boxes]
+        self._order = sorted(range(len(boxes)), key=top.__getitem__)
+        self._sorted_top = [top[i] for i in self._order]
+        self._max_bottom = list(accumulate((self._bottom[i] for i in self._order), max))
+
+    def __len__(self):
+        return len(self._order)
+
+    def overlapping(self, box, s=0, e=None):
+        """Ascending indices in [s, e) of the boxes sharing at least a point with box."""
+        top, bottom, x0, x1 = float(box["top"]), float(box["bottom"]), float(box["x0"]), float(box["x1"])
+        if e is None:
+            e = len(self._order)
+        k = bisect_right(self._sorted_top, bottom)
+        j = bisect_left(self._max_bottom, top, 0, k)
+        bottoms, lefts, rights = self._bottom, self._x0, self._x1
+        res = [
+            i for i in self._order[j:k]
+            if s <= i < e and bottoms[i] >= top and lefts[i] <= x1 and rights[i] >= x0
+        ]
+        res.sort()
+        return res
@@ -9,6 +9,7 @@ import numpy as np
 from app.rag.utils.file_utils import get_project_base_directory
 from app.rag.vision import Recognizer
 from app.rag.vision.operators import nms
+from app.rag.vision.box_ops import BoxIndex
 
 
 class LayoutRecognizer(Recognizer):
@@ -68,6 +69,7 @@ class LayoutRecognizer(Recognizer):
             def findLayout(ty):
                 nonlocal bxs, lts, self
                 lts_ = [lt for lt in lts if lt["type"] == ty]
+                lts_idx = BoxIndex(lts_)
                 i = 0
                 while i < len(bxs):
                     if bxs[i].get("layout_type"):
@@ -78,7 +80,7 @@ class LayoutRecognizer(Recognizer):
                         continue
 
                     ii = self.find_overlapped_with_threashold(bxs[i], lts_,
-                                                              thr=0.4)
+                                                              thr=0.4, index=lts_idx)
                     if ii is None:  # belong to nothing
                         bxs[i]["layout_type"] = ""
                         i += 1
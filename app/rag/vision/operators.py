@@ -684,26 +684,5 @@ def preprocess(im, preprocess_ops):
 
 
 def nms(bboxes, scores, iou_thresh):
-    import numpy as np
-    x1 = bboxes[:, 0]
-    y1 = bboxes[:, 1]
-    x2 = bboxes[:, 2]
-    y2 = bboxes[:, 3]
-    areas = (y2 - y1) * (x2 - x1)
-
-    indices = []
-    index = scores.argsort()[::-1]
-    while index.size > 0:
-        i = index[0]
-        indices.append(i)
-        x11 = np.maximum(x1[i], x1[index[1:]])
-        y11 = np.maximum(y1[i], y1[index[1:]])
-        x22 = np.minimum(x2[i], x2[index[1:]])
-        y22 = np.minimum(y2[i], y2[index[1:]])
-        w = np.maximum(0, x22 - x11 + 1)
-        h = np.maximum(0, y22 - y11 + 1)
-        overlaps = w * h
-        ious = overlaps / (areas[i] + areas[index[1:]] - overlaps)
-        idx = np.where(ious <= iou_thresh)[0]
-        index = index[idx + 1]
-    return indices
+    from .box_ops import greedy_nms
+    return greedy_nms(bboxes, scores, iou_thresh, offset=1, inclusive=True)
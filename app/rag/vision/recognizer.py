@@ -6,6 +6,7 @@ from .operators import *  # noqa: F403
 from .operators import preprocess
 from . import operators
 from .ocr import load_model
+from .box_ops import BoxIndex, batched_nms, sort_clustered
 
 
 class Recognizer:
@@ -30,6 +31,9 @@ class Recognizer:
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
         self.label_list = label_list
+        # models exported with a symbolic (or -1) batch axis can run a whole batch in one call
+        batch_dim = self.ort_sess.get_inputs()[0].shape[0]
+        self.dynamic_batch = not isinstance(batch_dim, int) or batch_dim < 1
 
     @staticmethod
     def sort_Y_firstly(arr, threashold):
@@ -39,6 +43,10 @@ class Recognizer:
                 diff = c1["x0"] - c2["x0"]
             return diff
 
+        # a plain key sort gives the same order whenever one exists, which is the common case
+        res = sort_clustered(arr, "top", "x0", threashold)
+        if res is not None:
+            return res
         arr = sorted(arr, key=cmp_to_key(cmp))
         return arr
 
@@ -50,6 +58,9 @@ class Recognizer:
                 diff = c1["top"] - c2["top"]
             return diff
 
+        res = sort_clustered(arr, "x0", "top", threashold)
+        if res is not None:
+            return res
         arr = sorted(arr, key=cmp_to_key(cmp))
         return arr
 
@@ -58,6 +69,9 @@ class Recognizer:
         # sort using y1 first and then x1
         # sorted(arr, key=lambda r: (r["x0"], r["top"]))
         arr = Recognizer.sort_X_firstly(arr, thr)
+        if all("C" in a for a in arr):
+            # the passes below are an insertion sort when every box has a column
+            return sorted(arr, key=lambda a: (a["C"], a["top"]))
         for i in range(len(arr) - 1):
             for j in range(i, -1, -1):
                 # restore the order using th
@@ -78,6 +92,9 @@ class Recognizer:
         # sort using y1 first and then x1
         # sorted(arr, key=lambda r: (r["top"], r["x0"]))
         arr = Recognizer.sort_Y_firstly(arr, thr)
+        if all("R" in a for a in arr):
+            # the passes below are an insertion sort when every box has a row
+            return sorted(arr, key=lambda a: (a["R"], a["x0"]))
         for i in range(len(arr) - 1):
             for j in range(i, -1, -1):
                 if "R" not in arr[j] or "R" not in arr[j + 1]:
@@ -121,6 +138,7 @@ class Recognizer:
                         a["bottom"] < b["top"],
                         a["top"] > b["bottom"]])
 
+        index = None
         i = 0
         while i + 1 < len(layouts):
             j = i + 1
@@ -143,12 +161,13 @@ class Recognizer:
                     layouts.pop(i)
                 continue
 
+            if index is None:
+                index = BoxIndex(boxes)
             area_i, area_i_1 = 0, 0
-            for b in boxes:
-                if not notOverlapped(b, layouts[i]):
-                    area_i += Recognizer.overlapped_area(b, layouts[i], False)
-                if not notOverlapped(b, layouts[j]):
-                    area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            for k in index.overlapping(layouts[i]):
+                area_i += Recognizer.overlapped_area(boxes[k], layouts[i], False)
+            for k in index.overlapping(layouts[j]):
+                area_i_1 += Recognizer.overlapped_area(boxes[k], layouts[j], False)
 
             if area_i > area_i_1:
                 layouts.pop(j)
@@ -197,7 +216,8 @@ class Recognizer:
         return inputs
 
     @staticmethod
-    def find_overlapped(box, boxes_sorted_by_y, naive=False):
+    def find_overlapped(box, boxes_sorted_by_y, naive=False, index: BoxIndex = None):
+        """``index``, a BoxIndex over boxes_sorted_by_y, limits the scan to the overlapping boxes."""
         if not boxes_sorted_by_y:
             return
         bxs = boxes_sorted_by_y
@@ -222,7 +242,7 @@ class Recognizer:
             break
 
         max_overlaped_i, max_overlaped = None, 0
-        for i in range(s, e):
+        for i in range(s, e) if index is None else index.overlapping(box, s, e):
             ov = Recognizer.overlapped_area(bxs[i], box)
             if ov <= max_overlaped:
                 continue
@@ -247,12 +267,13 @@ class Recognizer:
         return min_i
 
     @staticmethod
-    def find_overlapped_with_threashold(box, boxes, thr=0.3):
+    def find_overlapped_with_threashold(box, boxes, thr=0.3, index: BoxIndex = None):
         if not boxes:
             return
         max_overlapped_i, max_overlapped, _max_overlapped = None, thr, 0
         s, e = 0, len(boxes)
-        for i in range(s, e):
+        # boxes that don't overlap score (0, 0), which only wins when thr <= 0
+        for i in range(s, e) if index is None or thr <= 0 else index.overlapping(box):
             ov = Recognizer.overlapped_area(box, boxes[i])
             _ov = Recognizer.overlapped_area(boxes[i], box)
             if (ov, _ov) < (max_overlapped, _max_overlapped):
@@ -320,46 +341,6 @@ class Recognizer:
             y[:, 3] = x[:, 1] + x[:, 3] / 2
             return y
 
-        def compute_iou(box, boxes):
-            # Compute xmin, ymin, xmax, ymax for both boxes
-            xmin = np.maximum(box[0], boxes[:, 0])
-            ymin = np.maximum(box[1], boxes[:, 1])
-            xmax = np.minimum(box[2], boxes[:, 2])
-            ymax = np.minimum(box[3], boxes[:, 3])
-
-            # Compute intersection area
-            intersection_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
-
-            # Compute union area
-            box_area = (box[2] - box[0]) * (box[3] - box[1])
-            boxes_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
-            union_area = box_area + boxes_area - intersection_area
-
-            # Compute IoU
-            iou = intersection_area / union_area
-
-            return iou
-
-        def iou_filter(boxes, scores, iou_threshold):
-            sorted_indices = np.argsort(scores)[::-1]
-
-            keep_boxes = []
-            while sorted_indices.size > 0:
-                # Pick the last box
-                box_id = sorted_indices[0]
-                keep_boxes.append(box_id)
-
-                # Compute IoU of the picked box with the rest
-                ious = compute_iou(boxes[box_id, :], boxes[sorted_indices[1:], :])
-
-                # Remove boxes with IoU over the threshold
-                keep_indices = np.where(ious < iou_threshold)[0]
-
-                # print(keep_indices.shape, sorted_indices.shape)
-                sorted_indices = sorted_indices[keep_indices + 1]
-
-            return keep_boxes
-
         boxes = np.squeeze(boxes).T
         # Filter out object confidence scores below threshold
         scores = np.max(boxes[:, 4:], axis=1)
@@ -376,14 +357,7 @@ class Recognizer:
         boxes = np.multiply(boxes, input_shape, dtype=np.float32)
         boxes = xywh2xyxy(boxes)
 
-        unique_class_ids = np.unique(class_ids)
-        indices = []
-        for class_id in unique_class_ids:
-            class_indices = np.where(class_ids == class_id)[0]
-            class_boxes = boxes[class_indices, :]
-            class_scores = scores[class_indices]
-            class_keep_boxes = iou_filter(class_boxes, class_scores, 0.2)
-            indices.extend(class_indices[class_keep_boxes])
+        indices = batched_nms(boxes, scores, class_ids, 0.2)
 
         return [{
             "type": self.label_list[class_ids[i]].lower(),
@@ -407,6 +381,14 @@ class Recognizer:
             batch_image_list = imgs[start_index:end_index]
             inputs = self.preprocess(batch_image_list)
             logging.debug("preprocess")
+            if self.dynamic_batch and "scale_factor" not in self.input_names and len(inputs) > 1:
+                # every input is resized to input_shape, stack them and run the batch at once
+                feeds = {k: np.concatenate([ins[k] for ins in inputs], axis=0)
+                         for k in self.input_names}
+                outputs = self.ort_sess.run(None, feeds, self.run_options)[0]
+                for j, ins in enumerate(inputs):
+                    res.append(self.postprocess(outputs[j:j + 1], ins, thr))
+                continue
             for ins in inputs:
                 bb = self.postprocess(
                     self.ort_sess.run(None, {k: v for k, v in ins.items() if k in self.input_names}, self.run_options)[
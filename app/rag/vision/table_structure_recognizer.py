@@ -11,6 +11,26 @@ from app.rag.nlp import rag_tokenizer
 from .recognizer import Recognizer
 
 
+CAPTION_PATTERNS = [re.compile(p) for p in [
+    r"[图表]+[ 0-9:：]{2,}"
+]]
+
+BLOCK_TYPE_PATTERNS = [(re.compile(p), n) for p, n in [
+    ("^(20|19)[0-9]{2}[年/-][0-9]{1,2}[月/-][0-9]{1,2}日*$", "Dt"),
+    (r"^(20|19)[0-9]{2}年$", "Dt"),
+    (r"^(20|19)[0-9]{2}[年-][0-9]{1,2}月*$", "Dt"),
+    ("^[0-9]{1,2}[月-][0-9]{1,2}日*$", "Dt"),
+    (r"^第*[一二三四1-4]季度$", "Dt"),
+    (r"^(20|19)[0-9]{2}年*[一二三四1-4]季度$", "Dt"),
+    (r"^(20|19)[0-9]{2}[ABCDE]$", "Dt"),
+    ("^[0-9.,+%/ -]+$", "Nu"),
+    (r"^[0-9A-Z/\._~-]+$", "Ca"),
+    (r"^[A-Z]*[a-z' -]+$", "En"),
+    (r"^[0-9.,+-]+[0-9A-Za-z/$￥%<>（）()' -]+$", "NE"),
+    (r"^.{1}$", "Sg")
+]]
+
+
 class TableStructureRecognizer(Recognizer):
     labels = [
         "table",
@@ -78,32 +98,16 @@ class TableStructureRecognizer(Recognizer):
 
     @staticmethod
     def is_caption(bx):
-        patt = [
-            r"[图表]+[ 0-9:：]{2,}"
-        ]
-        if any([re.match(p, bx["text"].strip()) for p in patt]) \
+        if any([p.match(bx["text"].strip()) for p in CAPTION_PATTERNS]) \
                 or bx["layout_type"].find("caption") >= 0:
             return True
         return False
 
     @staticmethod
     def blockType(b):
-        patt = [
-            ("^(20|19)[0-9]{2}[年/-][0-9]{1,2}[月/-][0-9]{1,2}日*$", "Dt"),
-            (r"^(20|19)[0-9]{2}年$", "Dt"),
-            (r"^(20|19)[0-9]{2}[年-][0-9]{1,2}月*$", "Dt"),
-            ("^[0-9]{1,2}[月-][0-9]{1,2}日*$", "Dt"),
-            (r"^第*[一二三四1-4]季度$", "Dt"),
-            (r"^(20|19)[0-9]{2}年*[一二三四1-4]季度$", "Dt"),
-            (r"^(20|19)[0-9]{2}[ABCDE]$", "Dt"),
-            ("^[0-9.,+%/ -]+$", "Nu"),
-            (r"^[0-9A-Z/\._~-]+$", "Ca"),
-            (r"^[A-Z]*[a-z' -]+$", "En"),
-            (r"^[0-9.,+-]+[0-9A-Za-z/$￥%<>（）()' -]+$", "NE"),
-            (r"^.{1}$", "Sg")
-        ]
-        for p, n in patt:
-            if re.search(p, b["text"].strip()):
+        txt = b["text"].strip()
+        for p, n in BLOCK_TYPE_PATTERNS:
+            if p.search(txt):
                 return n
         tks = [t for t in rag_tokenizer.tokenize(b["text"]).split() if len(t) > 1]
         if len(tks) > 3:
@@ -142,21 +146,30 @@ class TableStructureRecognizer(Recognizer):
         rowh = np.min(rowh) if rowh else 0
         boxes = Recognizer.sort_R_firstly(boxes, rowh / 2)
         #for b in boxes:print(b)
-        boxes[0]["rn"] = 0
-        rows = [[boxes[0]]]
-        btm = boxes[0]["bottom"]
-        for b in boxes[1:]:
-            b["rn"] = len(rows) - 1
-            lst_r = rows[-1]
-            if lst_r[-1].get("R", "") != b.get("R", "") \
-                    or (b["top"] >= btm - 3 and lst_r[-1].get("R", "-1") != b.get("R", "-2")
-                        ):  # new row
-                btm = b["bottom"]
-                b["rn"] += 1
-                rows.append([b])
-                continue
-            btm = (btm + b["bottom"]) / 2.
-            rows[-1].append(b)
+        if all("R" in b for b in boxes):
+            # every box sits in a detected row, a new row starts exactly where R changes
+            rn = np.concatenate(
+                [[0], np.cumsum(np.diff([b["R"] for b in boxes]) != 0)]) if len(boxes) > 1 else [0]
+            rows = [[] for _ in range(int(rn[-1]) + 1)]
+            for b, n in zip(boxes, rn):
+                b["rn"] = int(n)
+                rows[b["rn"]].append(b)
+        else:
+            boxes[0]["rn"] = 0
+            rows = [[boxes[0]]]
+            btm = boxes[0]["bottom"]
+            for b in boxes[1:]:
+                b["rn"] = len(rows) - 1
+                lst_r = rows[-1]
+                if lst_r[-1].get("R", "") != b.get("R", "") \
+                        or (b["top"] >= btm - 3 and lst_r[-1].get("R", "-1") != b.get("R", "-2")
+                            ):  # new row
+                    btm = b["bottom"]
+                    b["rn"] += 1
+                    rows.append([b])
+                    continue
+                btm = (btm + b["bottom"]) / 2.
+                rows[-1].append(b)
 
         colwm = [b["C_right"] - b["C_left"] for b in boxes if "C" in b]
         colwm = np.min(colwm) if colwm else 0
@@ -0,0 +1,42 @@
+import pytest
+
+dialog_service = pytest.importorskip("app.rag.services.dialog_service")
+
+
+@pytest.fixture(autouse=True)
+def _count_words(monkeypatch):
+    monkeypatch.setattr(dialog_service, "num_tokens_from_string", lambda s: len(s.split()))
+
+
+def _replay(events):
+    text = ""
+    for event in events:
+        text = text + event["answer"] if event["delta"] else event["answer"]
+    return text
+
+
+def test_stream_deltas_sends_each_piece_once():
+    answers = ["a", "a b", "a b c", "a b c d"]
+    events = list(dialog_service.stream_deltas(answers, min_tokens=2))
+
+    assert all(e["delta"] for e in events)
+    assert [e["answer"] for e in events] == ["a b", " c d"]
+    assert events[-1]["tokens"] == 4
+    assert _replay(events) == answers[-1]
+
+
+def test_stream_deltas_replaces_rewritten_answer():
+    answers = ["<think> x y", "<think> x y z", "ok", "ok then"]
+    events = list(dialog_service.stream_deltas(answers, min_tokens=2))
+
+    assert events[0] == {"answer": "<think> x y", "audio_binary": None, "delta": True, "tokens": 3}
+    assert {"answer": "ok", "audio_binary": None, "delta": False, "tokens": 1} in events
+    assert _replay(events) == "ok then"
+
+
+def test_stream_deltas_keeps_sent_text_when_only_unsent_text_shrinks():
+    answers = ["a b", "a b c", "a b", "a b d e"]
+    events = list(dialog_service.stream_deltas(answers, min_tokens=2))
+
+    assert all(e["delta"] for e in events)
+    assert _replay(events) == answers[-1]
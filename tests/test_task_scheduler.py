@@ -0,0 +1,148 @@
+import multiprocessing
+import time
+
+import pytest
+
+from app.rag.services import task_scheduler
+from app.rag.services.task_scheduler import (
+    AdaptiveTaskSizer,
+    InMemoryTaskQueue,
+    SQLiteTaskQueue,
+    TaskPriority,
+    TaskWorkerPool,
+    WeightedFairScheduler,
+    get_task_scheduler,
+)
+
+
+def _sleep_task(task):
+    time.sleep(task["sleep"])
+    return task["id"]
+
+
+def _drain(scheduler):
+    order = []
+    while True:
+        message = scheduler.get(timeout=0)
+        if message is None:
+            return order
+        order.append(message["task"]["id"])
+
+
+def _task(task_id, pages=12, **kwargs):
+    return {"id": task_id, "from_page": 0, "to_page": pages, **kwargs}
+
+
+def test_interactive_tasks_go_first():
+    scheduler = WeightedFairScheduler(InMemoryTaskQueue())
+    scheduler.put(_task("bulk"), TaskPriority.BULK, "t1")
+    scheduler.put(_task("interactive"), TaskPriority.INTERACTIVE, "t1")
+
+    assert _drain(scheduler) == ["interactive", "bulk"]
+
+
+def test_small_tenant_is_not_starved_by_backlog():
+    scheduler = WeightedFairScheduler(InMemoryTaskQueue())
+    for i in range(100):
+        scheduler.put(_task(f"big-{i}"), TaskPriority.BULK, "big")
+    scheduler.put(_task("small-0"), TaskPriority.BULK, "small")
+    scheduler.put(_task("small-1"), TaskPriority.BULK, "small")
+
+    order = _drain(scheduler)
+    assert len(order) == 102
+    assert order.index("small-0") <= 1
+    assert order.index("small-1") <= 3
+
+
+def test_tenant_weights_shift_the_share():
+    scheduler = WeightedFairScheduler(InMemoryTaskQueue(), weights={"heavy": 3.0})
+    for i in range(40):
+        scheduler.put(_task(f"heavy-{i}"), TaskPriority.BULK, "heavy")
+        scheduler.put(_task(f"light-{i}"), TaskPriority.BULK, "light")
+
+    first = _drain(scheduler)[:20]
+    assert sum(t.startswith("heavy") for t in first) == 15
+
+
+def test_sqlite_queue_keeps_fifo_per_tenant_and_survives_reopen(tmp_path):
+    path = str(tmp_path / "queue.sqlite3")
+    scheduler = WeightedFairScheduler(SQLiteTaskQueue(path))
+    for i in range(3):
+        scheduler.put(_task(f"a-{i}"), TaskPriority.BULK, "a")
+    scheduler.put(_task("b-0"), TaskPriority.INTERACTIVE, "b")
+    assert len(scheduler) == 4
+
+    reopened = WeightedFairScheduler(SQLiteTaskQueue(path))
+    assert len(reopened) == 4
+    assert _drain(reopened) == ["b-0", "a-0", "a-1", "a-2"]
+    assert len(SQLiteTaskQueue(path)) == 0
+
+
+def test_sqlite_queue_in_memory():
+    queue = SQLiteTaskQueue(":memory:")
+    queue.push(TaskPriority.BULK, "t1", {"id": "x"})
+    assert queue.tenants(TaskPriority.BULK) == ["t1"]
+    assert queue.pop(TaskPriority.BULK, "t1") == {"id": "x"}
+    assert queue.pop(TaskPriority.BULK, "t1") is None
+
+
+def test_sizer_page_size_follows_measured_cost():
+    sizer = AdaptiveTaskSizer(target_seconds=60.0, alpha=1.0)
+    assert sizer.page_size("naive", 12) == 12
+
+    sizer.record("naive", 12, 12 * 2.0)
+    assert sizer.page_size("naive", 12) == 30
+
+    sizer.record("naive", 12, 12 * 60.0)
+    assert sizer.page_size("naive", 12) == 3
+
+    sizer.record("naive", 12, 0.012)
+    assert sizer.page_size("naive", 12) == 48
+
+
+def test_worker_pool_runs_tasks_and_feeds_sizer():
+    sizer = AdaptiveTaskSizer(target_seconds=0.1)
+    scheduler = WeightedFairScheduler(InMemoryTaskQueue(), sizer)
+    pool = TaskWorkerPool(_sleep_task, scheduler, max_workers=2).start()
+    try:
+        for i in range(4):
+            scheduler.put(_task(f"t-{i}", pages=10, sleep=0.2), TaskPriority.BULK, "t1", "naive")
+        deadline = time.monotonic() + 30
+        while sizer.cost("naive", 0.0) == 0.0 or len(scheduler):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        pool.stop()
+
+    assert len(scheduler) == 0
+    assert sizer.cost("naive", 0.0) >= 0.02
+    assert sizer.page_size("naive", 12) <= 5
+
+
+def test_spawned_workers_preload_resources_when_they_start(monkeypatch):
+    created = {}
+
+    class Executor:
+        def __init__(self, **kwargs):
+            created.update(kwargs)
+
+        def shutdown(self, wait=True):
+            pass
+
+    monkeypatch.setattr(task_scheduler, "ProcessPoolExecutor", Executor)
+    pool = TaskWorkerPool(_sleep_task, max_workers=1, preload=["rag_tokenizer"],
+                          mp_context=multiprocessing.get_context("spawn")).start()
+    pool.stop()
+
+    assert created["initializer"] is task_scheduler._preload_worker
+    assert created["initargs"] == (["rag_tokenizer"],)
+
+
+def test_local_backend_requires_a_task_handler(monkeypatch):
+    monkeypatch.delenv("TASK_QUEUE_BACKEND", raising=False)
+    assert get_task_scheduler() is None
+
+    monkeypatch.setenv("TASK_QUEUE_BACKEND", "memory")
+    monkeypatch.delenv("TASK_HANDLER", raising=False)
+    with pytest.raises(ValueError):
+        get_task_scheduler()